@@ -48,6 +48,7 @@ setup(name='silva.app.subscriptions',
         'silva.core.views',
         'silva.translations',
         'silva.ui',
+        'transaction',
         'z3c.schema',
         'zeam.form.silva',
         'zope.annotation',
@@ -55,7 +56,17 @@ setup(name='silva.app.subscriptions',
         'zope.interface',
         'zope.lifecycleevent',
         'zope.schema',
+        'ZODB3',
         ],
+      entry_points = {
+        'console_scripts': [
+            'silva-subscriptions-worker = silva.app.subscriptions.worker:main',
+            'silva-subscriptions-delivery = '
+            'silva.app.subscriptions.delivery:main',
+            'silva-subscriptions-benchmark = '
+            'silva.app.subscriptions.benchmark:main [test]',
+            ],
+        },
       tests_require = tests_require,
       extras_require = {'test': tests_require},
       )
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+"""Benchmark of the subscription hot paths.
+
+It builds a synthetic Silva site in the test layer, and measures the
+time needed by the most used operations. Mails are sent to a null SMTP
+server. Results are printed as JSON, so they can be compared between
+releases. It requires the test dependencies::
+
+  bin/silva-subscriptions-benchmark --depth 4 --fanout 3 > results.json
+"""
+
+import json
+import optparse
+import platform
+import sys
+import time
+
+import transaction
+
+
+class NullSMTP(object):
+    """SMTP server discarding all messages.
+    """
+    does_esmtp = False
+    sent = 0
+
+    def __init__(self, host, port):
+        pass
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def sendmail(self, mfrom, mto, message):
+        NullSMTP.sent += 1
+        return {}
+
+    def quit(self):
+        pass
+
+    close = quit
+
+
+def build_tree(root, depth, fanout, subscribers, ghosts):
+    """Build a tree of folders of the given depth, with fanout
+    documents and folders in each of them, subscribers email per
+    level, and ghosts of each document. Return the list of documents.
+    """
+    from silva.app.subscriptions.interfaces import ISubscriptionManager
+    from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+
+    documents = []
+
+    def subscribe(container, level):
+        manager = ISubscriptionManager(container)
+        for number in range(subscribers):
+            manager.subscribe('user%d-level%d@example.com' % (number, level))
+
+    def build(container, level):
+        subscribe(container, level)
+        factory = container.manage_addProduct['Silva']
+        for number in range(fanout):
+            identifier = 'document%d' % number
+            factory.manage_addMockupVersionedContent(identifier, identifier)
+            document = container[identifier]
+            documents.append(document)
+            for ghost in range(ghosts):
+                factory.manage_addGhost(
+                    'ghost%d_%d' % (number, ghost), None, haunted=document)
+        if level < depth:
+            for number in range(fanout):
+                identifier = 'folder%d' % number
+                factory.manage_addFolder(identifier, identifier)
+                build(container[identifier], level + 1)
+
+    ISubscriptionManager(root).subscribability = SUBSCRIBABLE
+    build(root, 0)
+    return documents
+
+
+def measure(function, repeat):
+    """Call function repeat times, and return timings in
+    milliseconds.
+    """
+    timings = []
+    for number in range(repeat):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    return {'repeat': repeat,
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+            'max': timings[-1]}
+
+
+def run(root, options):
+    from zope.component import getUtility
+    from silva.core.interfaces import IPublicationWorkflow
+    from silva.app.subscriptions.interfaces import ISubscriptionManager
+    from silva.app.subscriptions.interfaces import ISubscriptionService
+    from silva.app.subscriptions.outgoing import get_mail_data_manager
+    from silva.app.subscriptions.publications import get_publication_batch
+    from silva.app.subscriptions.service import version_published
+    from silva.app.subscriptions.smi import SubscriptionPortlet
+
+    factory = root.manage_addProduct['silva.app.subscriptions']
+    factory.manage_addSubscriptionService()
+    service = getUtility(ISubscriptionService)
+    service.enable_subscriptions()
+    service._bulk_delivery = True
+    service.smtp_factory = NullSMTP
+
+    documents = build_tree(
+        root, options.depth, options.fanout, options.subscribers,
+        options.ghosts)
+    transaction.commit()
+    # The deepest document is the most expensive one.
+    document = documents[-1]
+    for content in documents:
+        IPublicationWorkflow(content).publish()
+    transaction.commit()
+
+    def subscriptions():
+        len(ISubscriptionManager(document).subscriptions)
+
+    def is_subscribable():
+        ISubscriptionManager(document).is_subscribable()
+
+    def send_notification():
+        service.send_notification(document)
+        # Messages are otherwise sent after the commit.
+        get_mail_data_manager(service).send()
+
+    def publish():
+        version_published(document.get_viewable(), None)
+        # Notifications are otherwise sent on commit.
+        get_publication_batch(service).flush()
+        get_mail_data_manager(service).send()
+
+    def portlet():
+        SubscriptionPortlet(document, root.REQUEST, None, None).update()
+
+    results = {}
+    for name, function in [
+        ('subscriptions', subscriptions),
+        ('is_subscribable', is_subscribable),
+        ('send_notification', send_notification),
+        ('version_published', publish),
+        ('portlet_update', portlet)]:
+        results[name] = measure(function, options.repeat)
+        transaction.abort()
+    return results
+
+
+def get_parser():
+    parser = optparse.OptionParser(usage=u"%prog [options]")
+    parser.add_option(
+        '--depth', dest='depth', type='int', default=3,
+        help=u"Depth of the tree of folders")
+    parser.add_option(
+        '--fanout', dest='fanout', type='int', default=3,
+        help=u"Number of folders and documents in each folder")
+    parser.add_option(
+        '--subscribers', dest='subscribers', type='int', default=100,
+        help=u"Number of subscribers at each level")
+    parser.add_option(
+        '--ghosts', dest='ghosts', type='int', default=1,
+        help=u"Number of ghosts of each document")
+    parser.add_option(
+        '--repeat', dest='repeat', type='int', default=20,
+        help=u"Number of times each operation is measured")
+    return parser
+
+
+def main(argv=None):
+    options, args = get_parser().parse_args(argv)
+
+    import pkg_resources
+    from silva.app.subscriptions.testing import FunctionalLayer
+
+    layer = FunctionalLayer
+    layer.setUp()
+    layer.testSetUp()
+    try:
+        root = layer.get_application()
+        layer.login('manager')
+        results = run(root, options)
+        sent = NullSMTP.sent
+    finally:
+        layer.testTearDown()
+        layer.tearDown()
+
+    json.dump({
+            'version': pkg_resources.get_distribution(
+                'silva.app.subscriptions').version,
+            'python': platform.python_version(),
+            'parameters': {
+                'depth': options.depth,
+                'fanout': options.fanout,
+                'subscribers': options.subscribers,
+                'ghosts': options.ghosts},
+            'messages': sent,
+            'results': results},
+              sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
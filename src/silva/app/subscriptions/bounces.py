@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from email import message_from_string
+from email.utils import parseaddr, getaddresses
+import logging
+import mailbox
+import os
+
+import transaction
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+# Reasons for which an address is suppressed.
+BOUNCE = 'bounce'
+COMPLAINT = 'complaint'
+
+
+def open_mailbox(path):
+    """Open the Maildir directory or the mbox file at path.
+    """
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, factory=None, create=False)
+
+
+def get_address(value):
+    """Return the address of a DSN recipient field, like
+    ``rfc822; wim@example.com``.
+    """
+    if ';' in value:
+        value = value.split(';', 1)[1]
+    return parseaddr(value.strip())[1] or None
+
+
+def get_fields(part):
+    """Return the header blocks of a message/* part.
+    """
+    payload = part.get_payload()
+    if isinstance(payload, basestring):
+        return [message_from_string(payload)]
+    return payload or []
+
+
+def get_bounces(message):
+    """Return the (address, reason) pairs of the permanent failures
+    reported by a delivery status notification, or of the complaints
+    reported by a feedback report.
+    """
+    if message.get_content_type() != 'multipart/report':
+        return []
+    results = []
+    complaint = False
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type == 'message/delivery-status':
+            # The first block is about the message, the following ones
+            # about each recipient.
+            for fields in get_fields(part)[1:]:
+                recipient = (fields.get('Final-Recipient') or
+                             fields.get('Original-Recipient'))
+                action = (fields.get('Action') or '').strip().lower()
+                status = (fields.get('Status') or '').strip()
+                if recipient and action == 'failed' and status[:1] == '5':
+                    address = get_address(recipient)
+                    if address:
+                        results.append((address, BOUNCE))
+        elif content_type == 'message/feedback-report':
+            complaint = True
+            for fields in get_fields(part):
+                for recipient in fields.get_all('Original-Rcpt-To', []):
+                    address = get_address(recipient)
+                    if address:
+                        results.append((address, COMPLAINT))
+        elif (complaint and not results and
+              content_type in ('message/rfc822', 'text/rfc822-headers')):
+            # Without Original-Rcpt-To, the complaint is about the
+            # recipient of the original message.
+            for fields in get_fields(part):
+                for name, address in getaddresses(fields.get_all('To', [])):
+                    if address:
+                        results.append((address, COMPLAINT))
+    return results
+
+
+def iter_bounces(path):
+    """Iterate over the messages of a mailbox, one at a time, and
+    yield their key with the bounced addresses they report.
+    """
+    messages = open_mailbox(path)
+    for key in messages.iterkeys():
+        try:
+            message = messages[key]
+        except (KeyError, IOError):
+            # Removed by somebody else in the mean time.
+            continue
+        yield key, get_bounces(message)
+
+
+def remove_messages(success, path, keys):
+    if not success:
+        return
+    messages = open_mailbox(path)
+    messages.lock()
+    try:
+        for key in keys:
+            messages.discard(key)
+        messages.flush()
+    finally:
+        messages.unlock()
+        messages.close()
+
+
+def process_bounces(service, path, remove=False):
+    """Suppress all addresses reported as bounced or complaining in
+    the given mailbox, unsubscribing them from all content. If remove
+    is true, processed bounces are removed from the mailbox once the
+    transaction is committed. Return the number of scanned messages,
+    suppressed addresses and cancelled subscriptions.
+    """
+    messages = 0
+    suppressed = set()
+    cancelled = 0
+    processed = []
+    for key, bounces in iter_bounces(path):
+        messages += 1
+        for address, reason in bounces:
+            cancelled += service.suppress_address(address, reason)
+            suppressed.add(address)
+        if bounces:
+            processed.append(key)
+    if remove and processed:
+        # Only remove the bounces once the suppressions are committed.
+        transaction.get().addAfterCommitHook(
+            remove_messages, args=(path, processed))
+    logger.info(
+        u"Scanned %d messages, suppressed %d addresses and cancelled "
+        u"%d subscriptions.", messages, len(suppressed), cancelled)
+    return messages, len(suppressed), cancelled
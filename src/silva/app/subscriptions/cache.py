@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from collections import OrderedDict
+import threading
+
+
+def get_data_key(data):
+    """Return a key identifying the committed state of subscription
+    data, or None if it is not possible (new or modified data).
+    """
+    key = getattr(data, 'cache_key', None)
+    if key is not None:
+        # Shared default data
+        return key
+    if data._p_oid is None:
+        return None
+    data._p_activate()
+    if data._p_changed:
+        return None
+    length = getattr(data.subscriptions, '_length', None)
+    if length is None:
+        # No email, or emails stored with the data itself.
+        return (data._p_oid, data._p_serial, None)
+    length._p_activate()
+    if length._p_changed:
+        return None
+    return (data._p_oid, data._p_serial, length._p_serial)
+
+
+class SubscribersCache(object):
+    """Cache of inherited subscribers for a list of subscribable
+    parents, shared by all threads.
+
+    Entries are keyed by the committed state of the subscription data
+    of those parents, so a change in any of them (even in an other
+    process) produces a new key. Entries related to a changed content
+    are also removed when the change is notified.
+
+    The cache is bounded by the total number of emails it holds, not
+    by its number of entries, since an entry for the parents of a
+    content contains all the emails subscribed to any of them.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._oids = {}
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, managers):
+        key = []
+        for manager in managers:
+            data_key = get_data_key(manager.data)
+            if data_key is None:
+                return None
+            key.append(data_key)
+        return tuple(key)
+
+    def _pop(self, entry_key):
+        value, weight = self._entries.pop(entry_key)
+        self._weight -= weight
+        key = entry_key[1]
+        for oid, ignored, ignored in key:
+            keys = self._oids.get(oid)
+            if keys is not None:
+                keys.discard(entry_key)
+                if not keys:
+                    del self._oids[oid]
+        return value
+
+    def _lookup(self, kind, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.pop((kind, key), None)
+            if entry is not None:
+                self._entries[(kind, key)] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return None
+
+    def get(self, managers):
+        """Return a dictionary email to position in managers of the
+        first one to which the email is subscribed.
+        """
+        key = self.get_key(managers)
+        emails = self._lookup('emails', key)
+        if emails is not None:
+            return emails
+        emails = {}
+        for position, manager in enumerate(managers):
+            for email in manager.data.subscriptions:
+                emails.setdefault(email, position)
+        if key is not None:
+            self._store('emails', key, emails, len(emails))
+        return emails
+
+    def count(self, managers):
+        """Return the number of different emails subscribed to any
+        of the managers.
+        """
+        if not managers:
+            return 0
+        key = self.get_key(managers)
+        count = self._lookup('count', key)
+        if count is not None:
+            return count
+        inherited = self.get(managers[1:])
+        count = len(inherited)
+        for email in managers[0].data.subscriptions:
+            if email not in inherited:
+                count += 1
+        if key is not None:
+            self._store('count', key, count, 1)
+        return count
+
+    def _store(self, kind, key, value, weight):
+        weight = max(weight, 1)
+        if weight > self.size:
+            return
+        entry_key = (kind, key)
+        with self._lock:
+            if entry_key in self._entries:
+                self._pop(entry_key)
+            self._entries[entry_key] = (value, weight)
+            self._weight += weight
+            for oid, ignored, ignored in key:
+                if oid is not None:
+                    self._oids.setdefault(oid, set()).add(entry_key)
+            while self._weight > self.size:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, data):
+        """Remove all entries related to the given subscription data.
+        """
+        if getattr(data, '_p_oid', None) is None:
+            return
+        with self._lock:
+            for entry_key in list(self._oids.get(data._p_oid, ())):
+                self._pop(entry_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._oids.clear()
+            self._weight = 0
+
+
+subscribers_cache = SubscribersCache()
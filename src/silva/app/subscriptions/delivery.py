@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+"""Pool of processes delivering queued notifications.
+
+Notifications must be queued (the service is asynchronous). Each
+worker process opens its own connection to the database, that must
+be shared between processes (with ZEO or RelStorage), then claims
+batches of notifications, sends them and records which ones were
+sent::
+
+  bin/silva-subscriptions-delivery -C parts/instance/etc/zope.conf \\
+      --workers 4 /root
+
+Notifications that could not be sent are put back in the queue. The
+first worker sends again the messages of the outbox that are due.
+Notifications claimed by a worker that died are put back in the
+queue after --claim-timeout seconds.
+"""
+
+import logging
+import multiprocessing
+import optparse
+import os
+import random
+import socket
+import sys
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from silva.app.subscriptions.worker import MAXIMUM_RETRIES
+from silva.app.subscriptions.worker import get_site, get_service
+from silva.app.subscriptions.worker import send_outbox
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+
+def retry(function, *args):
+    """Call function in a transaction and commit it, retrying on
+    conflicts with the other workers.
+    """
+    for attempt in range(MAXIMUM_RETRIES + 1):
+        try:
+            result = function(*args)
+            transaction.commit()
+            return result
+        except ConflictError:
+            transaction.abort()
+            if attempt == MAXIMUM_RETRIES:
+                raise
+            # Let the other workers finish before trying again.
+            time.sleep(random.random() * 0.1 * (attempt + 1))
+
+
+def send_batch(service, worker, claimed):
+    """Send claimed notifications and record which ones were sent.
+    Messages go out when the transaction is committed: if it
+    conflicts, the batch is sent again from scratch.
+    """
+    sent = []
+    failed = []
+    for key, notification in claimed:
+        savepoint = transaction.savepoint()
+        try:
+            service.send_pending_notification(notification)
+        except ConflictError:
+            raise
+        except Exception:
+            logger.exception(
+                u"Worker %s could not send %r.", worker, notification)
+            # Forget the messages already rendered for it.
+            savepoint.rollback()
+            failed.append(key)
+        else:
+            sent.append(key)
+    service.complete_notifications(sent, failed)
+    return sent, failed
+
+
+def deliver_batch(service, worker, batch_size=None):
+    """Claim a batch of queued notifications for worker, send them
+    and record which ones were sent. Return the number of sent and
+    failed notifications.
+    """
+    # Claims are committed first, so no other worker send them.
+    claimed = retry(service.claim_notifications, worker, batch_size)
+    if not claimed:
+        return 0, 0
+    sent, failed = retry(send_batch, service, worker, claimed)
+    return len(sent), len(failed)
+
+
+def run_worker(service, worker, batch_size=None, limit=None):
+    """Deliver batches of queued notifications until the queue is
+    empty, or limit notifications have been processed. Return the
+    number of sent and failed notifications.
+    """
+    sent = failed = 0
+    while limit is None or sent + failed < limit:
+        size = batch_size
+        if limit is not None:
+            size = min(size or limit, limit - sent - failed)
+        batch_sent, batch_failed = deliver_batch(service, worker, size)
+        sent += batch_sent
+        failed += batch_failed
+        if batch_failed or not batch_sent:
+            # Failed notifications are back at the head of the queue,
+            # they will be tried again by the next run.
+            break
+    return sent, failed
+
+
+def get_worker_name(number):
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), number)
+
+
+def worker_process(options, path, number, results):
+    """Entry point of a worker process.
+    """
+    from Zope2.Startup.run import configure
+    import Zope2
+
+    configure(options.config)
+    root = get_site(Zope2.app(), path, options.url)
+    worker = get_worker_name(number)
+    if not number:
+        # Only one worker look for abandoned claims.
+        released = retry(
+            get_service(root).release_expired_notifications,
+            options.claim_timeout)
+        if released:
+            logger.warning(
+                u"Released %d notifications claimed by dead workers.",
+                released)
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = run_worker(
+            get_service(root), worker, options.batch_size)
+        total_sent += sent
+        total_failed += failed
+        if not number:
+            send_outbox(get_service(root))
+        if not options.interval:
+            break
+        time.sleep(options.interval)
+        transaction.begin()
+    results.put((number, total_sent, total_failed))
+
+
+def run_pool(options, path):
+    """Start the worker processes and wait for them. Return the
+    number of sent and failed notifications, and of workers that
+    exited with an error.
+    """
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker_process, args=(options, path, number, results),
+            name='silva-subscriptions-delivery-%d' % number)
+        for number in range(options.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    sent = failed = errors = 0
+    for process in processes:
+        if process.exitcode:
+            errors += 1
+            continue
+        number, worker_sent, worker_failed = results.get(timeout=10)
+        sent += worker_sent
+        failed += worker_failed
+    return sent, failed, errors
+
+
+def get_parser():
+    parser = optparse.OptionParser(
+        usage=u"%prog -C zope.conf [options] /path/to/silva/root")
+    parser.add_option(
+        '-C', '--config', dest='config',
+        help=u"Zope configuration file")
+    parser.add_option(
+        '-w', '--workers', dest='workers', type='int',
+        default=multiprocessing.cpu_count(),
+        help=u"Number of worker processes (default to the number of CPUs)")
+    parser.add_option(
+        '-b', '--batch-size', dest='batch_size', type='int',
+        help=u"Number of notifications claimed at once by a worker")
+    parser.add_option(
+        '-u', '--url', dest='url', default='http://localhost:8080',
+        help=u"Public URL of the Zope server, used in notifications")
+    parser.add_option(
+        '-t', '--claim-timeout', dest='claim_timeout', type='int',
+        default=3600,
+        help=u"Seconds after which notifications claimed by a worker "
+        u"that didn't report back are sent again")
+    parser.add_option(
+        '-i', '--interval', dest='interval', type='int', default=0,
+        help=u"Keep running, checking the queue every interval seconds")
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    options, args = parser.parse_args(argv)
+    if not options.config or len(args) != 1:
+        parser.error(u"You need to provide a configuration and a site.")
+    if options.workers < 1:
+        parser.error(u"You need at least one worker.")
+
+    logging.basicConfig(level=logging.INFO)
+    sent, failed, errors = run_pool(options, args[0])
+    logger.info(
+        u"Sent %d queued notifications, %d failed.", sent, failed)
+    if errors:
+        logger.error(u"%d delivery workers exited with an error.", errors)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
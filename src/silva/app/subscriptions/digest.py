@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import time
+
+from BTrees.LOBTree import LOBTree
+from persistent import Persistent
+
+from silva.translations import translate as _
+from zope.schema.vocabulary import SimpleVocabulary, SimpleTerm
+
+# Delivery modes for notifications
+IMMEDIATE = 'immediate'
+HOURLY = 'hourly'
+DAILY = 'daily'
+
+DIGEST_PERIODS = (HOURLY, DAILY)
+
+# Events are kept at most a week, even if a digest is not sent anymore
+MAXIMUM_AGE = 7 * 24 * 3600 * 1000000
+
+delivery_modes = SimpleVocabulary([
+        SimpleTerm(value=IMMEDIATE, token=IMMEDIATE,
+                   title=_(u"Immediately")),
+        SimpleTerm(value=HOURLY, token=HOURLY,
+                   title=_(u"Hourly digest")),
+        SimpleTerm(value=DAILY, token=DAILY,
+                   title=_(u"Daily digest"))])
+
+
+def now():
+    return int(time.time() * 1000000)
+
+
+class DigestLog(Persistent):
+    """Log of publications to include in the next digests.
+
+    Only the identifiers of the published contents are recorded. Each
+    digest period remembers up to when it was sent last.
+    """
+
+    def __init__(self):
+        self._events = LOBTree()
+        self._last_runs = dict((period, now()) for period in DIGEST_PERIODS)
+
+    def record(self, content_ids):
+        key = now()
+        while key in self._events:
+            key += 1
+        self._events[key] = tuple(content_ids)
+
+    def collect(self, period):
+        """Return the list of content identifiers published since the
+        last digest for the given period.
+        """
+        start = self._last_runs[period]
+        end = now()
+        events = list(self._events.values(min=start, max=end))
+        last_runs = self._last_runs.copy()
+        last_runs[period] = end + 1
+        self._last_runs = last_runs
+        self.prune()
+        return events
+
+    def prune(self):
+        """Remove events that have been included in all digests.
+        """
+        threshold = max(min(self._last_runs.values()), now() - MAXIMUM_AGE)
+        for key in list(self._events.keys(max=threshold, excludemax=True)):
+            del self._events[key]
+
+    def __len__(self):
+        return len(self._events)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBucket
+from persistent import Persistent
+
+from silva.app.subscriptions.subscribers import PLACEHOLDER
+from silva.app.subscriptions.subscribers import get_slot_key, merge_slots
+
+
+def normalize_email(email):
+    """Return the canonical form of an email address: without
+    surrounding spaces and with a lower case domain. ASCII addresses
+    are returned as interned strings, so that the same address used
+    in many places is stored once in memory.
+    """
+    email = email.strip()
+    if '@' in email:
+        local, domain = email.rsplit('@', 1)
+        email = '@'.join((local, domain.lower()))
+    if isinstance(email, unicode):
+        try:
+            email = email.encode('ascii')
+        except UnicodeEncodeError:
+            return email
+    return intern(email)
+
+
+class SubscriptionIndex(Persistent):
+    """Index of the identifiers of the contents to which each email
+    is locally subscribed.
+
+    As in a SubscriberSet, emails are spread over a fixed number of
+    standalone buckets, created upfront and never emptied, so that
+    concurrent subscriptions of different emails are merged by
+    conflict resolution.
+    """
+    slots = 256
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._slots = IOBTree()
+        for key in range(self.slots):
+            self._slots[key] = OOBucket({PLACEHOLDER: None})
+        self._length = Length(0)
+
+    def _get_slot(self, email):
+        return self._slots[get_slot_key(email, self.slots)]
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, email):
+        email = normalize_email(email)
+        return email != PLACEHOLDER and email in self._get_slot(email)
+
+    def add(self, email, content_id):
+        email = normalize_email(email)
+        slot = self._get_slot(email)
+        content_ids = slot.get(email)
+        if content_ids is None:
+            content_ids = slot[email] = IITreeSet()
+            self._length.change(1)
+        content_ids.insert(content_id)
+
+    def remove(self, email, content_id):
+        email = normalize_email(email)
+        slot = self._get_slot(email)
+        content_ids = slot.get(email)
+        if content_ids is not None and content_id in content_ids:
+            content_ids.remove(content_id)
+            if not content_ids:
+                del slot[email]
+                self._length.change(-1)
+
+    def get(self, email):
+        """Return the list of content identifiers to which the email
+        is subscribed.
+        """
+        email = normalize_email(email)
+        content_ids = self._get_slot(email).get(email)
+        if content_ids is None:
+            return []
+        return list(content_ids)
+
+    def emails(self):
+        return merge_slots(self._slots.values())
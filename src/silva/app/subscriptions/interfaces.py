@@ -43,10 +43,38 @@ class ISubscriptionManager(Interface):
         """Unsubscribe emailaddress for the content.
         """
 
+    def subscribe_many(emails):
+        """Subscribe all the given emails for the content at once.
+        Return for each of them True if it have been subscribed,
+        False if it already was.
+        """
+
+    def unsubscribe_many(emails):
+        """Unsubscribe all the given emails for the content at
+        once. Return for each of them True if it have been
+        unsubscribed, False if it was not subscribed.
+        """
+
     def is_subscribed(email):
         """Return true if the given email is suscribed at this level.
         """
 
+    def count_subscriptions():
+        """Return the number of emails subscribed to the content,
+        here or above.
+        """
+
+    def count_local_subscriptions():
+        """Return the number of emails subscribed to the content
+        at this level.
+        """
+
+    def search_local_subscriptions(prefix=u'', start=0, size=None):
+        """Return in order size emails subscribed to the content at
+        this level starting with prefix, skipping the start first
+        ones.
+        """
+
 
 class ISubscriptionService(ISilvaService, ISilvaLocalService):
 
@@ -73,7 +101,41 @@ class ISubscriptionService(ISilvaService, ISilvaLocalService):
         the given email.
         """
 
+    def subscribe_many(subscriptions):
+        """Subscribe (content, email) pairs without confirmation,
+        modifying each content only once. Return for each pair True
+        if the email have been subscribed, False if it already was,
+        or the error preventing the subscription.
+        """
+
+    def unsubscribe_many(subscriptions):
+        """Unsubscribe (content, email) pairs without confirmation,
+        modifying each content only once. Return for each pair True
+        if the email have been unsubscribed, False if it was not
+        subscribed, or the error preventing the cancellation.
+        """
+
     def send_notification(content, template_id):
         """Render the given template using content information and
-        send the result to the subscribed people.
+        send the result to the subscribed people. Messages are sent
+        only once the current transaction is committed.
+        """
+
+    def send_notifications(contents, template_id, trace=None, snapshots=None):
+        """Like send_notification, for multiple contents at once.
+        People subscribed to more than one of them receive only one
+        message. If a trace is given, the time at which each stage
+        of the delivery is reached is recorded in it. Snapshots of the
+        contents taken earlier can be given by content id.
+        """
+
+    def send_summary(groups, snapshots=None, traces=()):
+        """Send to each person subscribed to some of the contents
+        published together (given as groups of a content and its
+        ghosts) only one message listing all of them.
+        """
+
+    def notify_publications(publications):
+        """Notify subscribers of contents published in the same
+        transaction, given as (contents, trace) pairs.
         """
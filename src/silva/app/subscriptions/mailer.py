@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import logging
+import smtplib
+import socket
+
+from email.parser import HeaderParser
+from email.utils import getaddresses, parseaddr
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+
+def get_envelope(message):
+    """Return the sender and recipients of a rendered message.
+    """
+    headers = HeaderParser().parsestr(message, headersonly=True)
+    mfrom = parseaddr(headers.get('From', ''))[1]
+    mto = [address for name, address in getaddresses(
+            headers.get_all('To', []) +
+            headers.get_all('Cc', []) +
+            headers.get_all('Bcc', [])) if address]
+    return mfrom, mto
+
+
+def encode_message(message):
+    """Return a rendered message as it is sent over SMTP.
+    """
+    if isinstance(message, unicode):
+        return message.encode('utf-8')
+    return message
+
+
+def is_transient(code):
+    """Tell if an SMTP reply code reports a temporary failure, after
+    which sending the message again could succeed.
+    """
+    return 400 <= code < 500
+
+
+def is_permanent(error):
+    """Tell if an error raised while sending a message reports a
+    permanent failure, after which sending it again would fail too.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return not all(is_transient(code)
+                       for code, response in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return not is_transient(error.smtp_code)
+    return False
+
+
+def get_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BatchResult(object):
+    """Outcome of the delivery of one batch of messages.
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.processed = 0
+        self.sent = 0
+        self.failed = {}
+        self.deferred = []
+        self.rejected = []
+        self.error = None
+
+    def fail(self, recipients, error):
+        for recipient in recipients:
+            self.failed[recipient] = error
+
+    def defer(self, message, error):
+        """Record a message that failed for a temporary reason, and
+        can be sent again later.
+        """
+        self.deferred.append((message, error))
+
+    def reject(self, message, error):
+        """Record a message that failed for a permanent reason, and
+        cannot be sent again.
+        """
+        self.rejected.append((message, error))
+
+    def __repr__(self):
+        return '<BatchResult %d: %d sent, %d failed>' % (
+            self.number, self.sent, len(self.failed))
+
+
+class DeliveryReport(object):
+    """Outcome of a bulk delivery.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    @property
+    def sent(self):
+        return sum(batch.sent for batch in self.batches)
+
+    @property
+    def failed(self):
+        failed = {}
+        for batch in self.batches:
+            failed.update(batch.failed)
+        return failed
+
+    @property
+    def deferred(self):
+        deferred = []
+        for batch in self.batches:
+            deferred.extend(batch.deferred)
+        return deferred
+
+    @property
+    def rejected(self):
+        rejected = []
+        for batch in self.batches:
+            rejected.extend(batch.rejected)
+        return rejected
+
+    def __repr__(self):
+        return '<DeliveryReport: %d sent, %d failed>' % (
+            self.sent, len(self.failed))
+
+
+class SMTPMailer(object):
+    """Send a lot of messages using only one SMTP connection. If the
+    server supports it, commands for a message are pipelined.
+    """
+
+    def __init__(self, host='localhost', port=25, user=None, password=None,
+                 batch_size=100, factory=smtplib.SMTP):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.batch_size = batch_size
+        self.factory = factory
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            connection = self.factory(self.host, self.port)
+            connection.ehlo_or_helo_if_needed()
+            if self.user:
+                connection.login(self.user, self.password)
+            self._connection = connection
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                self._connection.close()
+            self._connection = None
+
+    def _pipeline(self, connection, mfrom, mto, message):
+        # RFC 2920: MAIL, RCPT and DATA are sent at once, then the
+        # responses are read.
+        commands = ['MAIL FROM:%s' % smtplib.quoteaddr(mfrom)]
+        commands.extend(
+            ['RCPT TO:%s' % smtplib.quoteaddr(recipient)
+             for recipient in mto])
+        commands.append('DATA')
+        connection.send(''.join(c + smtplib.CRLF for c in commands))
+        code, response = connection.getreply()
+        if code != 250:
+            for recipient in mto:
+                connection.getreply()
+            connection.getreply()
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, response, mfrom)
+        refused = {}
+        for recipient in mto:
+            code, response = connection.getreply()
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        code, response = connection.getreply()
+        if code != 354:
+            connection.rset()
+            if len(refused) == len(mto):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(code, response)
+        connection.send(smtplib.quotedata(message) +
+                        smtplib.CRLF + '.' + smtplib.CRLF)
+        code, response = connection.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def _send(self, mfrom, mto, message):
+        connection = self._connect()
+        if connection.does_esmtp and connection.has_extn('pipelining'):
+            return self._pipeline(connection, mfrom, mto, message)
+        return connection.sendmail(mfrom, mto, message)
+
+    def _send_batch(self, result, batch):
+        for message in batch:
+            mfrom, mto = get_envelope(message)
+            result.processed += 1
+            try:
+                refused = self._send(mfrom, mto, message)
+            except smtplib.SMTPRecipientsRefused as error:
+                result.failed.update(error.recipients)
+                if is_permanent(error):
+                    result.reject(message, str(error.recipients))
+                else:
+                    result.defer(message, str(error.recipients))
+                continue
+            except (smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError) as error:
+                result.fail(mto, (error.smtp_code, error.smtp_error))
+                if is_permanent(error):
+                    result.reject(message, '%d %s' % (
+                            error.smtp_code, error.smtp_error))
+                else:
+                    result.defer(message, '%d %s' % (
+                            error.smtp_code, error.smtp_error))
+                continue
+            result.failed.update(refused)
+            result.sent += 1
+
+    def send(self, messages):
+        """Send the given rendered messages, and return a delivery
+        report.
+        """
+        report = DeliveryReport()
+        messages = (encode_message(message) for message in messages)
+        for number, batch in enumerate(
+            get_batches(messages, self.batch_size)):
+            result = BatchResult(number)
+            report.batches.append(result)
+            try:
+                self._send_batch(result, batch)
+            except (smtplib.SMTPException, socket.error) as error:
+                # The connection is lost, the remaining messages of
+                # the batch are failed. We will reconnect for the next one.
+                logger.error(
+                    u"Error while sending batch %d of notifications: %s",
+                    number, error)
+                result.error = error
+                for message in batch[max(result.processed - 1, 0):]:
+                    result.fail(get_envelope(message)[1], str(error))
+                    result.defer(message, str(error))
+                if self._connection is not None:
+                    self._connection.close()
+                    self._connection = None
+        self._disconnect()
+        return report
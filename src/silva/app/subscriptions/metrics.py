@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds of the timing histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Operations of the service, and the counters and stages recorded
+# for each of them.
+OPERATIONS = (
+    'notification', 'digest', 'confirmation', 'information', 'outbox')
+COUNTERS = ('recipients', 'messages', 'bytes', 'failures')
+STAGES = ('resolve', 'render', 'deliver')
+
+
+class Histogram(object):
+    """Distribution of durations in buckets.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        index = 0
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def statistics(self):
+        return {'count': self.count,
+                'total': self.total,
+                'average': self.count and self.total / self.count or 0.0,
+                'maximum': self.maximum}
+
+
+class Metrics(object):
+    """Counters and timings of a subscription service, shared by all
+    threads of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self._counters = {}
+        self._timings = {}
+
+    def increment(self, operation, name, value=1):
+        with self._lock:
+            key = (operation, name)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, operation, stage, duration):
+        with self._lock:
+            key = (operation, stage)
+            histogram = self._timings.get(key)
+            if histogram is None:
+                histogram = self._timings[key] = Histogram()
+            histogram.observe(duration)
+
+    @contextmanager
+    def timer(self, operation, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(operation, stage, time.time() - start)
+
+    def get_counter(self, operation, name):
+        with self._lock:
+            return self._counters.get((operation, name), 0)
+
+    def get_timing(self, operation, stage):
+        with self._lock:
+            histogram = self._timings.get((operation, stage))
+            if histogram is None:
+                return Histogram().statistics()
+            return histogram.statistics()
+
+    def statistics(self):
+        """Return a flat dictionary of all the counters and timings.
+        """
+        data = {}
+        for operation in OPERATIONS:
+            for name in COUNTERS:
+                data['%s_%s' % (operation, name)] = self.get_counter(
+                    operation, name)
+            for stage in STAGES:
+                timing = self.get_timing(operation, stage)
+                for name in ('count', 'average', 'maximum'):
+                    data['%s_%s_%s' % (operation, stage, name)] = \
+                        timing[name]
+        return data
+
+    def render(self, prefix='silva_subscriptions'):
+        """Render all the metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted(
+                (key, histogram.buckets, list(histogram.counts),
+                 histogram.count, histogram.total)
+                for key, histogram in self._timings.items())
+        for (operation, name), value in counters:
+            lines.append('%s_%s_total{operation="%s"} %d' % (
+                    prefix, name, operation, value))
+        for (operation, stage), buckets, counts, count, total in timings:
+            labels = 'operation="%s",stage="%s"' % (operation, stage)
+            cumulative = 0
+            for bound, number in zip(buckets + ('+Inf',), counts):
+                cumulative += number
+                lines.append('%s_seconds_bucket{%s,le="%s"} %d' % (
+                        prefix, labels, bound, cumulative))
+            lines.append('%s_seconds_sum{%s} %f' % (prefix, labels, total))
+            lines.append('%s_seconds_count{%s} %d' % (prefix, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics(key):
+    """Return the metrics shared by all threads for the given
+    key. Metrics are not persistent, so that recording them doesn't
+    write in the database.
+    """
+    with _metrics_lock:
+        metrics = _metrics.get(key)
+        if metrics is None:
+            metrics = _metrics[key] = Metrics()
+        return metrics
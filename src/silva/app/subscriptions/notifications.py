@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import time
+
+from BTrees.LOBTree import LOBTree
+from BTrees.Length import Length
+from persistent import Persistent
+
+
+class PendingNotification(object):
+    """A notification that have been requested but not sent yet.
+    """
+    trace = None
+    snapshots = ()
+    groups = None
+    traces = ()
+    attempts = 0
+
+    def __init__(self, content_ids, template_id, trace=None, snapshots=(),
+                 groups=None, traces=()):
+        self.content_ids = tuple(content_ids)
+        self.template_id = template_id
+        self.created = time.time()
+        self.trace = trace
+        self.snapshots = tuple(snapshots)
+        if groups is not None:
+            # Contents published together, notified in one message,
+            # with the trace of each publication.
+            self.groups = tuple(map(tuple, groups))
+            self.traces = tuple(traces)
+
+    def __repr__(self):
+        return '<PendingNotification for %s using %s>' % (
+            ', '.join(map(str, self.content_ids)), self.template_id)
+
+
+class NotificationQueue(Persistent):
+    """Persistent queue of pending notifications.
+
+    Entries are ordered by creation time. Adding an entry only touch
+    one bucket of the underlying tree, so concurrent publications
+    don't conflict with each other.
+
+    Delivery workers claim entries, which are kept aside until they
+    are reported as sent, or released to be sent again. Entries
+    released too many times are kept as dead letters.
+    """
+    _claimed = None
+    _dead = None
+
+    def __init__(self):
+        self._entries = LOBTree()
+        self._length = Length(0)
+
+    def __len__(self):
+        return self._length()
+
+    def _new_key(self):
+        key = int(time.time() * 1000000)
+        while key in self._entries or (
+            self._claimed is not None and key in self._claimed):
+            key += 1
+        return key
+
+    def append(self, content_ids, template_id, trace=None, snapshots=(),
+               groups=None, traces=()):
+        notification = PendingNotification(
+            content_ids, template_id, trace, snapshots, groups, traces)
+        self._entries[self._new_key()] = notification
+        self._length.change(1)
+        return notification
+
+    def peek(self, size=None):
+        """Return the first size pending notifications without
+        removing them from the queue.
+        """
+        entries = []
+        for notification in self._entries.itervalues():
+            if size is not None and len(entries) >= size:
+                break
+            entries.append(notification)
+        return entries
+
+    def _pop_items(self, size=None):
+        keys = []
+        for key in self._entries.iterkeys():
+            if size is not None and len(keys) >= size:
+                break
+            keys.append(key)
+        items = []
+        for key in keys:
+            items.append((key, self._entries.pop(key)))
+        if items:
+            self._length.change(-len(items))
+        return items
+
+    def pop(self, size=None):
+        """Remove and return the first size pending notifications.
+        """
+        return [notification for key, notification in self._pop_items(size)]
+
+    def claim(self, worker, size=None):
+        """Remove the first size pending notifications from the queue
+        on behalf of worker, and return them with their keys.
+        """
+        if self._claimed is None:
+            self._claimed = LOBTree()
+        claimed = []
+        now = time.time()
+        for key, notification in self._pop_items(size):
+            self._claimed[key] = (worker, now, notification)
+            claimed.append((key, notification))
+        return claimed
+
+    def get_claimed(self):
+        """Return the claimed notifications as (key, worker, claim
+        time, notification).
+        """
+        if self._claimed is None:
+            return []
+        return [(key,) + entry for key, entry in self._claimed.items()]
+
+    def complete(self, keys):
+        """Forget the given claimed notifications, that have been sent.
+        """
+        if self._claimed is None:
+            return
+        for key in keys:
+            self._claimed.pop(key, None)
+
+    def release(self, keys, maximum_attempts=None):
+        """Put the given claimed notifications back in the queue, so
+        they are sent again, or in the dead letters once they have
+        been released maximum_attempts times. Return the dead ones.
+        """
+        if self._claimed is None:
+            return []
+        released = 0
+        dead = []
+        for key in keys:
+            entry = self._claimed.pop(key, None)
+            if entry is None:
+                continue
+            notification = entry[2]
+            notification.attempts += 1
+            if (maximum_attempts is not None and
+                notification.attempts >= maximum_attempts):
+                if self._dead is None:
+                    self._dead = LOBTree()
+                self._dead[key] = notification
+                dead.append(notification)
+                continue
+            self._entries[key] = notification
+            released += 1
+        if released:
+            self._length.change(released)
+        return dead
+
+    def release_expired(self, timeout, maximum_attempts=None):
+        """Release the notifications claimed more than timeout
+        seconds ago, by a worker that probably died. Return their
+        number.
+        """
+        threshold = time.time() - timeout
+        expired = [key for key, worker, claimed, notification
+                   in self.get_claimed() if claimed < threshold]
+        self.release(expired, maximum_attempts)
+        return len(expired)
+
+    def count_dead_letters(self):
+        if self._dead is None:
+            return 0
+        return len(self._dead)
+
+    def get_dead_letters(self):
+        """Return the notifications that failed too many times, by
+        key.
+        """
+        if self._dead is None:
+            return []
+        return list(self._dead.items())
+
+    def _pop_dead(self, keys=None):
+        if self._dead is None:
+            return []
+        if keys is None:
+            keys = list(self._dead.keys())
+        items = []
+        for key in keys:
+            notification = self._dead.pop(key, None)
+            if notification is not None:
+                items.append((key, notification))
+        return items
+
+    def replay(self, keys=None):
+        """Queue again the given dead letters (or all of them), in
+        their original position. Return their number.
+        """
+        items = self._pop_dead(keys)
+        for key, notification in items:
+            notification.attempts = 0
+            self._entries[key] = notification
+        if items:
+            self._length.change(len(items))
+        return len(items)
+
+    def purge(self, keys=None):
+        """Remove the given dead letters (or all of them). Return
+        their number.
+        """
+        return len(self._pop_dead(keys))
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import time
+
+from BTrees.LOBTree import LOBTree
+from BTrees.Length import Length
+from persistent import Persistent
+
+from silva.app.subscriptions.mailer import get_envelope
+
+# Default delay before sending a message again, doubled after each
+# failed attempt, up to a maximum.
+RETRY_DELAY = 60
+MAXIMUM_DELAY = 6 * 3600
+MAXIMUM_ATTEMPTS = 8
+
+
+def now():
+    return int(time.time() * 1000000)
+
+
+def get_delay(attempts, delay=RETRY_DELAY, maximum=MAXIMUM_DELAY):
+    """Return the number of seconds to wait before sending again a
+    message after the given number of failed attempts.
+    """
+    return min(delay * 2 ** max(attempts - 1, 0), maximum)
+
+
+class OutboxMessage(object):
+    """A rendered message that could not be sent yet.
+    """
+
+    def __init__(self, message, error=None, attempts=1):
+        self.message = message
+        self.created = time.time()
+        self.attempts = attempts
+        self.error = error
+
+    @property
+    def recipients(self):
+        return get_envelope(self.message)[1]
+
+    @property
+    def subject(self):
+        for line in self.message.splitlines():
+            if not line:
+                break
+            if line.lower().startswith('subject:'):
+                return line[8:].strip()
+        return None
+
+    def __repr__(self):
+        return '<OutboxMessage to %s after %d attempts>' % (
+            ', '.join(self.recipients), self.attempts)
+
+
+class Outbox(Persistent):
+    """Messages that failed to be sent. They are retried with an
+    exponential backoff, and kept as dead letters after too many
+    failures.
+
+    Pending messages are ordered by the time they are due, dead
+    letters by the time they died.
+    """
+
+    def __init__(self):
+        self._pending = LOBTree()
+        self._pending_length = Length(0)
+        self._dead = LOBTree()
+        self._dead_length = Length(0)
+
+    def __len__(self):
+        return self._pending_length()
+
+    def count_dead_letters(self):
+        return self._dead_length()
+
+    def _insert(self, tree, key, message):
+        while key in tree:
+            key += 1
+        tree[key] = message
+        return key
+
+    def _schedule(self, message, delay):
+        self._insert(self._pending, now() + int(delay * 1000000), message)
+        self._pending_length.change(1)
+
+    def add(self, message, error=None, delay=RETRY_DELAY, attempts=1):
+        """Add a message that failed to be sent a first time, or that
+        could not be sent yet if attempts is 0.
+        """
+        entry = OutboxMessage(message, error, attempts)
+        self._schedule(entry, delay)
+        return entry
+
+    def pop_due(self, size=None, accept=None):
+        """Remove and return the messages that are due to be sent
+        again, and accepted by the given function if any. They must
+        be given back to retry if they fail again.
+        """
+        keys = []
+        for key, entry in self._pending.iteritems(max=now()):
+            if size is not None and len(keys) >= size:
+                break
+            if accept is None or accept(entry):
+                keys.append(key)
+        entries = [self._pending.pop(key) for key in keys]
+        if entries:
+            self._pending_length.change(-len(entries))
+        return entries
+
+    def retry(self, entry, error, delay=RETRY_DELAY,
+              maximum_attempts=MAXIMUM_ATTEMPTS):
+        """Record a new failure of a message. Schedule it again after
+        an exponential backoff, or move it to the dead letters if it
+        failed too many times. Return True if it will be retried.
+        """
+        if entry.attempts + 1 >= maximum_attempts:
+            self.bury(entry.message, error, entry.attempts + 1)
+            return False
+        entry = OutboxMessage(entry.message, error, entry.attempts + 1)
+        self._schedule(entry, get_delay(entry.attempts, delay))
+        return True
+
+    def bury(self, message, error=None, attempts=1):
+        """Keep a message that cannot be sent as a dead letter.
+        """
+        entry = OutboxMessage(message, error, attempts)
+        self._insert(self._dead, now(), entry)
+        self._dead_length.change(1)
+        return entry
+
+    def get_pending(self):
+        """Return the pending messages with the time they are due.
+        """
+        return [(key / 1000000.0, entry)
+                for key, entry in self._pending.items()]
+
+    def get_dead_letters(self):
+        """Return the dead letters by key.
+        """
+        return list(self._dead.items())
+
+    def _pop_dead(self, keys=None):
+        if keys is None:
+            keys = list(self._dead.keys())
+        entries = []
+        for key in keys:
+            entry = self._dead.pop(key, None)
+            if entry is not None:
+                entries.append(entry)
+        if entries:
+            self._dead_length.change(-len(entries))
+        return entries
+
+    def replay(self, keys=None):
+        """Schedule the given dead letters (or all of them) to be
+        sent again now, as new messages. Return their number.
+        """
+        entries = self._pop_dead(keys)
+        for entry in entries:
+            self._schedule(
+                OutboxMessage(entry.message, entry.error, attempts=0), 0)
+        return len(entries)
+
+    def purge(self, keys=None):
+        """Remove the given dead letters (or all of them). Return
+        their number.
+        """
+        return len(self._pop_dead(keys))
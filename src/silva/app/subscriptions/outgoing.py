@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import logging
+import weakref
+
+import transaction
+from transaction.interfaces import IDataManager, IDataManagerSavepoint
+from ZODB.POSException import ConflictError
+from zope.interface import implements
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+# Number of times failures are recorded again after a conflict.
+MAXIMUM_RETRIES = 3
+
+# Messages not sent yet, per transaction and service.
+_managers = weakref.WeakKeyDictionary()
+
+
+class MailSavepoint(object):
+    """Savepoint of the messages queued in a transaction.
+    """
+    implements(IDataManagerSavepoint)
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.length = len(manager._deliveries)
+
+    def rollback(self):
+        del self.manager._deliveries[self.length:]
+
+
+class MailDataManager(object):
+    """Messages rendered during a transaction. They are sent by the
+    service once the transaction is committed, and forgotten if it is
+    aborted, so a transaction retried after a conflict doesn't send
+    them twice.
+    """
+    implements(IDataManager)
+
+    def __init__(self, service):
+        self.service = service
+        self.transaction_manager = transaction.manager
+        self._deliveries = []
+        self._joined = False
+        # Wait for the rate limiter while sending. Only set by the
+        # workers, a request must not be held after its commit.
+        self.throttled = False
+
+    def add(self, messages, operation='notification', traces=(),
+            entries=None):
+        """Queue rendered messages, to be sent after the commit. The
+        traces are marked when they are sent. Entries are the outbox
+        entries of the messages, if they are sent again.
+        """
+        if not messages:
+            return
+        if not self._joined:
+            # A rolled back savepoint can make us leave the transaction.
+            transaction.get().join(self)
+            self._joined = True
+        self._deliveries.append((messages, operation, traces, entries))
+
+    def __len__(self):
+        return sum(len(delivery[0]) for delivery in self._deliveries)
+
+    def send(self):
+        """Send the queued messages now, and record the ones that
+        failed in the outbox with a new transaction.
+        """
+        deliveries = self._deliveries
+        self._deliveries = []
+        failures = []
+        for messages, operation, traces, entries in deliveries:
+            try:
+                failures.extend(self.service._send_now(
+                        messages, operation, traces, entries,
+                        self.throttled))
+            except Exception:
+                logger.exception(
+                    u"Error while sending %d %s messages.",
+                    len(messages), operation)
+        if failures:
+            record_failures(self.service, failures)
+
+    def _reset(self):
+        self._deliveries = []
+        self._joined = False
+
+    def abort(self, txn):
+        self._reset()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        # Nothing can fail the transaction anymore.
+        self._joined = False
+        self.send()
+
+    def tpc_abort(self, txn):
+        self._reset()
+
+    def savepoint(self):
+        return MailSavepoint(self)
+
+    def sortKey(self):
+        # Finish after the database connections.
+        return '~silva.app.subscriptions:%d' % id(self)
+
+
+def record_failures(service, failures):
+    """Record messages that could not be sent after a transaction was
+    committed. As it cannot be changed anymore, it is done with a new
+    transaction and connection. Nothing can fail the transaction
+    anymore, errors are only logged.
+    """
+    try:
+        connection = service._p_jar
+        if connection is None:
+            service._defer_messages(failures)
+            return
+        manager = transaction.TransactionManager()
+        connection = connection.db().open(transaction_manager=manager)
+        try:
+            for attempt in range(MAXIMUM_RETRIES + 1):
+                try:
+                    manager.begin()
+                    connection.get(service._p_oid)._defer_messages(failures)
+                    manager.commit()
+                    return
+                except ConflictError:
+                    manager.abort()
+                except Exception:
+                    manager.abort()
+                    raise
+        finally:
+            connection.close()
+        logger.error(
+            u"Could not record %d messages that failed to be sent.",
+            len(failures))
+    except Exception:
+        logger.exception(
+            u"Error while recording %d messages that failed to be sent.",
+            len(failures))
+
+
+def get_mail_data_manager(service):
+    """Return the messages to send for the given service when the
+    current transaction is committed.
+    """
+    current = transaction.get()
+    managers = _managers.setdefault(current, {})
+    key = service.getPhysicalPath()
+    if key not in managers:
+        managers[key] = MailDataManager(service)
+    return managers[key]
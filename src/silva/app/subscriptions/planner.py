@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from collections import OrderedDict
+
+from silva.app.subscriptions.index import normalize_email
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+
+
+class Recipient(object):
+    """One email to notify about a content, subscribed via
+    subscribed_content.
+    """
+
+    def __init__(self, email, content, subscribed_content):
+        self.email = email
+        self.content = content
+        self.subscribed_content = subscribed_content
+
+
+class DeliveryPlan(object):
+    """Merge the subscribers of multiple contents changed by the same
+    event (like a content and the ghosts haunting it), so that every
+    email is notified only once.
+
+    If an email is subscribed to more than one of those contents, it
+    is notified about the first one added to the plan. Emails that
+    differ only by the case of their domain are notified only once.
+    """
+
+    def __init__(self, contents=()):
+        self._recipients = OrderedDict()
+        self._contents = []
+        for content in contents:
+            self.add(content)
+
+    def add(self, content):
+        manager = ISubscriptionManager(content, None)
+        if manager is None:
+            return
+        self._contents.append(content)
+        for subscription in manager.get_subscriptions():
+            key = normalize_email(subscription.email)
+            if key not in self._recipients:
+                self._recipients[key] = Recipient(
+                    subscription.email, content, subscription.content)
+
+    @property
+    def contents(self):
+        return list(self._contents)
+
+    def __contains__(self, email):
+        return normalize_email(email) in self._recipients
+
+    def __len__(self):
+        return len(self._recipients)
+
+    def __iter__(self):
+        return self._recipients.itervalues()
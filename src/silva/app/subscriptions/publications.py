@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from collections import OrderedDict
+import weakref
+
+import transaction
+
+from silva.core.references.reference import get_content_id
+
+# Publications not notified yet, per transaction and service.
+_batches = weakref.WeakKeyDictionary()
+
+
+class PublicationBatch(object):
+    """Contents published during one transaction, notified together
+    right before it is committed.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._publications = OrderedDict()
+
+    def add(self, contents, trace=None):
+        """Add contents published together (a content and the ghosts
+        haunting it). Publishing the same content again in the same
+        transaction is notified only once.
+        """
+        key = get_content_id(contents[0])
+        if key not in self._publications:
+            self._publications[key] = (list(contents), trace)
+
+    def __len__(self):
+        return len(self._publications)
+
+    def flush(self):
+        publications = self._publications.values()
+        self._publications.clear()
+        if publications:
+            self.service.notify_publications(publications)
+
+
+def get_publication_batch(service):
+    """Return the batch of publications to notify for the given
+    service when the current transaction is committed.
+    """
+    current = transaction.get()
+    batches = _batches.setdefault(current, {})
+    key = service.getPhysicalPath()
+    if key not in batches:
+        batch = batches[key] = PublicationBatch(service)
+        current.addBeforeCommitHook(batch.flush)
+    return batches[key]
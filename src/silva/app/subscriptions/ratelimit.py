@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket allowing rate messages per second, with bursts up
+    to capacity messages.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def fill(self):
+        """Ratio of available tokens.
+        """
+        self._refill()
+        return max(self.tokens, 0) / self.capacity
+
+    def available(self):
+        """Tell if a token can be taken right now.
+        """
+        self._refill()
+        return self.tokens >= 1
+
+    def reserve(self):
+        """Take one token, and return how long to wait before it is
+        actually available.
+        """
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    """Limit the number of messages sent per second, globally and
+    optionally per recipient domain. Messages over the limit wait
+    until they can be sent, or are not sent at all if the caller
+    cannot wait.
+    """
+
+    def __init__(self, rate, burst=None, domain_rate=None, domain_burst=None,
+                 clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or rate
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst or domain_rate
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(rate, self.burst, clock)
+        self._domains = {}
+        self.waiting = 0
+        self.messages = 0
+        self.delayed = 0
+        self.postponed = 0
+        self.total_wait = 0.0
+        self.maximum_wait = 0.0
+
+    def _get_domain_bucket(self, domain):
+        bucket = self._domains.get(domain)
+        if bucket is None:
+            bucket = self._domains[domain] = TokenBucket(
+                self.domain_rate, self.domain_burst, self.clock)
+        return bucket
+
+    def _get_buckets(self, recipients):
+        buckets = [self._bucket]
+        if self.domain_rate:
+            domains = set(
+                recipient.rsplit('@', 1)[-1].lower()
+                for recipient in recipients)
+            buckets.extend(map(self._get_domain_bucket, domains))
+        return buckets
+
+    def acquire(self, recipients=()):
+        """Take the capacity to send a message to the given
+        recipients if it is available right now, without waiting.
+        Return True if the message can be sent.
+        """
+        with self._lock:
+            buckets = self._get_buckets(recipients)
+            if not all(bucket.available() for bucket in buckets):
+                self.postponed += 1
+                return False
+            for bucket in buckets:
+                bucket.reserve()
+            self.messages += 1
+            return True
+
+    def wait(self, recipients=()):
+        """Wait until a message to the given recipients can be sent.
+        Return the time waited.
+        """
+        with self._lock:
+            delay = 0.0
+            for bucket in self._get_buckets(recipients):
+                delay = max(delay, bucket.reserve())
+            self.messages += 1
+            if delay:
+                self.delayed += 1
+                self.total_wait += delay
+                self.maximum_wait = max(self.maximum_wait, delay)
+                self.waiting += 1
+        if delay:
+            try:
+                self.sleep(delay)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        return delay
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'fill': int(self._bucket.fill * 100),
+                'waiting': self.waiting,
+                'messages': self.messages,
+                'delayed': self.delayed,
+                'postponed': self.postponed,
+                'average_wait': self.delayed and
+                self.total_wait / self.delayed or 0.0,
+                'maximum_wait': self.maximum_wait}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key, rate, burst=None, domain_rate=None,
+                     domain_burst=None):
+    """Return the rate limiter shared by all threads for the given
+    key, or None if rate is not set. Rate limiters are not persistent,
+    so that waiting doesn't write in the database.
+    """
+    with _limiters_lock:
+        if not rate:
+            _limiters.pop(key, None)
+            return None
+        config = (rate, burst, domain_rate, domain_burst)
+        limiter = _limiters.get(key)
+        if limiter is None or limiter.config != config:
+            limiter = _limiters[key] = RateLimiter(*config)
+            limiter.config = config
+        return limiter
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import logging
+import uuid
+
+from Acquisition import aq_base
+from five import grok
+from OFS.interfaces import ITraversable
+
+logger = logging.getLogger('silva.app.subscriptions')
+_marker = object()
+
+# Property of the templates that can be rendered once for all
+# recipients.
+RENDER_ONCE = 'render_once'
+
+
+def is_rendered_once(template):
+    """Tell if the template can be rendered once for all recipients.
+    """
+    return bool(getattr(aq_base(template), RENDER_ONCE, False))
+
+
+def set_rendered_once(template, value=True):
+    """Mark (or unmark) the template as renderable once for all
+    recipients. It can be changed from its ZMI properties as well.
+    """
+    if template.hasProperty(RENDER_ONCE):
+        template.manage_changeProperties({RENDER_ONCE: value})
+    else:
+        template.manage_addProperty(RENDER_ONCE, value, 'boolean')
+
+
+class PlaceholderContent(object):
+    """Stand in for the subscribed content while rendering a
+    template. Its URL is a marker replaced later on for each recipient.
+    """
+    grok.implements(ITraversable)
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, url):
+        self._url = url
+
+    def absolute_url(self):
+        return self._url
+
+    def restrictedTraverse(self, path, default=None):
+        if path in ('@@absolute_url', 'absolute_url'):
+            return self.absolute_url
+        raise KeyError(path)
+
+    unrestrictedTraverse = restrictedTraverse
+
+
+class SnapshotContent(PlaceholderContent):
+    """Stand in for a published content while rendering a template,
+    using only the data captured in a snapshot: the content itself is
+    never loaded. A template needing anything else fails to render.
+    """
+    __roles__ = None
+
+    def __init__(self, snapshot, root=None):
+        super(SnapshotContent, self).__init__(snapshot.url)
+        self.snapshot = snapshot
+        self._root = root
+
+    @property
+    def title(self):
+        return self.snapshot.title
+
+    def getId(self):
+        return self.snapshot.path[-1]
+
+    def getPhysicalPath(self):
+        return self.snapshot.path
+
+    def getPhysicalRoot(self):
+        # Looked up by page templates to get the request.
+        return self._root
+
+    def get_title(self):
+        return self.snapshot.title
+
+    def get_title_or_id(self):
+        return self.snapshot.title or self.getId()
+
+    def restrictedTraverse(self, path, default=_marker):
+        if path in ('getId', 'get_title', 'get_title_or_id',
+                    'getPhysicalPath', 'absolute_url', 'title'):
+            return getattr(self, path)
+        if path == '@@absolute_url':
+            return self.absolute_url
+        if default is _marker:
+            raise KeyError(path)
+        return default
+
+    unrestrictedTraverse = restrictedTraverse
+
+
+class MessageRenderer(object):
+    """Render a notification template for a list of recipients.
+
+    Only the recipient email, the subscribed content and the service
+    URL change between two recipients. A template that inserts those
+    values as they are can be marked as rendered once: it is rendered
+    only once with markers in place of those, that are replaced for
+    each recipient. Other templates are rendered for each recipient.
+    """
+
+    def __init__(self, template, data):
+        self.template = template
+        self.data = data
+        self._urls = {}
+        self._message = None
+        self._markers = None
+        self._split = None
+
+    def _get_url(self, content):
+        key = content.getPhysicalPath()
+        url = self._urls.get(key)
+        if url is None:
+            url = self._urls[key] = content.absolute_url()
+        return url
+
+    def _get_recipient_data(self, email, content):
+        url = self._get_url(content)
+        return {'to': email,
+                'subscribed_content': content,
+                'service_url': url + '/subscriptions.html'}
+
+    def _render(self, email, content):
+        data = self.data.copy()
+        data.update(self._get_recipient_data(email, content))
+        return self.template(**data)
+
+    def _prepare(self):
+        token = uuid.uuid4().hex
+        self._markers = markers = {
+            'to': '@@%s:to@@' % token,
+            'subscribed_content': '@@%s:url@@' % token}
+        data = self.data.copy()
+        data['to'] = markers['to']
+        data['subscribed_content'] = PlaceholderContent(
+            markers['subscribed_content'])
+        data['service_url'] = markers['subscribed_content'] + \
+            '/subscriptions.html'
+        try:
+            self._message = self.template(**data)
+        except Exception:
+            logger.info(
+                u"Template %s cannot be rendered once for all recipients.",
+                self.template.getId())
+            return False
+        return True
+
+    def _fill(self, email, content):
+        message = self._message.replace(self._markers['to'], email)
+        return message.replace(
+            self._markers['subscribed_content'], self._get_url(content))
+
+    def render(self, email, content):
+        """Render the message for the given email subscribed via the
+        given content.
+        """
+        if self._split is None:
+            self._split = is_rendered_once(self.template) and self._prepare()
+        if self._split:
+            return self._fill(email, content)
+        return self._render(email, content)
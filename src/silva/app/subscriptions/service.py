@@ -3,30 +3,60 @@
 # See also LICENSE.txt
 
 # Python
+from collections import OrderedDict
 from datetime import datetime
 import time
 import urllib
 import logging
+import smtplib
 
 # Zope
 from AccessControl import ClassSecurityInfo
 from Acquisition import aq_base
 from App.class_init import InitializeClass
+from BTrees.OOBTree import OOBTree
 from OFS import Folder
 
 # Silva
 from Products.Silva import SilvaPermissions
 from Products.Silva import MAILDROPHOST_AVAILABLE, MAILHOST_ID
-from Products.Silva.mail import sendmail
 from Products.Silva.install import add_helper, pt_add_helper
 
 from five import grok
 from zope import interface, schema
 from silva.app.subscriptions import errors
+from silva.app.subscriptions.bounces import process_bounces
 from silva.app.subscriptions.interfaces import (
     ISubscriptionService, ISubscriptionManager)
+from silva.app.subscriptions.digest import DigestLog, delivery_modes
+from silva.app.subscriptions.digest import IMMEDIATE, DIGEST_PERIODS
+from silva.app.subscriptions.index import SubscriptionIndex, normalize_email
+from silva.app.subscriptions.mailer import SMTPMailer, get_envelope
+from silva.app.subscriptions.mailer import encode_message, is_permanent
+from silva.app.subscriptions.metrics import get_metrics
+from silva.app.subscriptions.metrics import OPERATIONS, COUNTERS, STAGES
+from silva.app.subscriptions.notifications import NotificationQueue
+from silva.app.subscriptions.outbox import Outbox
+from silva.app.subscriptions.outbox import RETRY_DELAY, MAXIMUM_ATTEMPTS
+from silva.app.subscriptions.outgoing import get_mail_data_manager
+from silva.app.subscriptions.planner import DeliveryPlan
+from silva.app.subscriptions.publications import get_publication_batch
+from silva.app.subscriptions.ratelimit import get_rate_limiter
+from silva.app.subscriptions.rendering import MessageRenderer
+from silva.app.subscriptions.rendering import SnapshotContent
+from silva.app.subscriptions.rendering import set_rendered_once
+from silva.app.subscriptions.snapshot import take_snapshot
+from silva.app.subscriptions.subscribable import query_subscribable_data
+from silva.app.subscriptions.tracing import Trace, get_latency_recorder
+from silva.app.subscriptions.transfer import export_subscriptions
+from silva.app.subscriptions.transfer import import_subscriptions
+from silva.app.subscriptions.tracing import STAGES as LATENCY_STAGES
+from silva.app.subscriptions.tracing import PERCENTILES
+from silva.app.subscriptions.subscribable import walk_subscribable_data
 from silva.core import conf as silvaconf
+from silva.core.conf import schema as silvaschema
 from silva.core.interfaces import IHaunted, IVersion, IPublishable
+from silva.core.interfaces import ISilvaObject
 from silva.core.interfaces.events import IContentPublishedEvent
 from silva.core.interfaces import ISilvaConfigurableService
 from silva.core.layout.interfaces import IMetadata
@@ -36,8 +66,14 @@ from silva.core.services.interfaces import ISecretService
 from silva.translations import translate as _
 from z3c.schema.email import isValidMailAddress
 from zeam.form import silva as silvaforms
+from zeam.form.base import DISPLAY
+from zeam.form.base.datamanager import DictDataManager
 from zope.component import queryUtility, getUtility
+from zope.schema.interfaces import IContextSourceBinder
+from zope.schema.vocabulary import SimpleVocabulary, SimpleTerm
 from zope.lifecycleevent.interfaces import IObjectCreatedEvent
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from OFS.interfaces import IObjectWillBeRemovedEvent
 
 logger = logging.getLogger('silva.app.subscriptions')
 
@@ -71,6 +107,7 @@ class SubscriptionService(Folder.Folder, SilvaService):
 
     manage_options = (
         {'label':'Settings', 'action':'manage_settings'},
+        {'label':'Metrics', 'action':'manage_metrics'},
         ) + Folder.Folder.manage_options
 
     security = ClassSecurityInfo()
@@ -80,6 +117,23 @@ class SubscriptionService(Folder.Folder, SilvaService):
     _from = 'Subscription Service <subscription-service@example.com>'
     _sitename = 'Silva'
     _maximum_delay = 3
+    _asynchronous = False
+    _batch_size = 100
+    _notifications = None
+    _bulk_delivery = False
+    _bulk_batch_size = 100
+    smtp_factory = smtplib.SMTP
+    _digest_mode = IMMEDIATE
+    _delivery_modes = None
+    _digests = None
+    _index = None
+    _rate_limit = 0
+    _rate_burst = 0
+    _domain_rate_limit = 0
+    _suppressed = None
+    _outbox = None
+    _retry_delay = RETRY_DELAY
+    _retry_attempts = MAXIMUM_ATTEMPTS
 
     # ZMI methods
 
@@ -176,6 +230,8 @@ class SubscriptionService(Folder.Folder, SilvaService):
             content_id, email, 'confirm_subscription', token):
             raise errors.SubscriptionError()
         manager.subscribe(email)
+        # The address is working again.
+        self.unsuppress_address(email)
 
     security.declareProtected(SilvaPermissions.View, 'unsubscribe')
     def unsubscribe(self, content_id, email, token):
@@ -192,20 +248,737 @@ class SubscriptionService(Folder.Folder, SilvaService):
             raise errors.CancellationError()
         manager.unsubscribe(email)
 
+    security.declarePrivate('subscribe_many')
+    def subscribe_many(self, subscriptions):
+        return self._change_many(subscriptions, 'subscribe_many', True)
+
+    security.declarePrivate('unsubscribe_many')
+    def unsubscribe_many(self, subscriptions):
+        return self._change_many(subscriptions, 'unsubscribe_many', False)
+
+    def _change_many(self, subscriptions, method, validate):
+        # Group (content, email) pairs per content, so each content is
+        # modified only once, and return the results in order.
+        results = []
+        groups = OrderedDict()
+        for content, email in subscriptions:
+            position = len(results)
+            results.append(None)
+            if validate and not isValidMailAddress(email):
+                results[position] = errors.InvalidEmailaddressError(email)
+                continue
+            key = content.getPhysicalPath()
+            group = groups.get(key)
+            if group is None:
+                manager = ISubscriptionManager(content, None)
+                if manager is None:
+                    results[position] = errors.NotSubscribableError(content)
+                    continue
+                group = groups[key] = (manager, [], [])
+            group[1].append(position)
+            group[2].append(email)
+        for manager, positions, emails in groups.itervalues():
+            for position, result in zip(
+                positions, getattr(manager, method)(emails)):
+                results[position] = result
+        return results
+
     security.declarePrivate('send_notification')
     def send_notification(
         self, content, template_id='publication_event_template'):
+        self.send_notifications([content], template_id)
+
+    security.declarePrivate('send_notifications')
+    def send_notifications(
+        self, contents, template_id='publication_event_template',
+        trace=None, snapshots=None):
+        # Notify the subscribers of all the given contents, sending
+        # only one message per subscriber. Messages are rendered from
+        # snapshots of the contents, the given ones (by content id)
+        # or new ones.
         if not self.are_subscriptions_enabled():
             return
-        template = self._get_template(content, template_id)
-        data = self._get_default_data(content)
-        manager = ISubscriptionManager(content)
-        for subscription in manager.get_subscriptions():
-            content_url = subscription.content.absolute_url()
-            data['subscribed_content'] = subscription.content
-            data['service_url'] = content_url + '/subscriptions.html'
-            data['to'] = subscription.email
-            self._send_email(template, data)
+        metrics = self.get_metrics()
+        with metrics.timer('notification', 'resolve'):
+            plan = DeliveryPlan(contents)
+            recipients = plan
+            if template_id == 'publication_event_template':
+                # People who asked for a digest will be notified later.
+                recipients = [recipient for recipient in plan
+                              if self.get_delivery_mode(recipient.email) ==
+                              IMMEDIATE]
+                if len(recipients) != len(plan):
+                    self._record_digest(plan.contents)
+            if self._suppressed:
+                recipients = [recipient for recipient in recipients
+                              if not self.is_suppressed(recipient.email)]
+        metrics.increment('notification', 'recipients', len(recipients))
+        if trace is not None:
+            trace.mark('resolved')
+        renderers = {}
+        loaded = set()
+        root = self.getPhysicalRoot()
+
+        def get_renderer(content):
+            snapshot = None
+            if snapshots:
+                snapshot = snapshots.get(get_content_id(content))
+            if snapshot is None:
+                snapshot = take_snapshot(content)
+            context = SnapshotContent(snapshot, root)
+            return MessageRenderer(
+                self._get_template(context, template_id),
+                self._get_default_data(
+                    context, metadata=snapshot.get_metadata()))
+
+        def render(recipient):
+            key = recipient.content.getPhysicalPath()
+            renderer = renderers.get(key)
+            if renderer is None:
+                renderer = renderers[key] = get_renderer(recipient.content)
+            try:
+                return renderer.render(
+                    recipient.email, recipient.subscribed_content)
+            except Exception:
+                if key in loaded:
+                    raise
+            # The template needs more than the snapshot captured.
+            loaded.add(key)
+            logger.warning(
+                u"Template %s cannot be rendered from a snapshot, "
+                u"using content %s.", template_id, '/'.join(key))
+            renderer = renderers[key] = MessageRenderer(
+                self._get_template(recipient.content, template_id),
+                self._get_default_data(recipient.content))
+            return renderer.render(
+                recipient.email, recipient.subscribed_content)
+
+        self._deliver(
+            (render(recipient) for recipient in recipients),
+            traces=[trace] if trace is not None else ())
+
+    security.declarePrivate('get_delivery_mode')
+    def get_delivery_mode(self, email):
+        if self._delivery_modes is not None:
+            mode = self._delivery_modes.get(normalize_email(email))
+            if mode is not None:
+                return mode
+        return self._digest_mode
+
+    security.declarePrivate('set_delivery_mode')
+    def set_delivery_mode(self, email, mode):
+        # Set the delivery mode for a given email, or reset it to the
+        # default one if mode is None.
+        if mode is not None and mode not in delivery_modes:
+            raise ValueError(mode)
+        email = normalize_email(email)
+        if self._delivery_modes is None:
+            if mode is None:
+                return
+            self._delivery_modes = OOBTree()
+        if mode is None:
+            if email in self._delivery_modes:
+                del self._delivery_modes[email]
+        else:
+            self._delivery_modes[email] = mode
+
+    def _record_digest(self, contents):
+        if self._digests is None:
+            self._digests = DigestLog()
+        self._digests.record(
+            [get_content_id(content) for content in contents])
+
+    security.declarePrivate('send_digests')
+    def send_digests(self, period):
+        # Send one digest to each people who choose the given period,
+        # listing all content that changed since the last one. Return
+        # the number of sent digests.
+        if period not in DIGEST_PERIODS:
+            raise ValueError(period)
+        if self._digests is None or not self.are_subscriptions_enabled():
+            return 0
+        metrics = self.get_metrics()
+        with metrics.timer('digest', 'resolve'):
+            plans = [
+                DeliveryPlan(filter(None, map(get_content_from_id, ids)))
+                for ids in self._digests.collect(period)]
+            entries = self._collect_changes(
+                plans, lambda email: (
+                    self.get_delivery_mode(email) == period and
+                    not self.is_suppressed(email)))
+        metrics.increment('digest', 'recipients', len(entries))
+        return self._send_changes(entries, 'digest_template', 'digest')
+
+    security.declarePrivate('send_summary')
+    def send_summary(self, groups, snapshots=None, traces=()):
+        # Send one message to each subscriber listing all the
+        # contents they follow in groups of contents published
+        # together. Return the number of sent messages.
+        if not self.are_subscriptions_enabled():
+            return 0
+        metrics = self.get_metrics()
+        with metrics.timer('notification', 'resolve'):
+            plans = map(DeliveryPlan, groups)
+            for plan in plans:
+                if any(self.get_delivery_mode(recipient.email) != IMMEDIATE
+                       for recipient in plan):
+                    # People who asked for a digest will be notified later.
+                    self._record_digest(plan.contents)
+            entries = self._collect_changes(
+                plans, lambda email: (
+                    self.get_delivery_mode(email) == IMMEDIATE and
+                    not self.is_suppressed(email)), snapshots)
+        metrics.increment('notification', 'recipients', len(entries))
+        for trace in traces:
+            trace.mark('resolved')
+        return self._send_changes(
+            entries, 'summary_template', 'notification', traces)
+
+    def _collect_changes(self, plans, accept, snapshots=None):
+        # Return for each accepted email the details of all contents
+        # it follows in the given delivery plans.
+        entries = OrderedDict()
+        details = {}
+
+        def get_details(content):
+            key = content.getPhysicalPath()
+            if key not in details:
+                snapshot = None
+                if snapshots:
+                    snapshot = snapshots.get(get_content_id(content))
+                if snapshot is not None:
+                    url, title = snapshot.url, snapshot.title
+                else:
+                    url = content.absolute_url()
+                    title = content.get_title_or_id()
+                details[key] = {'url': url,
+                                'title': title,
+                                'service_url': url + '/subscriptions.html'}
+            return details[key]
+
+        for plan in plans:
+            for recipient in plan:
+                if not accept(recipient.email):
+                    continue
+                changes = entries.setdefault(recipient.email, OrderedDict())
+                key = recipient.content.getPhysicalPath()
+                if key not in changes:
+                    subscribed = get_details(recipient.subscribed_content)
+                    entry = get_details(recipient.content).copy()
+                    entry['subscribed_url'] = subscribed['url']
+                    entry['service_url'] = subscribed['service_url']
+                    changes[key] = entry
+        return entries
+
+    def _send_changes(self, entries, template_id, operation, traces=()):
+        # Send to each email one message listing its changes.
+        if not entries:
+            return 0
+        root = self.get_root()
+        template = self._get_template(root, template_id)
+
+        def render(email, changes):
+            data = self._get_default_data(root, email)
+            data['entries'] = changes.values()
+            return template(**data)
+
+        self._deliver(
+            (render(email, changes)
+             for email, changes in entries.iteritems()),
+            operation, traces)
+        return len(entries)
+
+    security.declarePrivate('index_subscription')
+    def index_subscription(self, content, email):
+        if self._index is None:
+            self._index = SubscriptionIndex()
+        self._index.add(email, get_content_id(content))
+
+    security.declarePrivate('unindex_subscription')
+    def unindex_subscription(self, content, email):
+        if self._index is not None:
+            self._index.remove(email, get_content_id(content))
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'get_subscribed_content')
+    def get_subscribed_content(self, email):
+        # Return all the contents to which email is locally subscribed.
+        if self._index is None:
+            return []
+        contents = []
+        for content_id in self._index.get(email):
+            content = get_content_from_id(content_id)
+            if content is not None:
+                contents.append(content)
+        return contents
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'rebuild_index')
+    def rebuild_index(self):
+        # Rebuild the index of subscribed emails from the content.
+        index = SubscriptionIndex()
+        for content, data in walk_subscribable_data(self.get_root()):
+            content_id = get_content_id(content)
+            for email in data.subscriptions:
+                index.add(email, content_id)
+        self._index = index
+        return len(index)
+
+    security.declarePrivate('unsubscribe_everywhere')
+    def unsubscribe_everywhere(self, email):
+        # Cancel all the subscriptions of an email, and return their
+        # number.
+        results = self.unsubscribe_many(
+            (content, email)
+            for content in self.get_subscribed_content(email))
+        return results.count(True)
+
+    security.declarePrivate('suppress_address')
+    def suppress_address(self, email, reason):
+        # Stop sending anything to an email, and cancel all its
+        # subscriptions. Return the number of cancelled subscriptions.
+        if self._suppressed is None:
+            self._suppressed = OOBTree()
+        self._suppressed[normalize_email(email)] = (reason, time.time())
+        return self.unsubscribe_everywhere(email)
+
+    security.declarePrivate('unsuppress_address')
+    def unsuppress_address(self, email):
+        if self._suppressed is not None:
+            email = normalize_email(email)
+            if email in self._suppressed:
+                del self._suppressed[email]
+
+    security.declarePrivate('is_suppressed')
+    def is_suppressed(self, email):
+        return (self._suppressed is not None and
+                normalize_email(email) in self._suppressed)
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'get_suppressed_addresses')
+    def get_suppressed_addresses(self):
+        # Return the suppressed emails, with the reason and the time of
+        # their suppression.
+        if self._suppressed is None:
+            return []
+        return [(email, reason, when)
+                for email, (reason, when) in self._suppressed.items()]
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'process_bounces')
+    def process_bounces(self, path, remove=False):
+        # Suppress the addresses reported by the bounces found in the
+        # Maildir or mbox at path.
+        return process_bounces(self, path, remove)
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'export_subscriptions')
+    def export_subscriptions(self, stream):
+        # Write all subscriptions as content path, email CSV rows.
+        return export_subscriptions(self.get_root(), stream)
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'import_subscriptions')
+    def import_subscriptions(
+        self, stream, batch_size=1000, commit=True, progress=None):
+        # Subscribe emails listed with content paths in CSV rows,
+        # committing every batch_size rows.
+        return import_subscriptions(
+            self.get_root(), stream, batch_size, commit, progress)
+
+    security.declarePrivate('get_rate_limiter')
+    def get_rate_limiter(self):
+        return get_rate_limiter(
+            self.getPhysicalPath(), self._rate_limit, self._rate_burst,
+            self._domain_rate_limit)
+
+    security.declarePrivate('get_metrics')
+    def get_metrics(self):
+        return get_metrics(self.getPhysicalPath())
+
+    security.declarePrivate('get_latency_recorder')
+    def get_latency_recorder(self):
+        return get_latency_recorder(self.getPhysicalPath())
+
+    security.declareProtected(
+        SilvaPermissions.ViewManagementScreens, 'get_latency_report')
+    def get_latency_report(self, content=None):
+        # Return percentiles of the time elapsed between the
+        # publication of content (or any content) and each stage of
+        # the delivery of its notifications.
+        content_id = None
+        if content is not None:
+            content_id = get_content_id(content)
+        return self.get_latency_recorder().report(content_id)
+
+    def _throttle(self, messages):
+        limiter = self.get_rate_limiter()
+        for message in messages:
+            if limiter is not None:
+                limiter.wait(get_envelope(message)[1])
+            yield message
+
+    def _deliver(self, messages, operation='notification', traces=()):
+        # Render the messages now, recording the time spent to do
+        # it, and send them once the transaction is committed.
+        metrics = self.get_metrics()
+        rendered = []
+        messages = iter(messages)
+        while True:
+            start = time.time()
+            try:
+                message = next(messages)
+            except StopIteration:
+                break
+            duration = time.time() - start
+            metrics.observe(operation, 'render', duration)
+            metrics.increment(operation, 'messages')
+            metrics.increment(
+                operation, 'bytes', len(encode_message(message)))
+            for trace in traces:
+                trace.mark('rendered')
+            rendered.append(message)
+        manager = get_mail_data_manager(self)
+        if not manager.throttled:
+            rendered = self._admit(rendered)
+        if not rendered:
+            for trace in traces:
+                self._record_trace(trace)
+            return
+        manager.add(rendered, operation, traces)
+
+    def _admit(self, messages):
+        # Return the messages the rate limiter allows to send right
+        # now. The other ones are kept in the outbox, to be sent by
+        # the workers that can wait for the limiter.
+        limiter = self.get_rate_limiter()
+        if limiter is None:
+            return messages
+        admitted = []
+        for message in messages:
+            if limiter.acquire(get_envelope(message)[1]):
+                admitted.append(message)
+                continue
+            if self._outbox is None:
+                self._outbox = Outbox()
+            self._outbox.add(message, u"Rate limit exceeded", 0, 0)
+        if len(admitted) < len(messages):
+            logger.info(
+                u"Rate limit exceeded, %d messages left in the outbox.",
+                len(messages) - len(admitted))
+        return admitted
+
+    def _send_now(self, messages, operation='notification', traces=(),
+                  entries=None, throttle=False):
+        # Send rendered messages, after the transaction that produced
+        # them is committed, waiting for the rate limiter if throttle
+        # is set (otherwise they were admitted by it already).
+        # Return the messages that failed, their error, outbox entry
+        # and whether the failure is permanent.
+        metrics = self.get_metrics()
+        failures = []
+        if entries is None:
+            entries = [None] * len(messages)
+        if self._bulk_delivery:
+            # The mailer reports failed messages as they are sent.
+            messages = map(encode_message, messages)
+        pending = {}
+        for message, entry in zip(messages, entries):
+            pending.setdefault(message, []).append(entry)
+
+        def hand(messages):
+            if throttle:
+                messages = self._throttle(messages)
+            for message in messages:
+                for trace in traces:
+                    trace.mark('handed')
+                yield message
+
+        start = time.time()
+        try:
+            if self._bulk_delivery:
+                report = self.send_messages(hand(messages))
+                if report.failed:
+                    metrics.increment(
+                        operation, 'failures', len(report.failed))
+                for message, error in report.rejected:
+                    failures.append(
+                        (message, error, pending[message].pop(0), True))
+                for message, error in report.deferred:
+                    failures.append(
+                        (message, error, pending[message].pop(0), False))
+                if report.sent:
+                    for trace in traces:
+                        trace.mark('delivered')
+            else:
+                for message in hand(messages):
+                    try:
+                        self._send_message(message)
+                    except Exception as error:
+                        # Don't prevent the other messages to be sent.
+                        metrics.increment(operation, 'failures')
+                        failures.append(
+                            (message, error, pending[message].pop(0),
+                             is_permanent(error)))
+                        continue
+                    for trace in traces:
+                        trace.mark('delivered')
+        finally:
+            metrics.observe(operation, 'deliver', time.time() - start)
+            for trace in traces:
+                self._record_trace(trace)
+        return failures
+
+    def _record_trace(self, trace):
+        self.get_latency_recorder().record(trace)
+        logger.debug(
+            u"Notification %s for content %s: %s.",
+            trace.trace_id, trace.content_id, ', '.join(
+                '%s after %.3fs' % (stage, latency)
+                for stage, latency in sorted(
+                    trace.latencies().items(), key=lambda i: i[1])))
+
+    security.declarePrivate('send_messages')
+    def send_messages(self, messages, batch_size=None):
+        # Send all the given rendered messages over one SMTP
+        # connection to the server configured in the mailhost.
+        mailhost = getattr(self.get_root(), MAILHOST_ID)
+        mailer = SMTPMailer(
+            host=getattr(mailhost, 'smtp_host', None) or 'localhost',
+            port=int(getattr(mailhost, 'smtp_port', None) or 25),
+            user=getattr(mailhost, 'smtp_uid', None) or None,
+            password=getattr(mailhost, 'smtp_pwd', None) or None,
+            batch_size=batch_size or self._bulk_batch_size,
+            factory=self.smtp_factory)
+        report = mailer.send(messages)
+        for recipient, error in report.failed.items():
+            logger.error(
+                u"Could not send notification to %s: %s.", recipient, error)
+        return report
+
+    def _defer_messages(self, failures):
+        # Keep the messages that could not be sent in the outbox, to
+        # send them again later. Messages coming from the outbox are
+        # retried until they failed too many times, messages that
+        # failed permanently are directly kept as dead letters.
+        if self._outbox is None:
+            self._outbox = Outbox()
+        for message, error, entry, permanent in failures:
+            if permanent:
+                entry = self._outbox.bury(
+                    message, str(error),
+                    1 if entry is None else entry.attempts + 1)
+                logger.error(
+                    u"Could not send message to %s, giving up: %s.",
+                    ', '.join(entry.recipients), error)
+            elif entry is None:
+                entry = self._outbox.add(
+                    message, str(error), self._retry_delay)
+                logger.warning(
+                    u"Could not send message to %s, will retry later: %s.",
+                    ', '.join(entry.recipients), error)
+            elif not self._outbox.retry(
+                entry, str(error), self._retry_delay, self._retry_attempts):
+                logger.error(
+                    u"Giving up sending message to %s after %d "
+                    u"attempts: %s.", ', '.join(entry.recipients),
+                    entry.attempts + 1, error)
+
+    security.declarePrivate('get_outbox')
+    def get_outbox(self):
+        return self._outbox
+
+    security.declarePrivate('process_outbox')
+    def process_outbox(self, size=None, throttle=False):
+        # Send again the messages of the outbox that are due, once
+        # the transaction is committed. Messages failing again are
+        # put back in the outbox. Unless throttle is set, only the
+        # messages the rate limiter allows now are sent, so nothing
+        # waits. Return the number of messages.
+        if self._outbox is None:
+            return 0
+        accept = None
+        limiter = self.get_rate_limiter()
+        if limiter is not None and not throttle:
+            accept = lambda entry: limiter.acquire(entry.recipients)
+        entries = self._outbox.pop_due(size, accept)
+        metrics = self.get_metrics()
+        metrics.increment('outbox', 'messages', len(entries))
+        metrics.increment('outbox', 'bytes', sum(
+                len(encode_message(entry.message)) for entry in entries))
+        manager = get_mail_data_manager(self)
+        if throttle:
+            manager.throttled = True
+        manager.add(
+            [entry.message for entry in entries], 'outbox', entries=entries)
+        return len(entries)
+
+    security.declarePrivate('replay_dead_letters')
+    def replay_dead_letters(self, keys=None):
+        if self._outbox is None:
+            return 0
+        return self._outbox.replay(keys)
+
+    security.declarePrivate('purge_dead_letters')
+    def purge_dead_letters(self, keys=None):
+        if self._outbox is None:
+            return 0
+        return self._outbox.purge(keys)
+
+    security.declarePrivate('queue_notification')
+    def queue_notification(
+        self, content, template_id='publication_event_template'):
+        self.queue_notifications([content], template_id)
+
+    security.declarePrivate('queue_notifications')
+    def queue_notifications(
+        self, contents, template_id='publication_event_template',
+        trace=None):
+        if not self.are_subscriptions_enabled():
+            return
+        if self._notifications is None:
+            self._notifications = NotificationQueue()
+        # Capture the contents now, so they don't need to be loaded
+        # again to render the notifications.
+        self._notifications.append(
+            [get_content_id(content) for content in contents], template_id,
+            trace, [take_snapshot(content) for content in contents])
+
+    security.declarePrivate('queue_summary')
+    def queue_summary(self, groups, traces=()):
+        if not self.are_subscriptions_enabled():
+            return
+        if self._notifications is None:
+            self._notifications = NotificationQueue()
+        content_ids = []
+        snapshots = []
+        for contents in groups:
+            content_ids.append(tuple(map(get_content_id, contents)))
+            snapshots.extend(map(take_snapshot, contents))
+        self._notifications.append(
+            [content_id for ids in content_ids for content_id in ids],
+            'summary_template', snapshots=snapshots, groups=content_ids,
+            traces=traces)
+
+    security.declarePrivate('notify_publications')
+    def notify_publications(self, publications):
+        # Notify subscribers of contents published in the same
+        # transaction, given as (contents, trace) pairs. If there is
+        # more than one, each subscriber receives one message listing
+        # all the published contents they follow.
+        if (len(publications) == 1 or
+            'summary_template' not in self.objectIds()):
+            for contents, trace in publications:
+                if self._asynchronous:
+                    # Only record the notification, the worker will
+                    # send it.
+                    self.queue_notifications(contents, trace=trace)
+                else:
+                    self.send_notifications(contents, trace=trace)
+        else:
+            groups = [contents for contents, trace in publications]
+            traces = [trace for contents, trace in publications
+                      if trace is not None]
+            if self._asynchronous:
+                self.queue_summary(groups, traces)
+            else:
+                self.send_summary(groups, traces=traces)
+
+    security.declarePrivate('get_pending_notifications')
+    def get_pending_notifications(self):
+        if self._notifications is None:
+            return 0
+        return len(self._notifications)
+
+    security.declarePrivate('process_notifications')
+    def process_notifications(self, batch_size=None):
+        # Send a batch of queued notifications, and return the number
+        # of processed ones. The caller is responsible for committing.
+        if self._notifications is None:
+            return 0
+        if batch_size is None:
+            batch_size = self._batch_size
+        pending = self._notifications.pop(batch_size)
+        for notification in pending:
+            self.send_pending_notification(notification)
+        return len(pending)
+
+    security.declarePrivate('send_pending_notification')
+    def send_pending_notification(self, notification):
+        # Only workers send queued notifications, they can wait for
+        # the rate limiter.
+        get_mail_data_manager(self).throttled = True
+
+        def get_contents(content_ids):
+            contents = []
+            for content_id in content_ids:
+                content = get_content_from_id(content_id)
+                if content is None:
+                    logger.warning(
+                        u"Dropping notification for missing content %s.",
+                        content_id)
+                    continue
+                contents.append(content)
+            return contents
+
+        snapshots = dict(
+            (snapshot.content_id, snapshot)
+            for snapshot in notification.snapshots)
+        if notification.groups is not None:
+            self.send_summary(
+                map(get_contents, notification.groups), snapshots,
+                notification.traces)
+        else:
+            self.send_notifications(
+                get_contents(notification.content_ids),
+                notification.template_id, notification.trace, snapshots)
+
+    security.declarePrivate('claim_notifications')
+    def claim_notifications(self, worker, batch_size=None):
+        # Remove a batch of queued notifications from the queue on
+        # behalf of a delivery worker, that must commit before
+        # sending them, and report back with complete_notifications.
+        if self._notifications is None:
+            return []
+        if batch_size is None:
+            batch_size = self._batch_size
+        return self._notifications.claim(worker, batch_size)
+
+    security.declarePrivate('complete_notifications')
+    def complete_notifications(self, sent=(), failed=()):
+        # Record the outcome of claimed notifications: the failed
+        # ones are put back in the queue, or kept as dead letters
+        # once they failed too many times.
+        if self._notifications is None:
+            return
+        self._notifications.complete(sent)
+        for notification in self._notifications.release(
+            failed, self._retry_attempts):
+            logger.error(
+                u"Giving up sending %r after %d attempts.",
+                notification, notification.attempts)
+
+    security.declarePrivate('release_expired_notifications')
+    def release_expired_notifications(self, timeout):
+        # Put back in the queue notifications claimed by workers that
+        # didn't report back after timeout seconds. They count as a
+        # failed attempt, as they might have killed the worker.
+        if self._notifications is None:
+            return 0
+        return self._notifications.release_expired(
+            timeout, self._retry_attempts)
+
+    security.declarePrivate('replay_dead_notifications')
+    def replay_dead_notifications(self, keys=None):
+        if self._notifications is None:
+            return 0
+        return self._notifications.replay(keys)
+
+    security.declarePrivate('purge_dead_notifications')
+    def purge_dead_notifications(self, keys=None):
+        if self._notifications is None:
+            return 0
+        return self._notifications.purge(keys)
 
     def _generate_token(self, content_id, email, action):
         secret = getUtility(ISecretService)
@@ -235,11 +1008,13 @@ class SubscriptionService(Folder.Folder, SilvaService):
             raise KeyError(template_id)
         return aq_base(self[template_id]).__of__(content)
 
-    def _get_default_data(self, content, email=None):
+    def _get_default_data(self, content, email=None, metadata=None):
+        if metadata is None:
+            metadata = IMetadata(content)
         data = {}
         data['from'] = self._from
         data['to'] = email
-        data['metadata'] = IMetadata(content)
+        data['metadata'] = metadata
         data['sitename'] = self._sitename
         data['confirmation_delay'] = self._maximum_delay
         return data
@@ -247,27 +1022,39 @@ class SubscriptionService(Folder.Folder, SilvaService):
     def _send_information(self, content, email, template_id):
         template = self._get_template(content, template_id)
         data = self._get_default_data(content, email)
-        self._send_email(template, data)
+        self.get_metrics().increment('information', 'recipients')
+        self._send_email(template, data, 'information')
 
     def _send_confirmation(
         self, content, subscribed_content, email, template_id, action):
-        template = self._get_template(content, template_id)
-        data = self._get_default_data(content, email)
-        subscribed_content_url = subscribed_content.absolute_url()
-        subscribed_content_id = get_content_id(subscribed_content)
-        token = self._generate_token(subscribed_content_id, email, action)
-        data['confirmation_url'] = '%s/subscriptions.html/@@%s?%s' % (
-            subscribed_content_url, action, urllib.urlencode((
-                    ('content', subscribed_content_id),
-                    ('email', urllib.quote(email)),
-                    ('token', token)),))
-        data['subscribed_content'] = subscribed_content
-        data['service_url'] = subscribed_content_url + '/subscriptions.html'
-        self._send_email(template, data)
-
-    def _send_email(self, template, data):
-        message = template(**data)
-        sendmail(self, message)
+        metrics = self.get_metrics()
+        with metrics.timer('confirmation', 'resolve'):
+            template = self._get_template(content, template_id)
+            data = self._get_default_data(content, email)
+            subscribed_content_url = subscribed_content.absolute_url()
+            subscribed_content_id = get_content_id(subscribed_content)
+            token = self._generate_token(
+                subscribed_content_id, email, action)
+            data['confirmation_url'] = '%s/subscriptions.html/@@%s?%s' % (
+                subscribed_content_url, action, urllib.urlencode((
+                        ('content', subscribed_content_id),
+                        ('email', urllib.quote(email)),
+                        ('token', token)),))
+            data['subscribed_content'] = subscribed_content
+            data['service_url'] = (
+                subscribed_content_url + '/subscriptions.html')
+        metrics.increment('confirmation', 'recipients')
+        self._send_email(template, data, 'confirmation')
+
+    def _send_email(self, template, data, operation):
+        # Render the message lazily, so its rendering is measured.
+        self._deliver((template(**data) for ignored in [None]), operation)
+
+    def _send_message(self, message):
+        # Messages are sent after the commit, the mailhost must not
+        # queue them in the transaction.
+        mailhost = getattr(self.get_root(), MAILHOST_ID)
+        mailhost.send(message, immediate=True)
 
 
 InitializeClass(SubscriptionService)
@@ -287,6 +1074,66 @@ class ISubscriptionSettings(interface.Interface):
         description=_(u"When a confirmation email is sent, "
                       u"it must be validated within that number of days"),
         required=True)
+    _asynchronous = schema.Bool(
+        title=_(u"Send notifications in the background"),
+        description=_(u"Queue notifications when content is published. "
+                      u"They are sent later by the notification worker"),
+        required=False)
+    _batch_size = schema.Int(
+        title=_(u"Notification batch size"),
+        description=_(u"Number of queued notifications sent by the "
+                      u"worker in one transaction"),
+        min=1,
+        required=True)
+    _bulk_delivery = schema.Bool(
+        title=_(u"Bulk delivery"),
+        description=_(u"Send notifications directly to the SMTP server "
+                      u"configured in the mailhost, using one connection "
+                      u"for all of them"),
+        required=False)
+    _bulk_batch_size = schema.Int(
+        title=_(u"Bulk delivery batch size"),
+        description=_(u"Number of messages sent in one batch. Delivery "
+                      u"errors are reported per batch"),
+        min=1,
+        required=True)
+    _digest_mode = schema.Choice(
+        title=_(u"Default delivery mode"),
+        description=_(u"Send notifications immediately, or collect them "
+                      u"in a periodic digest. People can choose a "
+                      u"different mode for themselves"),
+        vocabulary=delivery_modes,
+        required=True)
+    _rate_limit = schema.Int(
+        title=_(u"Maximum messages per second"),
+        description=_(u"Messages sent by the workers over that limit "
+                      u"wait before being sent. Set to 0 to disable the "
+                      u"limit"),
+        min=0,
+        required=True)
+    _rate_burst = schema.Int(
+        title=_(u"Maximum burst of messages"),
+        description=_(u"Number of messages that can be sent at once "
+                      u"before the limit applies. Default to the limit"),
+        min=0,
+        required=True)
+    _domain_rate_limit = schema.Int(
+        title=_(u"Maximum messages per second per recipient domain"),
+        description=_(u"Set to 0 to disable the limit per domain"),
+        min=0,
+        required=True)
+    _retry_delay = schema.Int(
+        title=_(u"Delay before sending again a failed message"),
+        description=_(u"In seconds. The delay doubles after each "
+                      u"failed attempt, up to six hours"),
+        min=1,
+        required=True)
+    _retry_attempts = schema.Int(
+        title=_(u"Maximum attempts to send a message"),
+        description=_(u"After that number of failed attempts, the "
+                      u"message is kept as a dead letter"),
+        min=1,
+        required=True)
 
 
 class SubscriptionConfiguration(silvaforms.ComposedConfigurationForm):
@@ -364,6 +1211,353 @@ class SubscriptionServiceManagementView(silvaforms.ZMIComposedForm):
     label = _(u"Service Subscriptions Configuration")
 
 
+class IRateLimiterStatus(interface.Interface):
+    fill = schema.Int(
+        title=_(u"Available sending capacity (%)"))
+    waiting = schema.Int(
+        title=_(u"Messages currently waiting"))
+    messages = schema.Int(
+        title=_(u"Messages sent"))
+    delayed = schema.Int(
+        title=_(u"Messages delayed"))
+    postponed = schema.Int(
+        title=_(u"Messages left in the outbox"))
+    average_wait = schema.Float(
+        title=_(u"Average wait of a delayed message (seconds)"))
+    maximum_wait = schema.Float(
+        title=_(u"Maximum wait of a message (seconds)"))
+
+
+class SubscriptionServiceRateLimiterStatus(silvaforms.ZMISubForm):
+    grok.context(SubscriptionService)
+    silvaforms.view(SubscriptionServiceManagementView)
+    silvaforms.order(30)
+
+    label = _(u"Outgoing messages rate limit")
+    description = _(u"Status of the rate limiter since the server started")
+    fields = silvaforms.Fields(IRateLimiterStatus)
+    mode = DISPLAY
+    ignoreContent = False
+    dataManager = DictDataManager
+
+    def available(self):
+        return self.context.get_rate_limiter() is not None
+
+    def update(self):
+        limiter = self.context.get_rate_limiter()
+        if limiter is not None:
+            self.setContentData(limiter.statistics())
+
+
+class ISubscriptionIndexLookup(interface.Interface):
+    email = schema.TextLine(
+        title=_(u"Email address"),
+        required=True)
+
+
+class SubscriptionServiceIndexForm(silvaforms.ZMISubForm):
+    grok.context(SubscriptionService)
+    silvaforms.view(SubscriptionServiceManagementView)
+    silvaforms.order(35)
+
+    label = _(u"Subscribed email addresses")
+    fields = silvaforms.Fields(ISubscriptionIndexLookup)
+
+    @property
+    def description(self):
+        index = self.context._index
+        return _(u"${count} email addresses are subscribed to content. "
+                 u"Look up to which content an email address is "
+                 u"subscribed, or rebuild the index of subscribed "
+                 u"email addresses.",
+                 mapping={'count': index is not None and len(index) or 0})
+
+    @silvaforms.action(_(u'Look up'))
+    def action_lookup(self):
+        data, error = self.extractData()
+        if error:
+            return silvaforms.FAILURE
+        paths = ['/'.join(content.getPhysicalPath()) for content in
+                 self.context.get_subscribed_content(data['email'])]
+        if paths:
+            self.status = _(u"Subscribed to: ${paths}.",
+                            mapping={'paths': u', '.join(paths)})
+        elif self.context.is_suppressed(data['email']):
+            self.status = _(u"Not subscribed to any content, and "
+                            u"suppressed after a bounce or a complaint.")
+        else:
+            self.status = _(u"Not subscribed to any content.")
+        return silvaforms.SUCCESS
+
+    @silvaforms.action(_(u'Rebuild index'))
+    def action_rebuild(self):
+        count = self.context.rebuild_index()
+        self.status = _(u"Index rebuilt with ${count} email addresses.",
+                        mapping={'count': count})
+        return silvaforms.SUCCESS
+
+
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+@grok.provider(IContextSourceBinder)
+def dead_letters_source(context):
+    terms = []
+    outbox = context.get_outbox()
+    if outbox is not None:
+        for key, entry in outbox.get_dead_letters():
+            title = u'%s: %s (%d attempts, %s)' % (
+                u', '.join(map(to_unicode, entry.recipients)),
+                to_unicode(entry.subject or u''), entry.attempts,
+                to_unicode(entry.error))
+            terms.append(SimpleTerm(value=key, token=str(key), title=title))
+    return SimpleVocabulary(terms)
+
+
+class IDeadLetters(interface.Interface):
+    dead_letters = schema.Set(
+        title=_(u"Dead letters"),
+        description=_(u"Messages that failed to be sent too many times. "
+                      u"Replay or purge the selected ones, or all of "
+                      u"them if none are selected"),
+        value_type=schema.Choice(source=dead_letters_source),
+        required=False)
+
+
+class SubscriptionServiceOutboxForm(silvaforms.ZMISubForm):
+    grok.context(SubscriptionService)
+    silvaforms.view(SubscriptionServiceManagementView)
+    silvaforms.order(33)
+
+    label = _(u"Outbox")
+    fields = silvaforms.Fields(IDeadLetters)
+    fields['dead_letters'].mode = 'multicheckbox'
+
+    @property
+    def description(self):
+        outbox = self.context.get_outbox()
+        return _(u"${pending} messages are waiting to be sent again, "
+                 u"${dead} dead letters.",
+                 mapping={'pending': len(outbox),
+                          'dead': outbox.count_dead_letters()})
+
+    def available(self):
+        return self.context.get_outbox() is not None
+
+    def get_selection(self):
+        data, errors = self.extractData()
+        if errors:
+            return None
+        return list(data.getWithDefault('dead_letters') or []) or None
+
+    @silvaforms.action(_(u'Send now'))
+    def action_send(self):
+        count = self.context.process_outbox()
+        self.status = _(u"${count} messages will be sent again.",
+                        mapping={'count': count})
+        return silvaforms.SUCCESS
+
+    @silvaforms.action(_(u'Replay'))
+    def action_replay(self):
+        count = self.context.replay_dead_letters(self.get_selection())
+        self.status = _(u"${count} dead letters will be sent again.",
+                        mapping={'count': count})
+        return silvaforms.SUCCESS
+
+    @silvaforms.action(_(u'Purge'))
+    def action_purge(self):
+        count = self.context.purge_dead_letters(self.get_selection())
+        self.status = _(u"${count} dead letters removed.",
+                        mapping={'count': count})
+        return silvaforms.SUCCESS
+
+
+class SubscriptionServiceDeadLettersText(grok.View):
+    """Full text of the dead letters, to inspect them.
+    """
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('deadletters.txt')
+    grok.context(SubscriptionService)
+
+    def render(self):
+        self.response.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        outbox = self.context.get_outbox()
+        if outbox is None:
+            return u''
+        return u'\n'.join(
+            u'Dead letter %d after %d attempts: %s\n\n%s\n' % (
+                key, entry.attempts, to_unicode(entry.error),
+                to_unicode(entry.message))
+            for key, entry in outbox.get_dead_letters())
+
+
+def get_metrics_fields():
+    fields = []
+    for operation in OPERATIONS:
+        for name in COUNTERS:
+            fields.append(schema.Int(
+                    __name__='%s_%s' % (operation, name),
+                    title=u'%s: %s' % (operation.capitalize(), name)))
+        for stage in STAGES:
+            prefix = '%s_%s' % (operation, stage)
+            title = u'%s: %s' % (operation.capitalize(), stage)
+            fields.extend([
+                    schema.Int(
+                        __name__=prefix + '_count',
+                        title=title + u' (count)'),
+                    schema.Float(
+                        __name__=prefix + '_average',
+                        title=title + u' (average seconds)'),
+                    schema.Float(
+                        __name__=prefix + '_maximum',
+                        title=title + u' (maximum seconds)')])
+    for stage in LATENCY_STAGES:
+        for percent in PERCENTILES:
+            fields.append(schema.Float(
+                    __name__='latency_%s_%d' % (stage, percent),
+                    title=u'Publication to %s latency (%dth percentile '
+                    u'seconds)' % (stage, percent),
+                    required=False))
+    return silvaforms.Fields(*fields)
+
+
+def get_metrics_data(service):
+    data = service.get_metrics().statistics()
+    for stage, entry in service.get_latency_report().items():
+        for percent in PERCENTILES:
+            data['latency_%s_%d' % (stage, percent)] = entry[percent]
+    return data
+
+
+class SubscriptionServiceMetricsView(silvaforms.ZMIForm):
+    """Display the counters and timings of the service.
+    """
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('manage_metrics')
+    grok.context(SubscriptionService)
+
+    label = _(u"Service Subscriptions Metrics")
+    description = _(u"Counters and timings of each stage of sending "
+                    u"messages, since the server started. They are "
+                    u"available as text for monitoring tools at "
+                    u"metrics.txt. Latencies per content are available "
+                    u"at latency.txt.")
+    fields = get_metrics_fields()
+    mode = DISPLAY
+    ignoreContent = False
+    dataManager = DictDataManager
+
+    def update(self):
+        self.setContentData(get_metrics_data(self.context))
+
+    @silvaforms.action(_(u'Reset'))
+    def action_reset(self):
+        self.context.get_metrics().reset()
+        self.context.get_latency_recorder().reset()
+        self.setContentData(get_metrics_data(self.context))
+        self.status = _(u"Metrics reset.")
+        return silvaforms.SUCCESS
+
+
+class SubscriptionServiceMetricsText(grok.View):
+    """Metrics of the service in the Prometheus text format.
+    """
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('metrics.txt')
+    grok.context(SubscriptionService)
+
+    def render(self):
+        self.response.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        return ''.join((
+                self.context.get_metrics().render(),
+                self.context.get_latency_recorder().render()))
+
+
+class SubscriptionServiceLatencyText(grok.View):
+    """Latency percentiles of the notifications of each recently
+    published content.
+    """
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('latency.txt')
+    grok.context(SubscriptionService)
+
+    def render(self):
+        self.response.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        recorder = self.context.get_latency_recorder()
+        lines = ['\t'.join(('content', 'stage', 'count') + tuple(
+                    'p%d' % percent for percent in PERCENTILES))]
+        for content_id in recorder.get_content_ids():
+            content = get_content_from_id(content_id)
+            if content is None:
+                continue
+            path = '/'.join(content.getPhysicalPath())
+            for stage, entry in recorder.report(content_id).items():
+                lines.append('\t'.join(
+                        [path, stage, str(entry['count'])] +
+                        ['%.3f' % entry[percent]
+                         if entry[percent] is not None else '-'
+                         for percent in PERCENTILES]))
+        return '\n'.join(lines) + '\n'
+
+
+class ISubscriptionImport(interface.Interface):
+    csv = silvaschema.Bytes(
+        title=_(u"CSV file"),
+        description=_(u"File with one content path and one email "
+                      u"address per line"),
+        required=True)
+
+
+class SubscriptionServiceImportForm(silvaforms.ZMISubForm):
+    grok.context(SubscriptionService)
+    silvaforms.view(SubscriptionServiceManagementView)
+    silvaforms.order(37)
+
+    label = _(u"Import subscriptions")
+    description = _(u"Subscribe email addresses to content in bulk. "
+                    u"Existing subscriptions can be exported as CSV "
+                    u"from subscriptions.csv.")
+    fields = silvaforms.Fields(ISubscriptionImport)
+
+    @silvaforms.action(_(u'Import'))
+    def action_import(self):
+        data, error = self.extractData()
+        if error:
+            return silvaforms.FAILURE
+        # The request is committed at once by the publisher, batch
+        # commits are left to scripts.
+        report = self.context.import_subscriptions(data['csv'], commit=False)
+        errors = u'; '.join(
+            u'line %d: %s' % error for error in report.errors[:10])
+        self.status = _(u"${imported} subscriptions imported, ${existing} "
+                        u"already existing, ${errors} invalid rows. "
+                        u"${details}",
+                        mapping={'imported': report.imported,
+                                 'existing': report.existing,
+                                 'errors': len(report.errors),
+                                 'details': errors})
+        return silvaforms.SUCCESS
+
+
+class SubscriptionServiceExport(grok.View):
+    """Export all subscriptions as CSV.
+    """
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('subscriptions.csv')
+    grok.context(SubscriptionService)
+
+    def render(self):
+        self.response.setHeader('Content-Type', 'text/csv; charset=utf-8')
+        self.response.setHeader(
+            'Content-Disposition', 'attachment; filename=subscriptions.csv')
+        # Stream the rows to the client while they are produced.
+        self.context.export_subscriptions(self.response)
+        return ''
+
+
 class SubscriptionServiceInstallMaildropHostForm(silvaforms.ZMISubForm):
     grok.context(SubscriptionService)
     silvaforms.view(SubscriptionServiceManagementView)
@@ -408,8 +1602,42 @@ def service_created(service, event):
         'already_subscribed_template.pt',
         'cancellation_confirmation_template.pt',
         'not_subscribed_template.pt',
-        'publication_event_template.pt']:
+        'publication_event_template.pt',
+        'digest_template.pt',
+        'summary_template.pt']:
         add_helper(service, identifier, globals(), pt_add_helper, True)
+    # The default notification template inserts the recipient values
+    # as they are.
+    set_rendered_once(service.publication_event_template)
+
+
+@grok.subscribe(ISilvaObject, IObjectWillBeRemovedEvent)
+def content_removed(content, event):
+    """Remove subscriptions to a deleted content from the index.
+    """
+    data = query_subscribable_data(content)
+    if data is None or not data.subscriptions:
+        return
+    service = queryUtility(ISubscriptionService)
+    if service is not None:
+        for email in data.subscriptions:
+            service.unindex_subscription(content, email)
+
+
+@grok.subscribe(ISilvaObject, IObjectAddedEvent)
+def content_added(content, event):
+    """Add subscriptions to a copied or imported content and its
+    sub-contents in the index.
+    """
+    if event.object is not content:
+        # The event is dispatched to the sub-contents as well.
+        return
+    service = queryUtility(ISubscriptionService)
+    if service is None:
+        return
+    for item, data in walk_subscribable_data(content):
+        for email in data.subscriptions:
+            service.index_subscription(item, email)
 
 
 @grok.subscribe(IVersion, IContentPublishedEvent)
@@ -417,11 +1645,17 @@ def version_published(version, event):
     """Content have been published. Send notifications.
     """
     service = queryUtility(ISubscriptionService)
-    if service is not None:
-        content = version.get_silva_object()
-        if IPublishable.providedBy(content):
-            # first send notification for content
-            service.send_notification(content)
-            # now send email for potential haunting ghosts
-            for haunting in IHaunted(content).getHaunting():
-                service.send_notification(haunting)
+    if service is None or not service.are_subscriptions_enabled():
+        return
+    content = version.get_silva_object()
+    if IPublishable.providedBy(content):
+        # Notify for the content and the potential haunting
+        # ghosts, at once in order to send only one message per
+        # subscriber.
+        contents = [content]
+        contents.extend(IHaunted(content).getHaunting())
+        # Notifications are sent when the transaction is
+        # committed, together with the ones for all the other
+        # contents published in the same transaction.
+        get_publication_batch(service).add(
+            contents, Trace(get_content_id(content)))
@@ -13,7 +13,10 @@ from silva.core.smi.settings import SettingsMenu, Settings
 from silva.ui.menu import MenuItem
 from silva.translations import translate as _
 
+from z3c.schema.email import RFC822MailAddress
 from zeam.form import silva as silvaforms
+from zeam.form.base import DISPLAY
+from zeam.form.base.datamanager import DictDataManager
 from zope import schema
 from zope.component import queryUtility
 from zope.interface import Interface
@@ -45,15 +48,34 @@ class ISubscribableSettings(Interface):
             u"(the default)."),
         source=subscribability_options,
         required=True)
-    locally_subscribed_emails = schema.Set(
-        title=_(u"subscribed email addresses"),
-        description=_(u"List of email addresses currently subscribed "
-                      u"to this content at this level, one per line. "),
-        value_type=schema.TextLine(required=True),
+
+
+class ISubscribedEmails(Interface):
+    emails = schema.Set(
+        title=_(u"email addresses"),
+        description=_(u"Email addresses to subscribe to or unsubscribe "
+                      u"from this content at this level, one per line."),
+        value_type=RFC822MailAddress(required=True),
+        required=True)
+
+
+class ISubscriptionSearch(Interface):
+    prefix = schema.TextLine(
+        title=_(u"email address starting with"),
+        required=False)
+    page = schema.Int(
+        title=_(u"page"),
+        min=1,
+        default=1,
         required=False)
 
 
-class SubscriptionForm(silvaforms.SMIForm):
+class ISubscribedEmail(Interface):
+    email = schema.TextLine(
+        title=_(u"email address"))
+
+
+class SubscriptionForm(silvaforms.SMIComposedForm):
     """Edit subscriptions.
     """
     grok.adapts(Settings, ISilvaObject)
@@ -61,10 +83,18 @@ class SubscriptionForm(silvaforms.SMIForm):
     grok.require('silva.ManageSilvaContent')
 
     label = _(u"Manage subscriptions")
+
+
+class SubscriptionSettingsForm(silvaforms.SMISubForm):
+    """Edit the subscribability.
+    """
+    grok.context(ISilvaObject)
+    silvaforms.view(SubscriptionForm)
+    silvaforms.order(10)
+
+    label = _(u"Subscribability")
     fields = silvaforms.Fields(ISubscribableSettings)
     fields['subscribability'].mode = 'radio'
-    fields['locally_subscribed_emails'].mode = 'lines'
-    fields['locally_subscribed_emails'].defaultValue = lambda f: set()
     ignoreContent = False
     dataManager = silvaforms.makeAdaptiveDataManager(ISubscriptionManager)
     actions = silvaforms.Actions(
@@ -72,6 +102,84 @@ class SubscriptionForm(silvaforms.SMIForm):
         silvaforms.EditAction())
 
 
+class SubscriptionEmailsForm(silvaforms.SMISubForm):
+    """Add or remove subscribed emails, without loading the other
+    ones.
+    """
+    grok.context(ISilvaObject)
+    silvaforms.view(SubscriptionForm)
+    silvaforms.order(20)
+
+    label = _(u"Add or remove email addresses")
+    fields = silvaforms.Fields(ISubscribedEmails)
+    fields['emails'].mode = 'lines'
+
+    @silvaforms.action(_(u"Subscribe"))
+    def subscribe(self):
+        data, errors = self.extractData()
+        if errors:
+            return silvaforms.FAILURE
+        manager = ISubscriptionManager(self.context)
+        added = manager.subscribe_many(data['emails']).count(True)
+        self.status = _(u"${count} email address(es) subscribed.",
+                        mapping={'count': added})
+        return silvaforms.SUCCESS
+
+    @silvaforms.action(_(u"Unsubscribe"))
+    def unsubscribe(self):
+        data, errors = self.extractData()
+        if errors:
+            return silvaforms.FAILURE
+        manager = ISubscriptionManager(self.context)
+        removed = manager.unsubscribe_many(data['emails']).count(True)
+        self.status = _(u"${count} email address(es) unsubscribed.",
+                        mapping={'count': removed})
+        return silvaforms.SUCCESS
+
+
+class SubscriptionEmailsList(silvaforms.SMISubTableForm):
+    """List the subscribed emails one page at a time.
+    """
+    grok.context(ISilvaObject)
+    silvaforms.view(SubscriptionForm)
+    silvaforms.order(30)
+
+    label = _(u"Subscribed email addresses")
+    emptyDescription = _(u"No email addresses are subscribed.")
+    fields = silvaforms.Fields(ISubscriptionSearch)
+    ignoreRequest = False
+    tableFields = silvaforms.Fields(ISubscribedEmail)
+    tableFields['email'].mode = DISPLAY
+    tableDataManager = DictDataManager
+    batchSize = 50
+
+    @silvaforms.action(_(u"Search"))
+    def search(self):
+        data, errors = self.extractData()
+        if errors:
+            return silvaforms.FAILURE
+        return silvaforms.SUCCESS
+
+    def getItems(self):
+        data, errors = self.extractData()
+        prefix = page = None
+        if not errors:
+            prefix = data.getWithDefault('prefix')
+            page = data.getWithDefault('page')
+        manager = ISubscriptionManager(self.context)
+        count = manager.count_local_subscriptions()
+        start = ((page or 1) - 1) * self.batchSize
+        emails = manager.search_local_subscriptions(
+            prefix or u'', start, self.batchSize)
+        self.description = _(
+            u"${count} email address(es) subscribed at this level. "
+            u"Showing ${first} to ${last} of the matching ones.",
+            mapping={'count': count,
+                     'first': start + 1 if emails else 0,
+                     'last': start + len(emails)})
+        return [{'email': email} for email in emails]
+
+
 class SubscriptionMenu(MenuItem):
     grok.adapts(SettingsMenu, IPublishable)
     grok.order(110)
@@ -96,8 +204,8 @@ class SubscriptionPortlet(silvaviews.Viewlet):
     def update(self):
         settings = ISubscriptionManager(self.context)
         self.is_enabled = settings.is_subscribable()
-        self.all_subscribers = len(settings.subscriptions)
-        self.locally_subscribers = len(settings.locally_subscribed_emails)
+        self.all_subscribers = settings.count_subscriptions()
+        self.locally_subscribers = settings.count_local_subscriptions()
         self.above_subscribers = self.all_subscribers - self.locally_subscribers
         if self.is_enabled:
             url = absoluteURL(self.context, self.request)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from silva.core.layout.interfaces import IMetadata
+from silva.core.references.reference import get_content_id
+
+# Metadata fields used by the notification templates.
+METADATA_FIELDS = (
+    ('silva-extra', 'subject'),
+    ('silva-extra', 'content_description'))
+
+
+class PublicationSnapshot(object):
+    """Immutable copy of the data of a published content, needed to
+    render its notifications without loading it again.
+    """
+    __slots__ = ('content_id', 'path', 'url', 'title', 'metadata')
+
+    def __init__(self, content_id, path, url, title, metadata=()):
+        values = (content_id, tuple(path), url, title, tuple(metadata))
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(u"Snapshots cannot be modified.")
+
+    def __reduce__(self):
+        return (PublicationSnapshot, tuple(
+                getattr(self, name) for name in self.__slots__))
+
+    def __eq__(self, other):
+        return (isinstance(other, PublicationSnapshot) and
+                self.__reduce__() == other.__reduce__())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_metadata(self):
+        """Return the metadata as a dictionary of set names to
+        dictionary of field values.
+        """
+        metadata = {}
+        for set_name, field, value in self.metadata:
+            metadata.setdefault(set_name, {})[field] = value
+        return metadata
+
+    def __repr__(self):
+        return '<PublicationSnapshot of %s>' % '/'.join(self.path)
+
+
+def take_snapshot(content, fields=METADATA_FIELDS):
+    """Capture the data of content needed by notification templates.
+    """
+    metadata = IMetadata(content)
+    return PublicationSnapshot(
+        get_content_id(content),
+        content.getPhysicalPath(),
+        content.absolute_url(),
+        content.get_title_or_id(),
+        [(set_name, field, metadata[set_name][field])
+         for set_name, field in fields])
@@ -2,17 +2,55 @@
 # Copyright (c) 2002-2013 Infrae. All rights reserved.
 # See also LICENSE.txt
 
+from itertools import islice
+
 from Acquisition import aq_parent
 from persistent import Persistent
 
 from five import grok
 from silva.core import interfaces
 from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
 from silva.app.subscriptions.interfaces import ISubscription
 from silva.app.subscriptions.interfaces import (
     ACQUIRE_SUBSCRIBABILITY, NOT_SUBSCRIBABLE, SUBSCRIBABLE)
+from silva.app.subscriptions.cache import subscribers_cache
+from silva.app.subscriptions.index import normalize_email
+from silva.app.subscriptions.subscribers import SubscriberSet
 
 from zope.annotation.interfaces import IAnnotations
+from zope.component import queryUtility
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
+
+
+def query_subscribable_data(content):
+    """Return the subscription data stored on the content, or None if
+    there is none.
+    """
+    annotations = IAnnotations(content, None)
+    if annotations is None:
+        return None
+    return annotations.get('silva.app.subscriptions')
+
+
+def walk_subscribable_data(container):
+    """Iterate through the container and all its subscribable
+    sub-objects, that have subscription data. The container can be
+    a content as well.
+    """
+    data = query_subscribable_data(container)
+    if data is not None:
+        yield container, data
+    if not interfaces.IContainer.providedBy(container):
+        return
+    for content in container.objectValues():
+        if interfaces.IContainer.providedBy(content):
+            for item in walk_subscribable_data(content):
+                yield item
+        elif interfaces.IContent.providedBy(content):
+            data = query_subscribable_data(content)
+            if data is not None:
+                yield content, data
 
 
 class Subscription(object):
@@ -24,11 +62,136 @@ class Subscription(object):
         self.manager = manager
 
 
+class Subscriptions(object):
+    """Read-only mapping of emails to their Subscription, for a
+    content and its subscribable parents.
+
+    Subscriptions inherited from the parents are looked up in a
+    cache, only the subscriptions local to the content are read each
+    time.
+    """
+
+    def __init__(self, parents):
+        if parents:
+            self._manager = parents[0]
+            self._local = parents[0].data.subscriptions
+            self._parents = parents[1:]
+            self._inherited = subscribers_cache.get(self._parents)
+        else:
+            self._manager = None
+            self._local = ()
+            self._parents = []
+            self._inherited = {}
+
+    def __contains__(self, email):
+        return email in self._local or email in self._inherited
+
+    def __getitem__(self, email):
+        if email in self._local:
+            return Subscription(email, self._manager)
+        return Subscription(email, self._parents[self._inherited[email]])
+
+    def get(self, email, default=None):
+        if email in self:
+            return self[email]
+        return default
+
+    def __iter__(self):
+        for email in self._local:
+            yield email
+        for email in self._inherited:
+            if email not in self._local:
+                yield email
+
+    def __len__(self):
+        if self._manager is None:
+            return 0
+        return subscribers_cache.count([self._manager] + self._parents)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[email] for email in self]
+
+    def items(self):
+        return [(email, self[email]) for email in self]
+
+
+class DefaultSubscribableData(object):
+    """Subscription settings of a content that have never been
+    changed. It is shared and read-only, so reading settings doesn't
+    write anything in the database.
+    """
+    subscriptions = frozenset()
+
+    def __init__(self, subscribability):
+        self.subscribability = subscribability
+        self.cache_key = (None, subscribability, None)
+
+    def migrate(self):
+        return False
+
+
+default_data = dict(
+    (subscribability, DefaultSubscribableData(subscribability))
+    for subscribability in (
+        ACQUIRE_SUBSCRIBABILITY, NOT_SUBSCRIBABLE, SUBSCRIBABLE))
+
+
 class SubscribableData(Persistent):
+    """Subscription settings of a content. Subscribed emails are
+    stored in a SubscriberSet, so that adding or removing one only
+    write a small part of them, without conflicting with concurrent
+    subscriptions. It is created only when a first email is
+    subscribed.
+    """
+    subscriptions = frozenset()
 
     def __init__(self, default_subscribability):
         self.subscribability = default_subscribability
-        self.subscriptions = set([])
+
+    def migrate(self):
+        """Convert subscriptions stored by previous versions.
+        """
+        self._p_activate()
+        subscriptions = self.__dict__.get('subscriptions')
+        if subscriptions is None or isinstance(subscriptions, SubscriberSet):
+            return False
+        if subscriptions:
+            self.subscriptions = SubscriberSet(subscriptions)
+        else:
+            del self.subscriptions
+        return True
+
+    def get_writable_subscriptions(self):
+        """Return the subscriptions, to modify them.
+        """
+        self.migrate()
+        if not isinstance(self.subscriptions, SubscriberSet):
+            self.subscriptions = SubscriberSet()
+        return self.subscriptions
+
+    def get_denormalized_emails(self):
+        """Return the subscribed emails that are not stored in their
+        canonical form.
+        """
+        return [email for email in self.subscriptions
+                if type(normalize_email(email)) is not type(email) or
+                normalize_email(email) != email]
+
+    def normalize(self):
+        """Store all subscribed emails in their canonical form.
+        """
+        self.migrate()
+        emails = self.get_denormalized_emails()
+        if emails:
+            subscriptions = self.get_writable_subscriptions()
+            for email in emails:
+                subscriptions.remove(email)
+            for email in emails:
+                subscriptions.insert(normalize_email(email))
+        return bool(emails)
 
 
 class Subscribable(grok.Adapter):
@@ -46,13 +209,22 @@ class Subscribable(grok.Adapter):
 
     def __init__(self, context):
         super(Subscribable, self).__init__(context)
-        annotations = IAnnotations(self.context)
-        data = annotations.get('silva.app.subscriptions')
+        data = query_subscribable_data(self.context)
         if data is None:
-            data = SubscribableData(self.default_subscribability)
-            annotations['silva.app.subscriptions'] = data
+            data = default_data[self.default_subscribability]
         self.data =  data
 
+    def _get_writable_data(self):
+        # Settings are stored on the content only when they are
+        # modified for the first time.
+        if isinstance(self.data, DefaultSubscribableData):
+            data = SubscribableData(self.default_subscribability)
+            IAnnotations(self.context)['silva.app.subscriptions'] = data
+            self.data = data
+        else:
+            self.data.migrate()
+        return self.data
+
     # ACCESSORS
 
     def is_subscribable(self):
@@ -69,7 +241,9 @@ class Subscribable(grok.Adapter):
             return self.data.subscribability
         def setter(self, flag):
             assert flag in self.subscribability_possibilities
-            self.data.subscribability = flag
+            if flag != self.data.subscribability:
+                self._get_writable_data().subscribability = flag
+                subscribers_cache.invalidate(self.data)
         return property(getter, setter)
 
     @apply
@@ -77,19 +251,26 @@ class Subscribable(grok.Adapter):
         def getter(self):
             return set(self.data.subscriptions)
         def setter(self, emails):
-            self.data.subscriptions = set(emails)
+            emails = set(map(normalize_email, emails))
+            previous = set(self.data.subscriptions)
+            added = emails - previous
+            removed = previous - emails
+            if not (added or removed):
+                return
+            subscriptions = self._get_writable_data(
+                ).get_writable_subscriptions()
+            for email in removed:
+                subscriptions.remove(email)
+            for email in added:
+                subscriptions.insert(email)
+            self._update_index(added, removed)
         return property(getter, setter)
 
     # ACCESSORS
 
     @property
     def subscriptions(self):
-        subscriptions = {}
-        for parent in self._get_subscribable_parents():
-            for email in parent.locally_subscribed_emails:
-                if email not in subscriptions:
-                    subscriptions[email] = Subscription(email, parent)
-        return subscriptions
+        return Subscriptions(self._get_subscribable_parents())
 
     def _get_subscribable_parents(self, subscribables=None, last_explicit=0):
         # The purpose of last_explicit is to prevent to collect
@@ -112,26 +293,85 @@ class Subscribable(grok.Adapter):
     def get_subscriptions(self):
         return self.subscriptions.values()
 
+    def count_subscriptions(self):
+        return subscribers_cache.count(self._get_subscribable_parents())
+
+    def count_local_subscriptions(self):
+        return len(self.data.subscriptions)
+
+    def search_local_subscriptions(self, prefix=u'', start=0, size=None):
+        subscriptions = self.data.subscriptions
+        if isinstance(subscriptions, SubscriberSet):
+            # Only read the emails in the range matching the prefix.
+            if prefix:
+                emails = subscriptions.keys(prefix, prefix + u'\uffff')
+            else:
+                emails = subscriptions.keys()
+        else:
+            emails = sorted(email for email in subscriptions
+                            if email.startswith(prefix))
+        if size is not None:
+            return list(islice(emails, start, start + size))
+        return list(islice(emails, start, None))
+
     def get_subscription(self, email):
         try:
-            return self.subscriptions[email]
+            return self.subscriptions[normalize_email(email)]
         except KeyError:
             return None
 
     def is_subscribed(self, email):
-        return email in self.subscriptions
+        return normalize_email(email) in self.subscriptions
 
     # MODIFIERS
 
     def subscribe(self, email):
-        self.data.subscriptions.add(email)
-        self.data._p_changed = True
+        email = normalize_email(email)
+        subscriptions = self._get_writable_data().get_writable_subscriptions()
+        if subscriptions.insert(email):
+            self._update_index(added=[email])
 
     def unsubscribe(self, emailaddress):
+        emailaddress = normalize_email(emailaddress)
         if emailaddress in self.data.subscriptions:
-            self.data.subscriptions.remove(emailaddress)
-            self.data._p_changed = True
-
+            self._get_writable_data().subscriptions.remove(emailaddress)
+            self._update_index(removed=[emailaddress])
+
+    def subscribe_many(self, emails):
+        emails = map(normalize_email, emails)
+        subscriptions = self.data.subscriptions
+        if all(email in subscriptions for email in emails):
+            return [False] * len(emails)
+        subscriptions = self._get_writable_data().get_writable_subscriptions()
+        results = map(subscriptions.insert, emails)
+        self._update_index(
+            added=[email for email, result in zip(emails, results) if result])
+        return results
+
+    def unsubscribe_many(self, emails):
+        results = []
+        removed = []
+        for email in map(normalize_email, emails):
+            if email in self.data.subscriptions:
+                if not removed:
+                    self._get_writable_data()
+                self.data.subscriptions.remove(email)
+                removed.append(email)
+                results.append(True)
+            else:
+                results.append(False)
+        if removed:
+            self._update_index(removed=removed)
+        return results
+
+    def _update_index(self, added=(), removed=()):
+        subscribers_cache.invalidate(self.data)
+        service = queryUtility(ISubscriptionService)
+        if service is not None:
+            for email in added:
+                service.index_subscription(self.context, email)
+            for email in removed:
+                service.unindex_subscription(self.context, email)
 
 
 class SubscribableContainer(Subscribable):
@@ -156,3 +396,12 @@ class SubscribableRoot(Subscribable):
             return subscribables
         subscribables.append(self)
         return subscribables
+
+
+@grok.subscribe(interfaces.IContainer, IObjectMovedEvent)
+def container_moved(container, event):
+    """Drop cached subscribers related to a moved container.
+    """
+    data = query_subscribable_data(container)
+    if data is not None:
+        subscribers_cache.invalidate(data)
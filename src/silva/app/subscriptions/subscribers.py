@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import heapq
+import zlib
+
+from BTrees.IOBTree import IOBucket
+from BTrees.Length import Length
+from BTrees.OOBTree import OOSet
+from persistent import Persistent
+
+# Kept in every slot: conflict resolution refuses to merge changes
+# that empty a set, like removing its last email.
+PLACEHOLDER = ''
+
+
+def get_slot_key(email, slots):
+    """Return the slot in which an email is stored.
+    """
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return zlib.crc32(email) % slots
+
+
+def merge_slots(slots, min=None, max=None):
+    """Iterate in order over the emails stored in the given slots,
+    between min and max included.
+    """
+    emails = heapq.merge(*[slot.keys(min, max) for slot in slots])
+    return (email for email in emails if email != PLACEHOLDER)
+
+
+class SubscriberSet(Persistent):
+    """Set of subscribed emails, safe to modify concurrently.
+
+    Emails are spread by hash over a fixed number of slots. Each slot
+    is a standalone OOSet: as it is never split, ZODB conflict
+    resolution merges concurrent additions and removals of different
+    emails. Adding or removing an email only write its slot and the
+    length counter, that resolve its conflicts as well. A slot is
+    created when a first email is stored in it, and is then never
+    emptied nor removed, so a small set uses only a few slots. Slots
+    are kept in a bucket, that is never split either: only
+    transactions creating the same slot at the same time conflict.
+    """
+    slots = 256
+
+    def __init__(self, emails=()):
+        self._slots = IOBucket()
+        self._length = Length(0)
+        for email in emails:
+            self.insert(email)
+
+    def _get_slot(self, email, create=False):
+        key = get_slot_key(email, self.slots)
+        slot = self._slots.get(key)
+        if slot is None and create:
+            slot = self._slots[key] = OOSet([PLACEHOLDER])
+        return slot
+
+    def insert(self, email):
+        """Add an email. Return True if it was not already present.
+        """
+        if self._get_slot(email, True).insert(email):
+            self._length.change(1)
+            return True
+        return False
+
+    def remove(self, email):
+        """Remove an email. Raise KeyError if it is not present.
+        """
+        slot = self._get_slot(email)
+        if slot is None or email == PLACEHOLDER:
+            raise KeyError(email)
+        slot.remove(email)
+        self._length.change(-1)
+
+    def __contains__(self, email):
+        if email == PLACEHOLDER:
+            return False
+        slot = self._get_slot(email)
+        return slot is not None and email in slot
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._length()
+
+    def __nonzero__(self):
+        return bool(self._length())
+
+    def keys(self, min=None, max=None):
+        """Iterate in order over the emails between min and max
+        included.
+        """
+        return merge_slots(self._slots.values(), min, max)
+
+    def __iter__(self):
+        return self.keys()
@@ -2,6 +2,11 @@
 # Copyright (c) 2010-2013 Infrae. All rights reserved.
 # See also LICENSE.txt
 
+import asyncore
+import smtpd
+import smtplib
+import threading
+
 from Products.Silva.testing import SilvaLayer
 import silva.app.subscriptions
 
@@ -12,3 +17,86 @@ class SilvaSubscriptionLayer(SilvaLayer):
         ]
 
 FunctionalLayer = SilvaSubscriptionLayer(silva.app.subscriptions)
+
+
+class FakeSMTP(object):
+    """Local stand in for smtplib.SMTP, recording sent messages.
+    """
+    connections = []
+    refused = set()
+    does_esmtp = True
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.messages = []
+        self.closed = False
+        self.connections.append(self)
+
+    @classmethod
+    def reset(cls):
+        cls.connections = []
+        cls.refused = set()
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def login(self, user, password):
+        self.user = user
+
+    def sendmail(self, mfrom, mto, message):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected()
+        refused = dict((address, (550, 'Unknown user'))
+                       for address in mto if address in self.refused)
+        if len(refused) == len(mto):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.messages.append((mfrom, mto, message))
+        return refused
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBusySMTP(FakeSMTP):
+    """SMTP stand in that temporarily refuses some recipients.
+    """
+    busy = set(['busy@example.com'])
+
+    def sendmail(self, mfrom, mto, message):
+        busy = dict((address, (451, 'Try again later'))
+                    for address in mto if address in self.busy)
+        if busy:
+            raise smtplib.SMTPRecipientsRefused(busy)
+        return super(FakeBusySMTP, self).sendmail(mfrom, mto, message)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """SMTP server listening on a free local port in a thread,
+    recording received messages.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.host, self.port = self.socket.getsockname()
+        self.messages = []
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.close()
+        self._thread.join(5)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from email import message_from_string
+import mailbox
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.bounces import get_bounces, BOUNCE, COMPLAINT
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.core.interfaces import IPublicationWorkflow
+
+
+DSN = """From: MAILER-DAEMON@example.com
+To: subscription-service@example.com
+Subject: Undelivered Mail Returned to Sender
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status;
+  boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+The mail could not be delivered.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mail.example.com
+
+Final-Recipient: rfc822; wim@Example.com
+Action: failed
+Status: 5.1.1
+
+Final-Recipient: rfc822; torvald@example.com
+Action: delayed
+Status: 4.4.1
+
+--BOUNDARY--
+"""
+
+COMPLAINT_REPORT = """From: abuse@example.com
+To: subscription-service@example.com
+Subject: Complaint
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=feedback-report;
+  boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+This is an abuse report.
+
+--BOUNDARY
+Content-Type: message/feedback-report
+
+Feedback-Type: abuse
+Version: 1
+
+--BOUNDARY
+Content-Type: message/rfc822
+
+From: subscription-service@example.com
+To: arthur@example.com
+Subject: Change notification
+
+Hello
+
+--BOUNDARY--
+"""
+
+MESSAGE = """From: wim@example.com
+To: subscription-service@example.com
+Subject: Hello
+
+Please subscribe me.
+"""
+
+
+class BouncesTestCase(unittest.TestCase):
+    """Test parsing bounces.
+    """
+
+    def test_delivery_status(self):
+        self.assertEqual(
+            get_bounces(message_from_string(DSN)),
+            [('wim@Example.com', BOUNCE)])
+
+    def test_complaint(self):
+        self.assertEqual(
+            get_bounces(message_from_string(COMPLAINT_REPORT)),
+            [('arthur@example.com', COMPLAINT)])
+
+    def test_message(self):
+        self.assertEqual(get_bounces(message_from_string(MESSAGE)), [])
+
+
+class ProcessBouncesTestCase(unittest.TestCase):
+    """Test suppressing addresses reported in a mailbox.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addFolder('folder', u'Test Folder')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bounces')
+        messages = mailbox.Maildir(self.path, factory=None, create=True)
+        for message in (DSN, COMPLAINT_REPORT, MESSAGE):
+            messages.add(message)
+        messages.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_process_bounces(self):
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        ISubscriptionManager(self.root).subscribability = SUBSCRIBABLE
+        service.subscribe_many([
+                (self.root, 'torvald@example.com'),
+                (self.root.document, 'wim@example.com'),
+                (self.root.folder, 'wim@example.com'),
+                (self.root.folder, 'arthur@example.com')])
+
+        self.assertEqual(service.process_bounces(self.path), (3, 2, 3))
+        self.assertEqual(
+            ISubscriptionManager(self.root.document).locally_subscribed_emails,
+            set())
+        self.assertEqual(
+            ISubscriptionManager(self.root.folder).locally_subscribed_emails,
+            set())
+        self.assertEqual(
+            sorted((email, reason) for email, reason, when
+                   in service.get_suppressed_addresses()),
+            [('arthur@example.com', COMPLAINT),
+             ('wim@example.com', BOUNCE)])
+        self.assertTrue(service.is_suppressed('wim@EXAMPLE.com'))
+        self.assertFalse(service.is_suppressed('torvald@example.com'))
+        # Messages are kept in the mailbox.
+        self.assertEqual(
+            len(mailbox.Maildir(self.path, factory=None, create=False)), 3)
+
+        # Suppressed addresses are not notified, even if subscribed
+        # again without confirmation.
+        ISubscriptionManager(self.root.document).subscribe('wim@example.com')
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(
+            [message.mto for message in self.root.service_mailhost.messages],
+            [['torvald@example.com']])
+
+        service.unsuppress_address('wim@example.com')
+        self.assertFalse(service.is_suppressed('wim@example.com'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BouncesTestCase))
+    suite.addTest(unittest.makeSuite(ProcessBouncesTestCase))
+    return suite
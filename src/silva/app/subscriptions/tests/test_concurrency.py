@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import transaction
+from persistent import Persistent
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from zope.annotation.interfaces import IAnnotations, IAttributeAnnotatable
+from zope.component import getGlobalSiteManager
+from zope.interface import implements
+
+from silva.app.subscriptions.index import SubscriptionIndex
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.subscribable import SubscribableData
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.core.interfaces import IContent
+
+
+class ConcurrentSubscriptionsTestCase(unittest.TestCase):
+    """Concurrent modifications of the subscribed emails of the same
+    content don't conflict.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.directory, 'Data.fs')))
+        connection = self.db.open()
+        data = connection.root()['data'] = SubscribableData(SUBSCRIBABLE)
+        data.subscriptions.insert('initial1@example.com')
+        data.subscriptions.insert('initial2@example.com')
+        transaction.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        manager = transaction.TransactionManager()
+        connection = self.db.open(transaction_manager=manager)
+        return manager, connection, connection.root()['data']
+
+    def test_add_remove(self):
+        """Two transactions adding and removing different emails
+        are merged, even if they empty the slot of a removed email.
+        """
+        manager1, connection1, data1 = self.open()
+        manager2, connection2, data2 = self.open()
+        data1.subscriptions.insert('wim@example.com')
+        data1.subscriptions.remove('initial1@example.com')
+        data2.subscriptions.insert('arthur@example.com')
+        data2.subscriptions.remove('initial2@example.com')
+        manager1.commit()
+        manager2.commit()
+        connection1.close()
+        connection2.close()
+
+        manager, connection, data = self.open()
+        self.assertEqual(
+            list(data.subscriptions),
+            ['arthur@example.com', 'wim@example.com'])
+        self.assertEqual(len(data.subscriptions), 2)
+        connection.close()
+
+
+class Content(Persistent):
+    """Content stored in a standalone database.
+    """
+    implements(IContent, IAttributeAnnotatable)
+
+    def __init__(self, content_id):
+        self.content_id = content_id
+
+
+class IndexingService(object):
+    """Stand in for the service, indexing subscriptions in the index
+    opened by the current thread.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def index_subscription(self, content, email):
+        self.local.index.add(email, content.content_id)
+
+    def unindex_subscription(self, content, email):
+        self.local.index.remove(email, content.content_id)
+
+
+class ConcurrentConfirmationsTestCase(unittest.TestCase):
+    """Many people confirming their subscription to the same new
+    content at the same time only conflict when they create the same
+    slot of the subscribed emails.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.directory, 'Data.fs')))
+        manager = transaction.TransactionManager()
+        connection = self.db.open(transaction_manager=manager)
+        root = connection.root()
+        content = root['content'] = Content(42)
+        ISubscriptionManager(content).subscribability = SUBSCRIBABLE
+        root['index'] = SubscriptionIndex()
+        manager.commit()
+        connection.close()
+        self.service = IndexingService()
+        getGlobalSiteManager().registerUtility(
+            self.service, ISubscriptionService)
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(
+            self.service, ISubscriptionService)
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_parallel_confirmations(self):
+        threads = 20
+        emails = 25
+        conflicts = []
+        barrier = threading.Event()
+
+        def confirm(number):
+            barrier.wait()
+            for index in range(emails):
+                email = 'user%d-%d@example.com' % (number, index)
+                while True:
+                    manager = transaction.TransactionManager()
+                    connection = self.db.open(transaction_manager=manager)
+                    self.service.local.index = connection.root()['index']
+                    try:
+                        ISubscriptionManager(
+                            connection.root()['content']).subscribe(email)
+                        manager.commit()
+                        break
+                    except ConflictError:
+                        manager.abort()
+                        conflicts.append(email)
+                    finally:
+                        connection.close()
+
+        workers = [threading.Thread(target=confirm, args=(number,))
+                   for number in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.set()
+        for worker in workers:
+            worker.join()
+
+        connection = self.db.open()
+        content = connection.root()['content']
+        index = connection.root()['index']
+        data = IAnnotations(content)['silva.app.subscriptions']
+        # Each slot is created once, losing a race to create it is the
+        # only source of conflicts.
+        self.assertTrue(len(conflicts) < len(data.subscriptions._slots))
+        self.assertEqual(len(data.subscriptions), threads * emails)
+        self.assertEqual(len(index), threads * emails)
+        for number in range(threads):
+            for position in range(emails):
+                email = 'user%d-%d@example.com' % (number, position)
+                self.assertIn(email, data.subscriptions)
+                self.assertEqual(index.get(email), [42])
+        connection.close()
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConcurrentSubscriptionsTestCase))
+    suite.addTest(unittest.makeSuite(ConcurrentConfirmationsTestCase))
+    return suite
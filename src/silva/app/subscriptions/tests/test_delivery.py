@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.delivery import deliver_batch, run_worker
+from silva.app.subscriptions.delivery import retry
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.notifications import NotificationQueue
+from silva.app.subscriptions.service import SubscriptionService
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.app.subscriptions.testing import LocalSMTPServer
+from silva.core.interfaces import IPublicationWorkflow
+
+
+class ClaimTestCase(unittest.TestCase):
+    """Test claiming queued notifications.
+    """
+
+    def test_claim(self):
+        queue = NotificationQueue()
+        for content_id in range(5):
+            queue.append([content_id], 'publication_event_template')
+
+        claimed = queue.claim('worker1', 2)
+        self.assertEqual(
+            [notification.content_ids for key, notification in claimed],
+            [(0,), (1,)])
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(
+            [worker for key, worker, time, notification
+             in queue.get_claimed()],
+            ['worker1', 'worker1'])
+        other = queue.claim('worker2', 2)
+        self.assertEqual(
+            [notification.content_ids for key, notification in other],
+            [(2,), (3,)])
+
+        # Sent notifications are forgotten, failed ones are queued
+        # again, in their original position.
+        queue.complete([claimed[0][0]])
+        queue.release([claimed[1][0]])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(
+            [notification.content_ids for notification in queue.peek()],
+            [(1,), (4,)])
+        self.assertEqual(len(queue.get_claimed()), 2)
+
+        # Claims of dead workers are released after a timeout.
+        self.assertEqual(queue.release_expired(3600), 0)
+        self.assertEqual(queue.release_expired(-1), 2)
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.get_claimed(), [])
+
+    def test_dead_letters(self):
+        queue = NotificationQueue()
+        queue.append([0], 'publication_event_template')
+        queue.append([1], 'publication_event_template')
+
+        # Notifications failing too many times are kept aside.
+        for attempt in range(3):
+            (key, notification), = queue.claim('worker', 1)
+            dead = queue.release([key], 3)
+        self.assertEqual(dead, [notification])
+        self.assertEqual(notification.attempts, 3)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.count_dead_letters(), 1)
+        self.assertEqual(queue.get_dead_letters(), [(key, notification)])
+
+        # They can be replayed in their original position, or purged.
+        self.assertEqual(queue.replay(), 1)
+        self.assertEqual(
+            [notification.content_ids for notification in queue.peek()],
+            [(0,), (1,)])
+        self.assertEqual(queue.peek()[0].attempts, 0)
+        (key, notification), = queue.claim('worker', 1)
+        self.assertEqual(queue.release([key], 1), [notification])
+        self.assertEqual(queue.purge([key]), 1)
+        self.assertEqual(queue.count_dead_letters(), 0)
+        self.assertEqual(len(queue), 1)
+
+
+class ConcurrentClaimTestCase(unittest.TestCase):
+    """Workers claiming notifications at the same time never claim
+    the same ones.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.directory, 'Data.fs')))
+        connection = self.db.open()
+        queue = connection.root()['queue'] = NotificationQueue()
+        for content_id in range(200):
+            queue.append([content_id], 'publication_event_template')
+        transaction.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_parallel_claims(self):
+        threads = 4
+        claims = []
+        barrier = threading.Event()
+
+        def work(number):
+            connection = self.db.open()
+            queue = connection.root()['queue']
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        claimed = retry(queue.claim, 'worker%d' % number, 5)
+                    except ConflictError:
+                        continue
+                    if not claimed:
+                        break
+                    claims.extend(
+                        notification.content_ids[0]
+                        for key, notification in claimed)
+                    keys = [key for key, notification in claimed]
+                    while True:
+                        try:
+                            retry(queue.complete, keys)
+                            break
+                        except ConflictError:
+                            continue
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=work, args=(number,))
+                   for number in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.set()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(claims), range(200))
+        connection = self.db.open()
+        queue = connection.root()['queue']
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.get_claimed(), [])
+        connection.close()
+
+
+class ServiceDeliveryTestCase(unittest.TestCase):
+    """Test delivery workers sending queued notifications to a local
+    SMTP server.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.server = LocalSMTPServer()
+        self.server.start()
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addMockupVersionedContent('other', 'Other')
+
+        mailhost = self.root.service_mailhost
+        mailhost.smtp_host = self.server.host
+        mailhost.smtp_port = self.server.port
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        self.service._asynchronous = True
+        self.service._bulk_delivery = True
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        IPublicationWorkflow(self.root.other).publish()
+        transaction.commit()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_deliver(self):
+        service = self.service
+        self.assertEqual(service.get_pending_notifications(), 2)
+
+        self.assertEqual(deliver_batch(service, 'worker', 1), (1, 0))
+        self.assertEqual(
+            sorted(rcpttos for mailfrom, rcpttos, data
+                   in self.server.messages),
+            [['torvald@example.com'], ['wim@example.com']])
+        self.assertEqual(service.get_pending_notifications(), 1)
+        self.assertEqual(service._notifications.get_claimed(), [])
+
+        self.assertEqual(run_worker(service, 'worker'), (1, 0))
+        self.assertEqual(len(self.server.messages), 4)
+        self.assertEqual(service.get_pending_notifications(), 0)
+        self.assertEqual(run_worker(service, 'worker'), (0, 0))
+
+    def test_failure(self):
+        service = self.service
+        original = SubscriptionService.send_pending_notification
+
+        def fail(self, notification):
+            raise ValueError(u"Relay is down")
+
+        SubscriptionService.send_pending_notification = fail
+        try:
+            # The worker stops at the first failure.
+            self.assertEqual(run_worker(service, 'worker', 1), (0, 1))
+        finally:
+            SubscriptionService.send_pending_notification = original
+
+        # The failed notification is queued again.
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(service.get_pending_notifications(), 2)
+        self.assertEqual(service._notifications.get_claimed(), [])
+        self.assertEqual(run_worker(service, 'worker'), (2, 0))
+        self.assertEqual(len(self.server.messages), 4)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ClaimTestCase))
+    suite.addTest(unittest.makeSuite(ConcurrentClaimTestCase))
+    suite.addTest(unittest.makeSuite(ServiceDeliveryTestCase))
+    return suite
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.digest import IMMEDIATE, HOURLY, DAILY
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.app.subscriptions.upgrader.upgrade_304 import \
+    service_templates_upgrader
+from silva.core.interfaces import IPublicationWorkflow
+
+
+class DigestTestCase(unittest.TestCase):
+    """Test periodic digests of notifications.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addMockupVersionedContent('other', 'Other')
+
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+
+    def test_delivery_mode(self):
+        service = self.service
+        self.assertEqual(service.get_delivery_mode('wim@example.com'),
+                         IMMEDIATE)
+        service._digest_mode = DAILY
+        self.assertEqual(service.get_delivery_mode('wim@example.com'),
+                         DAILY)
+        service.set_delivery_mode('wim@example.com', HOURLY)
+        self.assertEqual(service.get_delivery_mode('wim@example.com'),
+                         HOURLY)
+        self.assertEqual(service.get_delivery_mode('torvald@example.com'),
+                         DAILY)
+        # Emails are looked up in their canonical form.
+        self.assertEqual(service.get_delivery_mode('wim@EXAMPLE.com'),
+                         HOURLY)
+        service.set_delivery_mode('torvald@Example.com ', HOURLY)
+        self.assertEqual(service.get_delivery_mode('torvald@example.com'),
+                         HOURLY)
+        service.set_delivery_mode('wim@Example.COM', None)
+        self.assertEqual(service.get_delivery_mode('wim@example.com'),
+                         DAILY)
+        self.assertRaises(
+            ValueError, service.set_delivery_mode, 'wim@example.com', 'yearly')
+
+    def test_digest(self):
+        service = self.service
+        service.set_delivery_mode('wim@example.com', DAILY)
+        mailhost = self.root.service_mailhost
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        IPublicationWorkflow(self.root.other).publish()
+        transaction.commit()
+        self.root.document.create_copy()
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+
+        # Torvald is notified immediately.
+        self.assertEqual(len(mailhost.messages), 3)
+        self.assertEqual(
+            [message.mto for message in mailhost.messages],
+            [['torvald@example.com']] * 3)
+        mailhost.reset()
+
+        # Nobody use hourly digests.
+        self.assertEqual(service.send_digests(HOURLY), 0)
+        self.assertEqual(len(mailhost.messages), 0)
+
+        # Wim get one digest with the two changed documents.
+        self.assertEqual(service.send_digests(DAILY), 1)
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 1)
+        message = mailhost.read_last_message()
+        self.assertEqual(message.mto, ['wim@example.com'])
+        self.assertEqual(
+            message.subject,
+            'Changes notification digest from root')
+        self.assertIn('http://localhost/root/document', message.urls)
+        self.assertIn('http://localhost/root/other', message.urls)
+        self.assertIn(
+            'http://localhost/root/subscriptions.html', message.urls)
+
+        # The next digest is empty.
+        mailhost.reset()
+        self.assertEqual(service.send_digests(DAILY), 0)
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 0)
+        self.assertRaises(ValueError, service.send_digests, 'yearly')
+
+    def test_upgrade_templates(self):
+        service = self.service
+        service.manage_delObjects(['digest_template'])
+        self.assertEqual(service_templates_upgrader.validate(service), True)
+        self.assertEqual(service_templates_upgrader.upgrade(service), service)
+        self.assertIn('digest_template', service.objectIds())
+        self.assertEqual(service_templates_upgrader.validate(service), False)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DigestTestCase))
+    return suite
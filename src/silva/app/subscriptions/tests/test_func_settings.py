@@ -4,9 +4,12 @@
 
 import unittest
 
+import transaction
+
 from zope.component import getUtility
 from Products.Silva.ftesting import smi_settings
 from Products.Silva.testing import CatalogTransaction
+from silva.app.subscriptions.interfaces import ISubscriptionManager
 from silva.app.subscriptions.interfaces import ISubscriptionService
 from silva.app.subscriptions.testing import FunctionalLayer
 
@@ -40,14 +43,53 @@ class SettingsTestCase(unittest.TestCase):
         self.assertEqual(
             browser.inspect.tabs['Settings'].entries['Subscriptions'].click(),
             200)
-        self.assertIn('Manage subscriptions', browser.inspect.form)
-
-        form = browser.inspect.form['Manage subscriptions']
-        self.assertIn('subscribed email addresses', form.fields)
-        form.fields['subscribed email addresses'].value = 'info@infrae.com'
+        self.assertIn('Subscribability', browser.inspect.form)
+        form = browser.inspect.form['Subscribability']
         self.assertEqual(form.actions, ['Cancel', 'Save changes'])
-        self.assertEqual(form.actions['Save changes'].click(), 200)
-        browser.macros.assertFeedback('Changes saved.')
+
+        self.assertIn('Add or remove email addresses', browser.inspect.form)
+        form = browser.inspect.form['Add or remove email addresses']
+        self.assertIn('email addresses', form.fields)
+        form.fields['email addresses'].value = (
+            'info@infrae.com\nwim@example.com')
+        self.assertEqual(form.actions, ['Subscribe', 'Unsubscribe'])
+        self.assertEqual(form.actions['Subscribe'].click(), 200)
+        browser.macros.assertFeedback('2 email address(es) subscribed.')
+        self.assertEqual(
+            ISubscriptionManager(self.root).locally_subscribed_emails,
+            set(['info@infrae.com', 'wim@example.com']))
+
+        form = browser.inspect.form['Add or remove email addresses']
+        form.fields['email addresses'].value = 'wim@example.com'
+        self.assertEqual(form.actions['Unsubscribe'].click(), 200)
+        browser.macros.assertFeedback('1 email address(es) unsubscribed.')
+        self.assertEqual(
+            ISubscriptionManager(self.root).locally_subscribed_emails,
+            set(['info@infrae.com']))
+
+    def test_subscriptions_list(self):
+        manager = ISubscriptionManager(self.root)
+        manager.subscribe_many(
+            ['user%03d@example.com' % number for number in range(120)] +
+            ['info@infrae.com'])
+        transaction.commit()
+
+        browser = self.layer.get_web_browser(smi_settings)
+        browser.login(self.user)
+        self.assertEqual(browser.inspect.tabs['Settings'].open.click(), 200)
+        self.assertEqual(
+            browser.inspect.tabs['Settings'].entries['Subscriptions'].click(),
+            200)
+        self.assertIn('Subscribed email addresses', browser.inspect.form)
+        form = browser.inspect.form['Subscribed email addresses']
+        self.assertEqual(form.actions, ['Search'])
+        form.fields['email address starting with'].value = 'user1'
+        form.fields['page'].value = '1'
+        self.assertEqual(form.actions['Search'].click(), 200)
+        self.assertIn(
+            'Showing 1 to 20 of the matching ones', browser.contents)
+        self.assertIn('user119@example.com', browser.contents)
+        self.assertNotIn('info@infrae.com', browser.contents)
 
 
 def test_suite():
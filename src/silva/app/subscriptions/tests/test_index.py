@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.index import normalize_email
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.testing import FunctionalLayer
+
+
+class SubscriptionIndexTestCase(unittest.TestCase):
+    """Test the index of subscribed emails.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addFolder('folder', u'Test Folder')
+        factory = self.root.folder.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('index', 'Index')
+
+    def test_normalize_email(self):
+        self.assertEqual(
+            normalize_email(u' Wim@Example.COM '), u'Wim@example.com')
+        self.assertEqual(normalize_email(u'wim'), u'wim')
+
+    def test_index(self):
+        service = getUtility(ISubscriptionService)
+        self.assertEqual(service.get_subscribed_content('wim@example.com'), [])
+
+        ISubscriptionManager(self.root.document).subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder).subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder.index).subscribe(
+            'arthur@example.com')
+        self.assertItemsEqual(
+            service.get_subscribed_content('wim@Example.com'),
+            [self.root.document, self.root.folder])
+        self.assertEqual(
+            service.get_subscribed_content('arthur@example.com'),
+            [self.root.folder.index])
+
+        ISubscriptionManager(self.root.document).unsubscribe('wim@example.com')
+        self.assertEqual(
+            service.get_subscribed_content('wim@example.com'),
+            [self.root.folder])
+
+        # Editing the list of emails update the index as well.
+        ISubscriptionManager(self.root.folder).locally_subscribed_emails = [
+            'arthur@example.com']
+        self.assertEqual(
+            service.get_subscribed_content('wim@example.com'), [])
+        self.assertItemsEqual(
+            service.get_subscribed_content('arthur@example.com'),
+            [self.root.folder, self.root.folder.index])
+
+        # Deleting a content removes its subscriptions.
+        self.root.folder.manage_delObjects(['index'])
+        self.assertEqual(
+            service.get_subscribed_content('arthur@example.com'),
+            [self.root.folder])
+
+    def test_copy(self):
+        """The subscriptions of a copied content and its sub-contents
+        are indexed for the copy.
+        """
+        service = getUtility(ISubscriptionService)
+        ISubscriptionManager(self.root.folder).subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder.index).subscribe(
+            'arthur@example.com')
+        transaction.savepoint()
+        token = self.root.manage_copyObjects(['folder'])
+        self.root.manage_pasteObjects(token)
+        copy = self.root.copy_of_folder
+        self.assertItemsEqual(
+            service.get_subscribed_content('wim@example.com'),
+            [self.root.folder, copy])
+        self.assertItemsEqual(
+            service.get_subscribed_content('arthur@example.com'),
+            [self.root.folder.index, copy.index])
+
+    def test_rebuild_index(self):
+        service = getUtility(ISubscriptionService)
+        ISubscriptionManager(self.root.document).subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder.index).subscribe(
+            'wim@example.com')
+        service._index = None
+        self.assertEqual(service.get_subscribed_content('wim@example.com'), [])
+
+        self.assertEqual(service.rebuild_index(), 1)
+        self.assertItemsEqual(
+            service.get_subscribed_content('wim@example.com'),
+            [self.root.document, self.root.folder.index])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SubscriptionIndexTestCase))
+    return suite
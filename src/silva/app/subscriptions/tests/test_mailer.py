@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import smtplib
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.mailer import SMTPMailer, get_envelope
+from silva.app.subscriptions.testing import FunctionalLayer, FakeSMTP
+from silva.app.subscriptions.testing import FakeBusySMTP
+from silva.core.interfaces import IPublicationWorkflow
+
+MESSAGE = """To: %s
+From: Notifications <notification@example.com>
+Subject: Hello
+Content-Type: text/plain; charset=utf-8
+
+Hello world.
+"""
+
+
+class FakePipeliningSMTP(FakeSMTP):
+    """SMTP stand in that supports pipelining.
+    """
+
+    def __init__(self, host, port):
+        super(FakePipeliningSMTP, self).__init__(host, port)
+        self.replies = []
+        self.commands = []
+
+    def has_extn(self, name):
+        return name == 'pipelining'
+
+    def send(self, data):
+        if data.endswith('\r\n.\r\n'):
+            self.messages.append(data)
+            self.replies.append((250, 'Ok'))
+            return
+        accepted = False
+        for command in data.split('\r\n'):
+            if not command:
+                continue
+            self.commands.append(command)
+            if command.startswith('RCPT TO:'):
+                if command[9:-1] in self.refused:
+                    self.replies.append((550, 'Unknown user'))
+                else:
+                    accepted = True
+                    self.replies.append((250, 'Ok'))
+            elif command == 'DATA':
+                self.replies.append(accepted and (354, 'Go') or (554, 'No'))
+            else:
+                self.replies.append((250, 'Ok'))
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def rset(self):
+        self.replies = []
+
+
+class MailerTestCase(unittest.TestCase):
+    """Test sending messages in bulk.
+    """
+
+    def setUp(self):
+        FakeSMTP.reset()
+
+    def test_envelope(self):
+        self.assertEqual(
+            get_envelope(MESSAGE % 'wim@example.com'),
+            ('notification@example.com', ['wim@example.com']))
+
+    def test_send(self):
+        mailer = SMTPMailer(batch_size=2, factory=FakeSMTP)
+        FakeSMTP.refused.add('arthur@example.com')
+        report = mailer.send(
+            MESSAGE % email for email in [
+                'wim@example.com', 'arthur@example.com',
+                'sylvain@example.com', 'torvald@example.com',
+                'jasper@example.com'])
+        self.assertEqual(report.sent, 4)
+        self.assertEqual(report.failed.keys(), ['arthur@example.com'])
+        self.assertEqual(len(report.batches), 3)
+        self.assertEqual(
+            [(batch.sent, len(batch.failed)) for batch in report.batches],
+            [(1, 1), (2, 0), (1, 0)])
+        # Refused recipients are not sent again.
+        self.assertEqual(report.deferred, [])
+
+        # Only one connection have been used.
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        connection = FakeSMTP.connections[0]
+        self.assertEqual(connection.closed, True)
+        self.assertEqual(
+            [mto for mfrom, mto, message in connection.messages],
+            [['wim@example.com'], ['sylvain@example.com'],
+             ['torvald@example.com'], ['jasper@example.com']])
+
+    def test_send_deferred(self):
+        mailer = SMTPMailer(factory=FakeBusySMTP)
+        FakeSMTP.refused.add('arthur@example.com')
+        report = mailer.send(
+            MESSAGE % email for email in [
+                'wim@example.com', 'busy@example.com',
+                'arthur@example.com'])
+        self.assertEqual(report.sent, 1)
+        self.assertEqual(
+            sorted(report.failed.keys()),
+            ['arthur@example.com', 'busy@example.com'])
+        # Only the temporary failures can be sent again later.
+        self.assertEqual(
+            [message for message, error in report.deferred],
+            [MESSAGE % 'busy@example.com'])
+        self.assertEqual(
+            [message for message, error in report.rejected],
+            [MESSAGE % 'arthur@example.com'])
+
+    def test_send_pipelining(self):
+        mailer = SMTPMailer(factory=FakePipeliningSMTP)
+        FakeSMTP.refused.add('arthur@example.com')
+        report = mailer.send(
+            MESSAGE % email for email in [
+                'wim@example.com', 'arthur@example.com',
+                'sylvain@example.com'])
+        self.assertEqual(report.sent, 2)
+        self.assertEqual(report.failed.keys(), ['arthur@example.com'])
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        connection = FakeSMTP.connections[0]
+        self.assertEqual(len(connection.messages), 2)
+        self.assertEqual(
+            connection.commands[:3],
+            ['MAIL FROM:<notification@example.com>',
+             'RCPT TO:<wim@example.com>',
+             'DATA'])
+
+
+class ServiceBulkDeliveryTestCase(unittest.TestCase):
+    """Test notifications sent in bulk by the service.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        FakeSMTP.reset()
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+
+    def test_bulk_notification(self):
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        service.smtp_factory = FakeSMTP
+        service._bulk_delivery = True
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+
+        # Nothing went through the mailhost.
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        self.assertEqual(len(FakeSMTP.connections), 1)
+        self.assertEqual(
+            sorted(mto for mfrom, mto, message in
+                   FakeSMTP.connections[0].messages),
+            [['torvald@example.com'], ['wim@example.com']])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MailerTestCase))
+    suite.addTest(unittest.makeSuite(ServiceBulkDeliveryTestCase))
+    return suite
@@ -4,7 +4,11 @@
 
 import unittest
 
+import transaction
 from zope.interface.verify import verifyObject
+from silva.app.subscriptions.cache import subscribers_cache
+from silva.app.subscriptions.subscribable import query_subscribable_data
+from silva.app.subscriptions.subscribers import SubscriberSet
 from silva.app.subscriptions.interfaces import ISubscriptionManager
 from silva.app.subscriptions.interfaces import ISubscription
 from silva.app.subscriptions.testing import FunctionalLayer
@@ -115,6 +119,74 @@ class SubscriptionManagerTestCase(unittest.TestCase):
             manager.is_subscribed('sylvain@example.com'),
             False)
 
+    def test_normalize(self):
+        """Emails are stored with a lower case domain, and are
+        looked up the same way.
+        """
+        manager = ISubscriptionManager(self.root.document)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe(u' Wim@Example.COM ')
+        manager.subscribe('Wim@example.com')
+        self.assertEqual(
+            manager.locally_subscribed_emails, set(['Wim@example.com']))
+        self.assertTrue(
+            isinstance(list(manager.locally_subscribed_emails)[0], str))
+        self.assertEqual(manager.is_subscribed('Wim@EXAMPLE.com'), True)
+        self.assertEqual(manager.is_subscribed('wim@example.com'), False)
+        subscription = manager.get_subscription('Wim@Example.com')
+        self.assertNotEqual(subscription, None)
+        self.assertEqual(subscription.email, 'Wim@example.com')
+
+        manager.unsubscribe('Wim@EXAMPLE.COM')
+        self.assertEqual(manager.locally_subscribed_emails, set())
+
+    def test_subscribe_unsubscribe_many(self):
+        manager = ISubscriptionManager(self.root.document)
+        manager.subscribe('wim@example.com')
+        self.assertEqual(
+            manager.subscribe_many(
+                ['wim@example.com', 'sylvain@example.com',
+                 'arthur@example.com', 'sylvain@example.com']),
+            [False, True, True, False])
+        self.assertEqual(
+            manager.locally_subscribed_emails,
+            set(['wim@example.com', 'sylvain@example.com',
+                 'arthur@example.com']))
+        self.assertEqual(
+            manager.unsubscribe_many(
+                ['sylvain@example.com', 'torvald@example.com',
+                 'arthur@example.com']),
+            [True, False, True])
+        self.assertEqual(
+            manager.locally_subscribed_emails, set(['wim@example.com']))
+
+        # Nothing is written if nothing changes.
+        manager = ISubscriptionManager(self.root.folder)
+        self.assertEqual(manager.unsubscribe_many(['wim@example.com']),
+                         [False])
+        self.assertEqual(manager.subscribe_many([]), [])
+        self.assertEqual(query_subscribable_data(self.root.folder), None)
+
+    def test_search(self):
+        manager = ISubscriptionManager(self.root.document)
+        self.assertEqual(manager.search_local_subscriptions(), [])
+        manager.subscribe_many(
+            ['user%02d@example.com' % number for number in range(30)] +
+            ['arthur@example.com', 'wim@example.com'])
+        self.assertEqual(
+            manager.search_local_subscriptions(u'user2', 3, 4),
+            ['user23@example.com', 'user24@example.com',
+             'user25@example.com', 'user26@example.com'])
+        self.assertEqual(
+            manager.search_local_subscriptions(u'user', 28, 10),
+            ['user28@example.com', 'user29@example.com'])
+        self.assertEqual(
+            manager.search_local_subscriptions(size=2),
+            ['arthur@example.com', 'user00@example.com'])
+        self.assertEqual(
+            manager.search_local_subscriptions(u'w'), ['wim@example.com'])
+        self.assertEqual(manager.search_local_subscriptions(u'z'), [])
+
     def test_is_subscribed(self):
         """is_subscribed returns True if you are subscribed on of the
         parents.
@@ -137,6 +209,48 @@ class SubscriptionManagerTestCase(unittest.TestCase):
         # That didn't changed anything on the parent
         self.assertEqual(manager_root.is_subscribed('wim@example.com'), True)
 
+    def test_read_only(self):
+        """Reading subscription settings doesn't store anything on
+        the content.
+        """
+        manager = ISubscriptionManager(self.root.folder.index)
+        self.assertEqual(manager.is_subscribable(), False)
+        self.assertEqual(manager.is_subscribed('wim@example.com'), False)
+        self.assertEqual(manager.get_subscriptions(), [])
+        self.assertEqual(manager.locally_subscribed_emails, set())
+        manager.unsubscribe('wim@example.com')
+        manager.subscribability = ACQUIRE_SUBSCRIBABILITY
+        manager.locally_subscribed_emails = []
+        for content in [self.root, self.root.folder, self.root.folder.index]:
+            self.assertEqual(query_subscribable_data(content), None)
+
+        # Settings are stored the first time they are changed.
+        manager.subscribe('wim@example.com')
+        self.assertNotEqual(
+            query_subscribable_data(self.root.folder.index), None)
+        self.assertEqual(query_subscribable_data(self.root.folder), None)
+        self.assertEqual(
+            manager.locally_subscribed_emails, set(['wim@example.com']))
+
+    def test_storage(self):
+        """Subscribed emails are stored only once there are some, in
+        as few slots as needed.
+        """
+        manager = ISubscriptionManager(self.root.folder)
+        manager.subscribability = SUBSCRIBABLE
+        data = query_subscribable_data(self.root.folder)
+        self.assertEqual(data.subscriptions, frozenset())
+        self.assertNotIn('subscriptions', data.__dict__)
+
+        manager.subscribe_many(['wim@example.com', 'arthur@example.com'])
+        self.assertTrue(isinstance(data.subscriptions, SubscriberSet))
+        self.assertEqual(len(data.subscriptions._slots), 2)
+        manager.unsubscribe_many(['wim@example.com', 'arthur@example.com'])
+        self.assertEqual(len(data.subscriptions), 0)
+        self.assertEqual(list(data.subscriptions), [])
+        # Slots are never removed.
+        self.assertEqual(len(data.subscriptions._slots), 2)
+
     def tests_get_subscription(self):
         """Test retrieving subscriptions information.
         """
@@ -171,7 +285,110 @@ class SubscriptionManagerTestCase(unittest.TestCase):
         self.assertEqual(len(manager.get_subscriptions()), 1)
 
 
+class SubscribersCacheTestCase(unittest.TestCase):
+    """Test inherited subscribers are cached.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addFolder('folder', u'Test Folder')
+        factory = self.root.folder.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('index', 'Index')
+        factory.manage_addMockupVersionedContent('other', 'Other')
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder).subscribe('arthur@example.com')
+        transaction.commit()
+        subscribers_cache.clear()
+
+    def test_cache(self):
+        manager = ISubscriptionManager(self.root.folder.index)
+        hits = subscribers_cache.hits
+        self.assertEqual(
+            sorted(manager.subscriptions.keys()),
+            ['arthur@example.com', 'wim@example.com'])
+        self.assertEqual(subscribers_cache.hits, hits)
+
+        # Other contents in the same folder use the same entry.
+        manager = ISubscriptionManager(self.root.folder.other)
+        self.assertEqual(manager.is_subscribed('wim@example.com'), True)
+        self.assertEqual(
+            manager.get_subscription('arthur@example.com').content,
+            self.root.folder)
+        self.assertEqual(subscribers_cache.hits, hits + 2)
+
+        # A change above invalidates the cache.
+        ISubscriptionManager(self.root).subscribe('sylvain@example.com')
+        self.assertEqual(manager.is_subscribed('sylvain@example.com'), True)
+        transaction.commit()
+        self.assertEqual(manager.is_subscribed('sylvain@example.com'), True)
+        self.assertEqual(len(manager.subscriptions), 3)
+
+        ISubscriptionManager(self.root.folder).subscribability = \
+            NOT_SUBSCRIBABLE
+        self.assertEqual(manager.is_subscribed('sylvain@example.com'), False)
+        self.assertEqual(len(manager.subscriptions), 0)
+        transaction.commit()
+        self.assertEqual(manager.is_subscribed('sylvain@example.com'), False)
+
+    def test_count(self):
+        manager = ISubscriptionManager(self.root.folder.index)
+        manager.subscribe_many(['wim@example.com', 'torvald@example.com'])
+        self.assertEqual(manager.count_subscriptions(), 3)
+        self.assertEqual(manager.count_local_subscriptions(), 2)
+        transaction.commit()
+
+        # Counts are cached once committed.
+        self.assertEqual(manager.count_subscriptions(), 3)
+        hits = subscribers_cache.hits
+        self.assertEqual(manager.count_subscriptions(), 3)
+        self.assertEqual(subscribers_cache.hits, hits + 1)
+        self.assertEqual(len(manager.subscriptions), 3)
+
+        manager.unsubscribe('torvald@example.com')
+        self.assertEqual(manager.count_subscriptions(), 2)
+        self.assertEqual(manager.count_local_subscriptions(), 1)
+        transaction.commit()
+        self.assertEqual(manager.count_subscriptions(), 2)
+
+        ISubscriptionManager(self.root.folder).subscribability = \
+            NOT_SUBSCRIBABLE
+        self.assertEqual(manager.count_subscriptions(), 0)
+        self.assertEqual(manager.count_local_subscriptions(), 1)
+
+    def test_size(self):
+        """The cache doesn't hold more emails than its size.
+        """
+        size = subscribers_cache.size
+        subscribers_cache.size = 2
+        try:
+            manager = ISubscriptionManager(self.root.folder.index)
+            self.assertEqual(len(manager.subscriptions.keys()), 2)
+            self.assertEqual(subscribers_cache._weight, 2)
+
+            # Subscribers of an other folder are too many to be cached.
+            factory = self.root.manage_addProduct['Silva']
+            factory.manage_addFolder('other', u'Other Folder')
+            ISubscriptionManager(self.root.other).subscribe_many(
+                ['arthur@example.com', 'torvald@example.com'])
+            transaction.commit()
+            factory = self.root.other.manage_addProduct['Silva']
+            factory.manage_addMockupVersionedContent('index', 'Index')
+            manager = ISubscriptionManager(self.root.other.index)
+            self.assertEqual(len(manager.subscriptions.keys()), 3)
+            self.assertEqual(subscribers_cache._weight, 2)
+            self.assertEqual(len(subscribers_cache._entries), 1)
+        finally:
+            subscribers_cache.size = size
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(SubscriptionManagerTestCase))
+    suite.addTest(unittest.makeSuite(SubscribersCacheTestCase))
     return suite
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.metrics import Metrics, Histogram
+from silva.app.subscriptions.testing import FunctionalLayer, FakeSMTP
+from silva.core.interfaces import IPublicationWorkflow
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test recording counters and timings.
+    """
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(0.5)
+        histogram.observe(3.0)
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        statistics = histogram.statistics()
+        self.assertEqual(statistics['count'], 4)
+        self.assertAlmostEqual(statistics['average'], 1.0125)
+        self.assertAlmostEqual(statistics['maximum'], 3.0)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.increment('notification', 'messages')
+        metrics.increment('notification', 'bytes', 42)
+        metrics.observe('notification', 'render', 0.02)
+        self.assertEqual(metrics.get_counter('notification', 'messages'), 1)
+        self.assertEqual(metrics.get_counter('notification', 'bytes'), 42)
+        self.assertEqual(metrics.get_counter('digest', 'bytes'), 0)
+        statistics = metrics.statistics()
+        self.assertEqual(statistics['notification_render_count'], 1)
+        self.assertAlmostEqual(statistics['notification_render_maximum'], 0.02)
+        self.assertEqual(statistics['digest_deliver_count'], 0)
+
+        text = metrics.render()
+        self.assertIn(
+            'silva_subscriptions_bytes_total{operation="notification"} 42\n',
+            text)
+        self.assertIn(
+            'silva_subscriptions_seconds_bucket{operation="notification",'
+            'stage="render",le="0.05"} 1\n',
+            text)
+        self.assertIn(
+            'silva_subscriptions_seconds_count{operation="notification",'
+            'stage="render"} 1\n',
+            text)
+
+        metrics.reset()
+        self.assertEqual(metrics.get_counter('notification', 'messages'), 0)
+
+
+class ServiceMetricsTestCase(unittest.TestCase):
+    """Test metrics recorded by the service.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        self.service.get_metrics().reset()
+
+    def test_notification(self):
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 2)
+
+        metrics = self.service.get_metrics()
+        self.assertEqual(metrics.get_counter('notification', 'recipients'), 2)
+        self.assertEqual(metrics.get_counter('notification', 'messages'), 2)
+        self.assertEqual(metrics.get_counter('notification', 'failures'), 0)
+        self.assertTrue(metrics.get_counter('notification', 'bytes') > 0)
+        self.assertEqual(
+            metrics.get_timing('notification', 'resolve')['count'], 1)
+        self.assertEqual(
+            metrics.get_timing('notification', 'render')['count'], 2)
+        self.assertEqual(
+            metrics.get_timing('notification', 'deliver')['count'], 1)
+
+    def test_confirmation(self):
+        manager = ISubscriptionManager(self.root.document)
+        manager.subscribability = SUBSCRIBABLE
+        self.service.request_subscription(
+            self.root.document, 'torvald@example.com')
+
+        metrics = self.service.get_metrics()
+        self.assertEqual(metrics.get_counter('confirmation', 'recipients'), 1)
+        self.assertEqual(metrics.get_counter('confirmation', 'messages'), 1)
+        self.assertEqual(metrics.get_counter('notification', 'messages'), 0)
+
+    def test_bytes(self):
+        """The size of the messages is counted once encoded.
+        """
+        self.service._bulk_delivery = True
+        self.service.smtp_factory = FakeSMTP
+        FakeSMTP.reset()
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('other', u'\xdcberblick')
+
+        IPublicationWorkflow(self.root.other).publish()
+        transaction.commit()
+        (mfrom, mto, message), = FakeSMTP.connections[0].messages
+        self.assertIn('\xc3\x9cberblick', message)
+        self.assertEqual(
+            self.service.get_metrics().get_counter('notification', 'bytes'),
+            len(message))
+
+    def test_views(self):
+        browser = self.layer.get_browser()
+        browser.login('manager')
+        self.assertEqual(
+            browser.open('/root/service_subscriptions/manage_metrics'), 200)
+        self.assertEqual(
+            browser.open('/root/service_subscriptions/metrics.txt'), 200)
+        self.assertEqual(browser.content_type, 'text/plain')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MetricsTestCase))
+    suite.addTest(unittest.makeSuite(ServiceMetricsTestCase))
+    return suite
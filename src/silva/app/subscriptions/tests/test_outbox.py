@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import smtplib
+import socket
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.outbox import Outbox, get_delay
+from silva.app.subscriptions.ratelimit import get_rate_limiter
+from silva.app.subscriptions.service import SubscriptionService
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.app.subscriptions.testing import FakeSMTP, FakeBusySMTP
+from silva.core.interfaces import IPublicationWorkflow
+
+MESSAGE = """To: %s
+From: Notifications <notification@example.com>
+Subject: Hello
+Content-Type: text/plain; charset=utf-8
+
+Hello world.
+"""
+
+
+class OutboxTestCase(unittest.TestCase):
+    """Test retrying messages that failed to be sent.
+    """
+
+    def test_delay(self):
+        self.assertEqual(
+            [get_delay(attempts) for attempts in range(1, 6)],
+            [60, 120, 240, 480, 960])
+        self.assertEqual(get_delay(20), 6 * 3600)
+        self.assertEqual(get_delay(3, 10), 40)
+
+    def test_retry(self):
+        outbox = Outbox()
+        entry = outbox.add(MESSAGE % 'wim@example.com', 'Connection refused')
+        self.assertEqual(entry.recipients, ['wim@example.com'])
+        self.assertEqual(entry.subject, 'Hello')
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(len(outbox), 1)
+        # The message is not due yet.
+        self.assertEqual(outbox.pop_due(), [])
+
+        outbox.add(MESSAGE % 'arthur@example.com', 'Connection refused', 0)
+        entry, = outbox.pop_due()
+        self.assertEqual(entry.recipients, ['arthur@example.com'])
+        self.assertEqual(len(outbox), 1)
+
+        # Failed messages are retried, until they fail too many times.
+        self.assertEqual(outbox.retry(entry, 'Timeout', 0, 3), True)
+        entry, = outbox.pop_due()
+        self.assertEqual((entry.attempts, entry.error), (2, 'Timeout'))
+        self.assertEqual(outbox.retry(entry, 'Timeout', 0, 3), False)
+        self.assertEqual(outbox.pop_due(), [])
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox.count_dead_letters(), 1)
+        (key, entry), = outbox.get_dead_letters()
+        self.assertEqual(entry.attempts, 3)
+
+        # Dead letters can be replayed.
+        self.assertEqual(outbox.replay([key]), 1)
+        self.assertEqual(outbox.count_dead_letters(), 0)
+        entry, = outbox.pop_due()
+        self.assertEqual(entry.recipients, ['arthur@example.com'])
+        self.assertEqual(entry.attempts, 0)
+        self.assertEqual(outbox.retry(entry, 'Timeout', 0, 1), False)
+        self.assertEqual(outbox.purge(), 1)
+        self.assertEqual(outbox.get_dead_letters(), [])
+
+
+class ServiceOutboxTestCase(unittest.TestCase):
+    """Test notifications that could not be sent are kept in the
+    outbox.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        self.service.get_metrics().reset()
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+        self.send_message = SubscriptionService._send_message
+
+    def tearDown(self):
+        SubscriptionService._send_message = self.send_message
+        # Rate limiters are shared by the tests, forget them.
+        get_rate_limiter(self.service.getPhysicalPath(), 0)
+
+    def break_relay(self):
+
+        def fail(service, message):
+            raise socket.error(u"Connection refused")
+
+        SubscriptionService._send_message = fail
+
+    def refuse_recipients(self):
+
+        def fail(service, message):
+            raise smtplib.SMTPRecipientsRefused(
+                {'wim@example.com': (550, 'Unknown user')})
+
+        SubscriptionService._send_message = fail
+
+    def repair_relay(self):
+        SubscriptionService._send_message = self.send_message
+
+    def test_outbox(self):
+        service = self.service
+        service._retry_delay = 0
+        service._retry_attempts = 3
+        mailhost = self.root.service_mailhost
+        self.break_relay()
+
+        # Publishing doesn't fail.
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 0)
+        self.assertEqual(
+            service.get_metrics().get_counter('notification', 'failures'), 2)
+        outbox = service.get_outbox()
+        self.assertEqual(len(outbox), 2)
+
+        # Messages are sent again once the transaction is committed.
+        self.assertEqual(service.process_outbox(), 2)
+        transaction.commit()
+        metrics = service.get_metrics()
+        self.assertEqual(metrics.get_counter('outbox', 'messages'), 2)
+        self.assertEqual(metrics.get_counter('outbox', 'failures'), 2)
+        self.assertEqual(metrics.statistics()['outbox_failures'], 2)
+        self.assertEqual(
+            [entry.attempts for due, entry in outbox.get_pending()], [2, 2])
+        self.assertEqual(service.process_outbox(), 2)
+        transaction.commit()
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.count_dead_letters(), 2)
+        self.assertEqual(service.process_outbox(), 0)
+
+        # Once the relay works again, dead letters can be replayed.
+        self.repair_relay()
+        (key, entry), other = outbox.get_dead_letters()
+        self.assertEqual(service.purge_dead_letters([key]), 1)
+        self.assertEqual(service.replay_dead_letters(), 1)
+        self.assertEqual(service.process_outbox(), 1)
+        self.assertEqual(len(mailhost.messages), 0)
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 1)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.count_dead_letters(), 0)
+
+    def test_confirmation(self):
+        service = self.service
+        self.break_relay()
+        service.request_subscription(self.root.document, 'arthur@example.com')
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        entry, = [entry for due, entry in service.get_outbox().get_pending()]
+        self.assertEqual(entry.recipients, ['arthur@example.com'])
+        self.assertEqual(entry.error, 'Connection refused')
+
+        # The message is sent later, after the retry delay.
+        self.repair_relay()
+        self.assertEqual(service.process_outbox(), 0)
+        self.assertEqual(len(service.get_outbox()), 1)
+
+    def test_rate_limit(self):
+        """Messages sent after a request don't wait for the rate
+        limiter: the ones over the limit are left in the outbox, to be
+        sent by the workers that can wait.
+        """
+        service = self.service
+        service._rate_limit = 1
+        limiter = service.get_rate_limiter()
+        mailhost = self.root.service_mailhost
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 1)
+        entry, = [entry for due, entry in service.get_outbox().get_pending()]
+        self.assertEqual(entry.attempts, 0)
+        self.assertEqual(entry.error, u"Rate limit exceeded")
+        self.assertEqual(limiter.statistics()['postponed'], 1)
+
+        self.assertEqual(service.process_outbox(throttle=True), 1)
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 2)
+        self.assertEqual(len(service.get_outbox()), 0)
+        self.assertEqual(limiter.statistics()['messages'], 2)
+
+    def test_rate_limit_outbox(self):
+        """Messages sent again from the outbox outside of the workers
+        don't wait for the rate limiter either: the ones over the
+        limit stay in the outbox.
+        """
+        service = self.service
+        service._retry_delay = 0
+        self.break_relay()
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(service.get_outbox()), 2)
+
+        self.repair_relay()
+        service._rate_limit = 1
+        self.assertEqual(service.process_outbox(), 1)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+        self.assertEqual(len(service.get_outbox()), 1)
+        limiter = service.get_rate_limiter()
+        self.assertEqual(limiter.statistics()['postponed'], 1)
+
+    def test_bulk_delivery(self):
+        """Messages temporarily refused by the relay while sending in
+        bulk are kept in the outbox, even with non-ASCII text.
+        """
+        service = self.service
+        service._bulk_delivery = True
+        service._retry_delay = 0
+        service.smtp_factory = FakeBusySMTP
+        FakeSMTP.reset()
+        ISubscriptionManager(self.root).subscribe('busy@example.com')
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('other', u'\xdcberblick')
+
+        IPublicationWorkflow(self.root.other).publish()
+        transaction.commit()
+        self.assertEqual(
+            sorted(mto for mfrom, mto, message
+                   in FakeSMTP.connections[0].messages),
+            [['torvald@example.com'], ['wim@example.com']])
+        entry, = [entry for due, entry in service.get_outbox().get_pending()]
+        self.assertEqual(entry.recipients, ['busy@example.com'])
+        self.assertIn('451', entry.error)
+        self.assertIn('\xc3\x9cberblick', entry.message)
+
+        # The message goes out once the relay accepts it.
+        busy = FakeBusySMTP.busy
+        FakeBusySMTP.busy = set()
+        try:
+            self.assertEqual(service.process_outbox(), 1)
+            transaction.commit()
+        finally:
+            FakeBusySMTP.busy = busy
+        self.assertEqual(
+            [mto for mfrom, mto, message
+             in FakeSMTP.connections[1].messages],
+            [['busy@example.com']])
+        self.assertEqual(len(service.get_outbox()), 0)
+
+    def test_permanent_failure(self):
+        """Messages refused for a permanent reason are directly kept
+        as dead letters, instead of being retried.
+        """
+        service = self.service
+        service._retry_delay = 0
+        self.refuse_recipients()
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        outbox = service.get_outbox()
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.count_dead_letters(), 2)
+        self.assertEqual(
+            [entry.attempts for key, entry in outbox.get_dead_letters()],
+            [1, 1])
+        self.assertIn('550', outbox.get_dead_letters()[0][1].error)
+
+    def test_bulk_permanent_failure(self):
+        """Messages refused for a permanent reason while sending in
+        bulk are directly kept as dead letters.
+        """
+        service = self.service
+        service._bulk_delivery = True
+        service._retry_delay = 0
+        service.smtp_factory = FakeSMTP
+        FakeSMTP.reset()
+        FakeSMTP.refused.add('wim@example.com')
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(
+            [mto for mfrom, mto, message
+             in FakeSMTP.connections[0].messages],
+            [['torvald@example.com']])
+        outbox = service.get_outbox()
+        self.assertEqual(len(outbox), 0)
+        (key, entry), = outbox.get_dead_letters()
+        self.assertEqual(entry.recipients, ['wim@example.com'])
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn('550', entry.error)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(OutboxTestCase))
+    suite.addTest(unittest.makeSuite(ServiceOutboxTestCase))
+    return suite
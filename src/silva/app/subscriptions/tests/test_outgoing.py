@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.outgoing import get_mail_data_manager
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.core.interfaces import IPublicationWorkflow
+
+
+class FakeService(object):
+    """Service recording the messages it sends.
+    """
+    _p_jar = None
+
+    def __init__(self, failing=(), broken=False):
+        self.failing = failing
+        self.broken = broken
+        self.sent = []
+        self.deferred = []
+        self.throttled = []
+
+    def getPhysicalPath(self):
+        return ('', 'service_subscriptions')
+
+    def _send_now(self, messages, operation, traces, entries, throttle):
+        self.throttled.append(throttle)
+        failures = []
+        for message in messages:
+            if message in self.failing:
+                failures.append(
+                    (message, 'Connection refused', None, False))
+            else:
+                self.sent.append(message)
+        return failures
+
+    def _defer_messages(self, failures):
+        if self.broken:
+            raise ValueError(u"Cannot record failures")
+        self.deferred.extend(failures)
+
+
+class MailDataManagerTestCase(unittest.TestCase):
+    """Test messages are sent only when the transaction is committed.
+    """
+
+    def setUp(self):
+        transaction.abort()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_commit(self):
+        service = FakeService()
+        manager = get_mail_data_manager(service)
+        self.assertIs(get_mail_data_manager(service), manager)
+        manager.add(['hello', 'world'])
+        manager.add([])
+        self.assertEqual(len(manager), 2)
+        self.assertEqual(service.sent, [])
+        transaction.commit()
+        self.assertEqual(service.sent, ['hello', 'world'])
+        self.assertEqual(len(manager), 0)
+
+        # Each transaction has its own messages.
+        manager = get_mail_data_manager(service)
+        manager.add(['again'])
+        transaction.commit()
+        self.assertEqual(service.sent, ['hello', 'world', 'again'])
+
+    def test_abort(self):
+        service = FakeService()
+        get_mail_data_manager(service).add(['hello'])
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(service.sent, [])
+
+    def test_savepoint(self):
+        service = FakeService()
+        manager = get_mail_data_manager(service)
+        savepoint = transaction.savepoint()
+        manager.add(['rolled back'])
+        savepoint.rollback()
+        manager.add(['hello'])
+        savepoint = transaction.savepoint()
+        manager.add(['rolled back'])
+        savepoint.rollback()
+        transaction.commit()
+        self.assertEqual(service.sent, ['hello'])
+
+    def test_throttled(self):
+        service = FakeService()
+        get_mail_data_manager(service).add(['hello'])
+        transaction.commit()
+        manager = get_mail_data_manager(service)
+        manager.throttled = True
+        manager.add(['world'])
+        transaction.commit()
+        self.assertEqual(service.throttled, [False, True])
+
+    def test_failures(self):
+        service = FakeService(failing=['world'])
+        get_mail_data_manager(service).add(['hello', 'world'])
+        transaction.commit()
+        self.assertEqual(service.sent, ['hello'])
+        self.assertEqual(
+            service.deferred, [('world', 'Connection refused', None, False)])
+
+    def test_failures_error(self):
+        """An error while recording failures is only logged, as the
+        transaction is committed already.
+        """
+        service = FakeService(failing=['world'], broken=True)
+        get_mail_data_manager(service).add(['hello', 'world'])
+        transaction.commit()
+        self.assertEqual(service.sent, ['hello'])
+        self.assertEqual(service.deferred, [])
+
+
+class ServiceConflictTestCase(unittest.TestCase):
+    """Test a transaction retried after a conflict sends its
+    notifications only once.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager.subscribe('wim@example.com')
+        transaction.commit()
+
+    def change_concurrently(self):
+        # Change the service with an other connection, and commit it
+        # first.
+        manager = transaction.TransactionManager()
+        connection = self.root._p_jar.db().open(transaction_manager=manager)
+        try:
+            connection.get(self.service._p_oid)._sitename = 'Other'
+            manager.commit()
+        finally:
+            connection.close()
+
+    def test_conflict(self):
+        mailhost = self.root.service_mailhost
+        attempts = 0
+        while True:
+            attempts += 1
+            IPublicationWorkflow(self.root.document).publish()
+            self.service._sitename = 'Silva'
+            if attempts == 1:
+                self.change_concurrently()
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                # Nothing was sent by the failed attempt.
+                self.assertEqual(len(mailhost.messages), 0)
+                continue
+            break
+
+        self.assertEqual(attempts, 2)
+        self.assertEqual(
+            sorted(message.mto for message in mailhost.messages),
+            [['torvald@example.com'], ['wim@example.com']])
+
+    def test_abort(self):
+        mailhost = self.root.service_mailhost
+        IPublicationWorkflow(self.root.document).publish()
+        self.service.request_subscription(
+            self.root.document, 'arthur@example.com')
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(len(mailhost.messages), 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MailDataManagerTestCase))
+    suite.addTest(unittest.makeSuite(ServiceConflictTestCase))
+    return suite
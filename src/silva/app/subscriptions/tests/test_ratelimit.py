@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+from silva.app.subscriptions.ratelimit import RateLimiter, get_rate_limiter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    """Test limiting the rate of sent messages.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_rate(self):
+        limiter = RateLimiter(
+            10, burst=2, clock=self.clock, sleep=self.clock.sleep)
+        # The two first messages are sent at once, the next ones wait.
+        self.assertEqual(limiter.wait(), 0)
+        self.assertEqual(limiter.wait(), 0)
+        self.assertAlmostEqual(limiter.wait(), 0.1)
+        self.assertAlmostEqual(limiter.wait(), 0.1)
+        self.assertAlmostEqual(self.clock.now, 1000.2)
+
+        statistics = limiter.statistics()
+        self.assertEqual(statistics['messages'], 4)
+        self.assertEqual(statistics['delayed'], 2)
+        self.assertEqual(statistics['waiting'], 0)
+        self.assertAlmostEqual(statistics['maximum_wait'], 0.1)
+
+        # After a while, the capacity is back.
+        self.clock.now += 10
+        self.assertEqual(limiter.statistics()['fill'], 100)
+        self.assertEqual(limiter.wait(), 0)
+
+    def test_domain_rate(self):
+        limiter = RateLimiter(
+            100, domain_rate=1, clock=self.clock, sleep=self.clock.sleep)
+        self.assertEqual(limiter.wait(['wim@example.com']), 0)
+        self.assertEqual(limiter.wait(['arthur@infrae.com']), 0)
+        self.assertAlmostEqual(limiter.wait(['sylvain@Example.com']), 1.0)
+
+    def test_acquire(self):
+        limiter = RateLimiter(
+            10, burst=2, domain_rate=1, clock=self.clock,
+            sleep=self.clock.sleep)
+        # Messages over the limit are refused instead of waiting.
+        self.assertEqual(limiter.acquire(['wim@example.com']), True)
+        self.assertEqual(limiter.acquire(['sylvain@example.com']), False)
+        self.assertEqual(limiter.acquire(['arthur@infrae.com']), True)
+        self.assertEqual(limiter.acquire(['torvald@infrae.org']), False)
+        self.assertEqual(self.clock.now, 1000.0)
+        statistics = limiter.statistics()
+        self.assertEqual(statistics['messages'], 2)
+        self.assertEqual(statistics['postponed'], 2)
+
+        self.clock.now += 1
+        self.assertEqual(limiter.acquire(['sylvain@example.com']), True)
+
+    def test_registry(self):
+        limiter = get_rate_limiter(('', 'root', 'service'), 10)
+        self.assertTrue(isinstance(limiter, RateLimiter))
+        self.assertTrue(
+            get_rate_limiter(('', 'root', 'service'), 10) is limiter)
+        self.assertFalse(
+            get_rate_limiter(('', 'root', 'service'), 20) is limiter)
+        self.assertEqual(get_rate_limiter(('', 'root', 'service'), 0), None)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RateLimiterTestCase))
+    return suite
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import cPickle
+import unittest
+
+import transaction
+
+from Products.PageTemplates.ZopePageTemplate import manage_addPageTemplate
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.rendering import MessageRenderer
+from silva.app.subscriptions.rendering import SnapshotContent
+from silva.app.subscriptions.rendering import is_rendered_once
+from silva.app.subscriptions.rendering import set_rendered_once
+from silva.app.subscriptions.snapshot import PublicationSnapshot
+from silva.app.subscriptions.snapshot import take_snapshot
+from silva.core.references.reference import get_content_id
+from silva.core.references.reference import get_content_from_id
+from silva.app.subscriptions.testing import FunctionalLayer
+
+
+class MessageRendererTestCase(unittest.TestCase):
+    """Test rendering a template for multiple recipients.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addFolder('folder', u'Test Folder')
+
+    def get_renderer(self, template_id):
+        service = getUtility(ISubscriptionService)
+        content = self.root.document
+        template = service._get_template(content, template_id)
+        return MessageRenderer(
+            template, service._get_default_data(content)), template
+
+    def test_render_once(self):
+        """The message rendered once for all recipients is the same
+        than the one rendered for each of them.
+        """
+        renderer, template = self.get_renderer('publication_event_template')
+        self.assertEqual(is_rendered_once(template), True)
+        data = getUtility(ISubscriptionService)._get_default_data(
+            self.root.document)
+        for email, content in [
+            ('wim@example.com', self.root),
+            ('torvald@example.com', self.root.folder),
+            ('sylvain@example.com', self.root)]:
+            message = renderer.render(email, content)
+            data.update({
+                    'to': email,
+                    'subscribed_content': content,
+                    'service_url': content.absolute_url() +
+                    '/subscriptions.html'})
+            self.assertEqual(message, template(**data))
+            self.assertIn('To: %s' % email, message)
+            self.assertIn(content.absolute_url(), message)
+        self.assertEqual(renderer._split, True)
+
+    def test_render_per_recipient(self):
+        """A template is rendered for each recipient, unless it is
+        marked as rendered once.
+        """
+        service = getUtility(ISubscriptionService)
+        manage_addPageTemplate(
+            service, 'custom_template',
+            text=u'To: <tal:to tal:replace="options/to" />')
+        renderer, template = self.get_renderer('custom_template')
+        self.assertEqual(is_rendered_once(template), False)
+        self.assertEqual(
+            renderer.render('wim@example.com', self.root).strip(),
+            u'To: wim@example.com')
+        self.assertEqual(renderer._split, False)
+
+        set_rendered_once(service.custom_template)
+        renderer, template = self.get_renderer('custom_template')
+        self.assertEqual(
+            renderer.render('wim@example.com', self.root).strip(),
+            u'To: wim@example.com')
+        self.assertEqual(renderer._split, True)
+        set_rendered_once(service.custom_template, False)
+        self.assertEqual(is_rendered_once(service.custom_template), False)
+
+    def test_snapshot(self):
+        """Snapshots are immutable and picklable.
+        """
+        snapshot = take_snapshot(self.root.document)
+        self.assertEqual(snapshot.content_id,
+                         get_content_id(self.root.document))
+        self.assertEqual(snapshot.path, ('', 'root', 'document'))
+        self.assertEqual(snapshot.url, 'http://localhost/root/document')
+        self.assertEqual(snapshot.title, 'Document')
+        self.assertEqual(
+            sorted(snapshot.get_metadata()['silva-extra'].keys()),
+            ['content_description', 'subject'])
+        self.assertRaises(AttributeError, setattr, snapshot, 'title', 'Other')
+        copy = cPickle.loads(cPickle.dumps(snapshot, 2))
+        self.assertTrue(isinstance(copy, PublicationSnapshot))
+        self.assertEqual(copy, snapshot)
+
+    def get_snapshot_renderer(self, snapshot, template_id):
+        service = getUtility(ISubscriptionService)
+        context = SnapshotContent(snapshot, self.root.getPhysicalRoot())
+        return MessageRenderer(
+            service._get_template(context, template_id),
+            service._get_default_data(
+                context, metadata=snapshot.get_metadata()))
+
+    def test_render_snapshot(self):
+        """A message rendered from a snapshot is the same than the
+        one rendered from the content.
+        """
+        renderer, template = self.get_renderer('publication_event_template')
+        snapshot_renderer = self.get_snapshot_renderer(
+            take_snapshot(self.root.document), 'publication_event_template')
+        for email, content in [
+            ('wim@example.com', self.root),
+            ('torvald@example.com', self.root.folder)]:
+            self.assertEqual(
+                snapshot_renderer.render(email, content),
+                renderer.render(email, content))
+
+    def test_render_snapshot_without_content(self):
+        """Rendering a message from a snapshot doesn't load the
+        content, it works even if the content is gone.
+        """
+        renderer, template = self.get_renderer('publication_event_template')
+        expected = renderer.render('wim@example.com', self.root)
+        snapshot = take_snapshot(self.root.document)
+        self.root.manage_delObjects(['document'])
+        self.assertEqual(get_content_from_id(snapshot.content_id), None)
+        snapshot_renderer = self.get_snapshot_renderer(
+            snapshot, 'publication_event_template')
+        self.assertEqual(
+            snapshot_renderer.render('wim@example.com', self.root), expected)
+
+        context = SnapshotContent(snapshot)
+        self.assertEqual(context.title, 'Document')
+        self.assertEqual(context.getPhysicalPath(), ('', 'root', 'document'))
+        self.assertRaises(AttributeError, getattr, context, 'meta_type')
+        self.assertRaises(KeyError, context.restrictedTraverse, 'meta_type')
+
+    def test_render_snapshot_fallback(self):
+        """A customized template using more than the snapshot
+        captured is rendered from the content.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        manage_addPageTemplate(
+            service, 'custom_template',
+            text=u'To: <tal:to tal:replace="options/to" />\n'
+            u'From: <tal:from tal:replace="options/from" />\n'
+            u'Subject: <tal:type tal:replace="context/meta_type" />:'
+            u'<tal:id tal:replace="context/getId" />\n\nHello.\n')
+        snapshot_renderer = self.get_snapshot_renderer(
+            take_snapshot(self.root.document), 'custom_template')
+        self.assertRaises(
+            Exception, snapshot_renderer.render, 'wim@example.com', self.root)
+
+        manager = ISubscriptionManager(self.root.document)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('wim@example.com')
+        service.send_notifications([self.root.document], 'custom_template')
+        transaction.commit()
+        message, = self.root.service_mailhost.messages
+        self.assertEqual(message.mto, ['wim@example.com'])
+        self.assertEqual(
+            message.subject, '%s:document' % self.root.document.meta_type)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MessageRendererTestCase))
+    return suite
@@ -4,6 +4,8 @@
 
 import unittest
 
+import transaction
+
 from zope.component import getUtility
 from zope.interface.verify import verifyObject
 
@@ -104,6 +106,9 @@ class SubscriptionServiceTestCase(unittest.TestCase):
         service = getUtility(ISubscriptionService)
         service.enable_subscriptions()
         service.request_subscription(self.root.document, "torvald@example.com")
+        # The message is sent once the transaction is committed.
+        self.assertEqual(self.root.service_mailhost.messages, [])
+        transaction.commit()
 
         message = self.root.service_mailhost.read_last_message()
         self.assertNotEqual(message, None)
@@ -171,6 +176,7 @@ class SubscriptionServiceTestCase(unittest.TestCase):
         service = getUtility(ISubscriptionService)
         service.enable_subscriptions()
         service.request_cancellation(self.root.document, "torvald@example.com")
+        transaction.commit()
 
         message = self.root.service_mailhost.read_last_message()
         self.assertNotEqual(message, None)
@@ -213,9 +219,11 @@ class SubscriptionServiceTestCase(unittest.TestCase):
         self.assertEqual(len(self.root.service_mailhost.messages), 0)
 
         IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
 
-        # We have two notification, one for the document, one for the ghost
-        self.assertEqual(len(self.root.service_mailhost.messages), 2)
+        # Torvald is subscribed to the document and the ghost, via
+        # the root, but receive only one notification.
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
         message = self.root.service_mailhost.messages[0]
         self.assertEqual(message.content_type, 'text/plain')
         self.assertEqual(message.charset, 'utf-8')
@@ -223,13 +231,6 @@ class SubscriptionServiceTestCase(unittest.TestCase):
         self.assertEqual(message.mfrom, 'notification@example.com')
         self.assertEqual(message.subject, 'Change notification for "Document"')
 
-        message = self.root.service_mailhost.messages[1]
-        self.assertEqual(message.content_type, 'text/plain')
-        self.assertEqual(message.charset, 'utf-8')
-        self.assertEqual(message.mto, ['torvald@example.com'])
-        self.assertEqual(message.mfrom, 'notification@example.com')
-        self.assertEqual(message.subject, 'Change notification for "ghost"')
-
         self.root.service_mailhost.reset()
         self.assertEqual(len(self.root.service_mailhost.messages), 0)
 
@@ -237,10 +238,221 @@ class SubscriptionServiceTestCase(unittest.TestCase):
         service.disable_subscriptions()
         self.root.document.create_copy()
         IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
 
         # No notification have been sent
         self.assertEqual(len(self.root.service_mailhost.messages), 0)
 
+    def test_case_duplicates_notification(self):
+        """Emails that differ only by the case of their domain are
+        notified once, while the case of their local part matters.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('Torvald@example.com')
+        manager.subscribe('wim@Example.com')
+        manager = ISubscriptionManager(self.root.document)
+        manager.subscribe('torvald@Example.com')
+        manager.subscribe('wim@example.COM')
+        self.assertEqual(len(manager.subscriptions), 3)
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertItemsEqual(
+            [message.mto for message in self.root.service_mailhost.messages],
+            [['Torvald@example.com'], ['torvald@example.com'],
+             ['wim@example.com']])
+
+    def test_subscribe_unsubscribe_many(self):
+        """Subscribe and unsubscribe many emails to many contents at
+        once.
+        """
+        service = getUtility(ISubscriptionService)
+        results = service.subscribe_many([
+                (self.root.document, 'wim@example.com'),
+                (self.root.folder, 'wim@example.com'),
+                (self.root.document, 'torvald@example.com'),
+                (self.root.document, 'invalid'),
+                (self.root.document, 'wim@example.com')])
+        self.assertEqual(results[:3], [True, True, True])
+        self.assertTrue(
+            isinstance(results[3], errors.InvalidEmailaddressError))
+        self.assertEqual(results[4], False)
+        self.assertEqual(
+            ISubscriptionManager(self.root.document).locally_subscribed_emails,
+            set(['wim@example.com', 'torvald@example.com']))
+        self.assertEqual(
+            ISubscriptionManager(self.root.folder).locally_subscribed_emails,
+            set(['wim@example.com']))
+
+        results = service.unsubscribe_many([
+                (self.root.document, 'wim@example.com'),
+                (self.root.folder, 'torvald@example.com'),
+                (self.root.folder, 'wim@example.com')])
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual(
+            ISubscriptionManager(self.root.document).locally_subscribed_emails,
+            set(['torvald@example.com']))
+        self.assertEqual(
+            ISubscriptionManager(self.root.folder).locally_subscribed_emails,
+            set())
+
+    def test_ghost_publication_notification(self):
+        """People subscribed to a ghost are notified about it when the
+        haunted content is published.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager = ISubscriptionManager(self.root.ghost)
+        manager.subscribe('wim@example.com')
+        manager.subscribe('torvald@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+
+        messages = dict(
+            (message.mto[0], message)
+            for message in self.root.service_mailhost.messages)
+        self.assertEqual(len(self.root.service_mailhost.messages), 2)
+        self.assertEqual(
+            sorted(messages.keys()),
+            ['torvald@example.com', 'wim@example.com'])
+        self.assertEqual(
+            messages['torvald@example.com'].subject,
+            'Change notification for "Document"')
+        self.assertEqual(
+            messages['wim@example.com'].subject,
+            'Change notification for "ghost"')
+
+    def test_queued_publication_notification(self):
+        """If notifications are sent in the background, publishing
+        only queue them. They are sent when the queue is processed.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        service._asynchronous = True
+        self.assertEqual(service.get_pending_notifications(), 0)
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+
+        # Nothing is sent, but the publication is queued, with a
+        # snapshot of the content.
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        self.assertEqual(service.get_pending_notifications(), 1)
+        notification, = service._notifications.peek()
+        self.assertEqual(
+            [snapshot.title for snapshot in notification.snapshots],
+            ['Document', 'ghost'])
+
+        self.root.document.create_copy()
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        self.assertEqual(service.get_pending_notifications(), 2)
+
+        # Process the queue one notification at a time.
+        self.assertEqual(service.process_notifications(1), 1)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+        self.assertEqual(service.get_pending_notifications(), 1)
+        self.assertEqual(service.process_notifications(), 1)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 2)
+        self.assertEqual(service.get_pending_notifications(), 0)
+        self.assertEqual(service.process_notifications(), 0)
+
+        message = self.root.service_mailhost.messages[0]
+        self.assertEqual(message.mto, ['torvald@example.com'])
+        self.assertEqual(message.subject, 'Change notification for "Document"')
+
+    def test_coalesced_publication_notification(self):
+        """Contents published in the same transaction are notified
+        in only one message per subscriber, listing all of them.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        factory = self.root.folder.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('index', 'Index')
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+        manager = ISubscriptionManager(self.root.folder.index)
+        manager.subscribe('wim@example.com')
+        transaction.commit()
+
+        IPublicationWorkflow(self.root.document).publish()
+        IPublicationWorkflow(self.root.folder.index).publish()
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        transaction.commit()
+
+        messages = dict(
+            (message.mto[0], message)
+            for message in self.root.service_mailhost.messages)
+        self.assertEqual(len(self.root.service_mailhost.messages), 2)
+        self.assertEqual(
+            sorted(messages.keys()),
+            ['torvald@example.com', 'wim@example.com'])
+        message = messages['torvald@example.com']
+        self.assertEqual(message.subject, 'Changes notification from root')
+        self.assertIn('http://localhost/root/document', message.urls)
+        self.assertIn('http://localhost/root/folder/index', message.urls)
+        message = messages['wim@example.com']
+        self.assertIn('http://localhost/root/folder/index', message.urls)
+        self.assertNotIn('http://localhost/root/document', message.urls)
+
+        # Nothing is sent if the transaction is aborted.
+        self.root.service_mailhost.reset()
+        self.root.document.create_copy()
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+
+    def test_coalesced_queued_publication_notification(self):
+        """Contents published in the same transaction are queued as
+        only one notification.
+        """
+        service = getUtility(ISubscriptionService)
+        service.enable_subscriptions()
+        service._asynchronous = True
+        factory = self.root.folder.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('index', 'Index')
+
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+
+        IPublicationWorkflow(self.root.document).publish()
+        IPublicationWorkflow(self.root.folder.index).publish()
+        transaction.commit()
+        self.assertEqual(service.get_pending_notifications(), 1)
+        notification, = service._notifications.peek()
+        self.assertEqual(len(notification.groups), 2)
+        self.assertEqual(
+            [snapshot.title for snapshot in notification.snapshots],
+            ['Document', 'ghost', 'Index'])
+
+        self.assertEqual(service.process_notifications(), 1)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+        message = self.root.service_mailhost.read_last_message()
+        self.assertEqual(message.mto, ['torvald@example.com'])
+        self.assertIn('http://localhost/root/document', message.urls)
+        self.assertIn('http://localhost/root/folder/index', message.urls)
+
 
 def test_suite():
     suite = unittest.TestSuite()
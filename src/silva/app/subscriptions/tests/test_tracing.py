@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+import transaction
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.interfaces import SUBSCRIBABLE
+from silva.app.subscriptions.publications import _batches
+from silva.app.subscriptions.testing import FunctionalLayer
+from silva.app.subscriptions.tracing import Trace, LatencyRecorder
+from silva.app.subscriptions.tracing import percentile
+from silva.core.interfaces import IPublicationWorkflow
+from silva.core.references.reference import get_content_id
+
+
+class TracingTestCase(unittest.TestCase):
+    """Test recording the latency of notifications.
+    """
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3.0], 90), 3.0)
+        self.assertEqual(percentile([], 50), None)
+
+    def test_recorder(self):
+        recorder = LatencyRecorder(contents=2)
+        for number, content_id in enumerate([1, 1, 2, 3]):
+            trace = Trace(content_id, received=100.0)
+            trace.mark('resolved', 100.5)
+            trace.mark('delivered', 101.0 + number)
+            recorder.record(trace)
+
+        report = recorder.report()
+        self.assertEqual(report['delivered']['count'], 4)
+        self.assertEqual(report['delivered'][50], 2.0)
+        self.assertEqual(report['delivered'][99], 4.0)
+        self.assertEqual(report['resolved'][90], 0.5)
+        self.assertEqual(report['rendered']['count'], 0)
+        self.assertEqual(report['rendered'][50], None)
+
+        # Only the two last contents are kept.
+        self.assertEqual(recorder.get_content_ids(), [2, 3])
+        self.assertEqual(recorder.report(1)['delivered']['count'], 0)
+        self.assertEqual(recorder.report(3)['delivered'][50], 4.0)
+
+
+class ServiceTracingTestCase(unittest.TestCase):
+    """Test tracing notifications sent by the service.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        self.service = getUtility(ISubscriptionService)
+        self.service.enable_subscriptions()
+        self.service.get_latency_recorder().reset()
+        manager = ISubscriptionManager(self.root)
+        manager.subscribability = SUBSCRIBABLE
+        manager.subscribe('torvald@example.com')
+
+    def test_publication(self):
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+
+        report = self.service.get_latency_report(self.root.document)
+        self.assertEqual(
+            report.keys(), ['resolved', 'rendered', 'handed', 'delivered'])
+        for stage, entry in report.items():
+            self.assertEqual(entry['count'], 1)
+        self.assertTrue(
+            report['resolved'][50] <= report['rendered'][50] <=
+            report['handed'][50] <= report['delivered'][50])
+        self.assertEqual(
+            self.service.get_latency_report()['delivered']['count'], 1)
+
+    def test_queued_publication(self):
+        self.service._asynchronous = True
+        IPublicationWorkflow(self.root.document).publish()
+        transaction.commit()
+
+        # The trace is kept with the queued notification.
+        notification, = self.service._notifications.peek()
+        self.assertEqual(
+            notification.trace.content_id, get_content_id(self.root.document))
+        self.assertEqual(notification.trace.stages, {})
+        report = self.service.get_latency_report(self.root.document)
+        self.assertEqual(report['delivered']['count'], 0)
+
+        self.assertEqual(self.service.process_notifications(), 1)
+        report = self.service.get_latency_report(self.root.document)
+        self.assertEqual(report['delivered']['count'], 0)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+        report = self.service.get_latency_report(self.root.document)
+        self.assertEqual(report['delivered']['count'], 1)
+
+    def test_queued_summary(self):
+        """Traces of contents published together are kept with the
+        queued notification listing them.
+        """
+        self.service._asynchronous = True
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('other', 'Other')
+        IPublicationWorkflow(self.root.document).publish()
+        IPublicationWorkflow(self.root.other).publish()
+        transaction.commit()
+
+        notification, = self.service._notifications.peek()
+        self.assertEqual(
+            [trace.content_id for trace in notification.traces],
+            [get_content_id(self.root.document),
+             get_content_id(self.root.other)])
+        self.assertEqual(self.service.process_notifications(), 1)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 1)
+        for content in (self.root.document, self.root.other):
+            report = self.service.get_latency_report(content)
+            self.assertEqual(report['delivered']['count'], 1)
+
+    def test_disabled(self):
+        """Nothing is traced if subscriptions are disabled.
+        """
+        self.service.disable_subscriptions()
+        IPublicationWorkflow(self.root.document).publish()
+        self.assertNotIn(transaction.get(), _batches)
+        transaction.commit()
+        self.assertEqual(len(self.root.service_mailhost.messages), 0)
+        self.assertEqual(
+            self.service.get_latency_report()['resolved']['count'], 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TracingTestCase))
+    suite.addTest(unittest.makeSuite(ServiceTracingTestCase))
+    return suite
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from cStringIO import StringIO
+import unittest
+
+from zope.component import getUtility
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.interfaces import ISubscriptionService
+from silva.app.subscriptions.testing import FunctionalLayer
+
+
+class TransferTestCase(unittest.TestCase):
+    """Test importing and exporting subscriptions as CSV.
+    """
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('document', 'Document')
+        factory.manage_addFolder('folder', u'Test Folder')
+        factory = self.root.folder.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('index', 'Index')
+
+    def test_import(self):
+        service = getUtility(ISubscriptionService)
+        ISubscriptionManager(self.root.document).subscribe('wim@example.com')
+        reports = []
+        report = service.import_subscriptions(StringIO(
+                '/document,torvald@example.com\n'
+                '/document,wim@example.com\n'
+                '/document,wim@EXAMPLE.com\n'
+                '\n'
+                '/folder/index, arthur@example.com\n'
+                '/folder,wim@example.com\n'
+                '/nowhere,wim@example.com\n'
+                '/folder,not an email\n'
+                '/folder\n'), batch_size=2, commit=False,
+                progress=reports.append)
+        self.assertEqual(report.rows, 8)
+        self.assertEqual(report.imported, 3)
+        self.assertEqual(report.existing, 2)
+        self.assertEqual([line for line, message in report.errors],
+                         [7, 8, 9])
+        # Progress is reported after each batch, the last one being
+        # possibly smaller.
+        self.assertEqual(len(reports), 4)
+
+        self.assertEqual(
+            ISubscriptionManager(self.root.document).locally_subscribed_emails,
+            set(['torvald@example.com', 'wim@example.com']))
+        self.assertEqual(
+            ISubscriptionManager(self.root.folder).locally_subscribed_emails,
+            set(['wim@example.com']))
+        self.assertEqual(
+            ISubscriptionManager(
+                self.root.folder.index).locally_subscribed_emails,
+            set(['arthur@example.com']))
+        # The index is updated.
+        self.assertEqual(
+            service.get_subscribed_content('arthur@example.com'),
+            [self.root.folder.index])
+
+    def test_export(self):
+        service = getUtility(ISubscriptionService)
+        ISubscriptionManager(self.root.document).subscribe('wim@example.com')
+        ISubscriptionManager(self.root.folder.index).subscribe(
+            'arthur@example.com')
+        ISubscriptionManager(self.root.folder.index).subscribe(
+            'torvald@example.com')
+        stream = StringIO()
+        self.assertEqual(service.export_subscriptions(stream), 3)
+        self.assertEqual(
+            sorted(stream.getvalue().splitlines()),
+            ['/document,wim@example.com',
+             '/folder/index,arthur@example.com',
+             '/folder/index,torvald@example.com'])
+
+        # What is exported can be imported back.
+        ISubscriptionManager(self.root.document).unsubscribe(
+            'wim@example.com')
+        stream.seek(0)
+        report = service.import_subscriptions(stream, commit=False)
+        self.assertEqual(report.imported, 1)
+        self.assertEqual(report.existing, 2)
+        self.assertEqual(report.errors, [])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TransferTestCase))
+    return suite
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+
+import unittest
+
+from ..interfaces import ISubscriptionManager
+from ..subscribable import query_subscribable_data
+from ..subscribers import SubscriberSet
+from ..testing import FunctionalLayer
+from ..upgrader.upgrade_304 import subscription_storage_upgrader
+from ..upgrader.upgrade_304 import subscription_address_upgrader
+from ..upgrader.upgrade_304 import service_index_upgrader
+
+
+class StorageUpgraderTestCase(unittest.TestCase):
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        self.layer.login('editor')
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addMockupVersionedContent('item', 'Document')
+
+    def test_upgrade_storage(self):
+        """Test upgrade of subscriptions stored in a set.
+        """
+        content = self.root.item
+        self.assertEqual(
+            subscription_storage_upgrader.validate(content),
+            False)
+        manager = ISubscriptionManager(content)
+        manager.subscribe('wim@example.com')
+        data = query_subscribable_data(content)
+        data.subscriptions = set(['wim@example.com', 'arthur@example.com'])
+        self.assertEqual(
+            subscription_storage_upgrader.validate(content),
+            True)
+        self.assertEqual(
+            subscription_storage_upgrader.upgrade(content),
+            content)
+        self.assertEqual(
+            subscription_storage_upgrader.validate(content),
+            False)
+        self.assertTrue(isinstance(data.subscriptions, SubscriberSet))
+        self.assertEqual(
+            manager.locally_subscribed_emails,
+            set(['wim@example.com', 'arthur@example.com']))
+
+        # Nothing is stored for an empty set.
+        data.subscriptions = set()
+        self.assertEqual(
+            subscription_storage_upgrader.validate(content),
+            True)
+        subscription_storage_upgrader.upgrade(content)
+        self.assertEqual(data.subscriptions, frozenset())
+        self.assertEqual(
+            subscription_storage_upgrader.validate(content),
+            False)
+
+    def test_upgrade_addresses(self):
+        """Test upgrade of subscribed emails not in canonical form.
+        """
+        content = self.root.item
+        manager = ISubscriptionManager(content)
+        manager.subscribe('wim@example.com')
+        self.assertEqual(
+            subscription_address_upgrader.validate(content),
+            False)
+        data = query_subscribable_data(content)
+        data.subscriptions.insert(u'Arthur@Example.com')
+        data.subscriptions.insert(u'wim@Example.com ')
+        self.assertEqual(
+            subscription_address_upgrader.validate(content),
+            True)
+        self.assertEqual(
+            subscription_address_upgrader.upgrade(content),
+            content)
+        self.assertEqual(
+            subscription_address_upgrader.validate(content),
+            False)
+        self.assertEqual(
+            manager.locally_subscribed_emails,
+            set(['wim@example.com', 'Arthur@example.com']))
+        self.assertEqual(len(data.subscriptions), 2)
+
+    def test_upgrade_index(self):
+        """Test existing subscriptions are indexed, once upgraded.
+        """
+        self.layer.login('manager')
+        factory = self.root.manage_addProduct['silva.app.subscriptions']
+        factory.manage_addSubscriptionService()
+        service = self.root.service_subscriptions
+        content = self.root.item
+        ISubscriptionManager(content).subscribe('wim@example.com')
+        data = query_subscribable_data(content)
+        data.subscriptions = set(['wim@example.com', u'Arthur@Example.com'])
+        service._index = None
+        self.assertEqual(service.get_subscribed_content('wim@example.com'), [])
+        self.assertEqual(service_index_upgrader.validate(service), True)
+        self.assertEqual(service_index_upgrader.upgrade(service), service)
+        self.assertTrue(isinstance(data.subscriptions, SubscriberSet))
+        self.assertEqual(
+            service.get_subscribed_content('wim@example.com'), [content])
+        self.assertEqual(
+            service.get_subscribed_content('Arthur@example.com'), [content])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StorageUpgraderTestCase))
+    return suite
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from collections import OrderedDict, deque
+import math
+import threading
+import time
+import uuid
+
+# Stages of a notification after the publication event is received.
+STAGES = ('resolved', 'rendered', 'handed', 'delivered')
+PERCENTILES = (50, 90, 99)
+
+
+class Trace(object):
+    """Timestamps of the stages of a notification fan-out, from the
+    publication of a content to the delivery of the last message.
+
+    A stage is marked every time one message reaches it, so its
+    timestamp is the one of the last recipient.
+    """
+
+    def __init__(self, content_id, received=None):
+        self.trace_id = uuid.uuid4().hex
+        self.content_id = content_id
+        self.received = received if received is not None else time.time()
+        self.stages = {}
+
+    def mark(self, stage, when=None):
+        self.stages[stage] = when if when is not None else time.time()
+
+    def latencies(self):
+        """Return the seconds elapsed between the reception of the
+        event and every reached stage.
+        """
+        return dict((stage, when - self.received)
+                    for stage, when in self.stages.items())
+
+    def __repr__(self):
+        return '<Trace %s for %s>' % (self.trace_id, self.content_id)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+class LatencyRecorder(object):
+    """Latencies of the last completed traces, for the whole service
+    and per content, shared by all threads.
+    """
+
+    def __init__(self, size=1000, content_size=100, contents=500):
+        self.size = size
+        self.content_size = content_size
+        self.contents = contents
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._service = dict(
+            (stage, deque(maxlen=self.size)) for stage in STAGES)
+        self._contents = OrderedDict()
+
+    def record(self, trace):
+        latencies = trace.latencies()
+        with self._lock:
+            contents = self._contents.pop(trace.content_id, None)
+            if contents is None:
+                contents = dict(
+                    (stage, deque(maxlen=self.content_size))
+                    for stage in STAGES)
+            self._contents[trace.content_id] = contents
+            while len(self._contents) > self.contents:
+                self._contents.popitem(last=False)
+            for stage, latency in latencies.items():
+                if stage in self._service:
+                    self._service[stage].append(latency)
+                    contents[stage].append(latency)
+
+    def get_content_ids(self):
+        with self._lock:
+            return list(self._contents.keys())
+
+    def report(self, content_id=None):
+        """Return for each stage the number of recorded latencies and
+        their percentiles, for the service or a given content.
+        """
+        with self._lock:
+            if content_id is None:
+                latencies = self._service
+            else:
+                latencies = self._contents.get(content_id, {})
+            latencies = dict(
+                (stage, list(values)) for stage, values in latencies.items())
+        report = OrderedDict()
+        for stage in STAGES:
+            values = latencies.get(stage, [])
+            entry = report[stage] = {'count': len(values)}
+            for percent in PERCENTILES:
+                entry[percent] = percentile(values, percent)
+        return report
+
+    def render(self, prefix='silva_subscriptions'):
+        """Render the service latencies in the Prometheus text format.
+        """
+        lines = []
+        for stage, entry in self.report().items():
+            for percent in PERCENTILES:
+                if entry[percent] is not None:
+                    lines.append(
+                        '%s_latency_seconds{stage="%s",quantile="%s"} %f' % (
+                            prefix, stage, percent / 100.0, entry[percent]))
+            lines.append('%s_latency_seconds_count{stage="%s"} %d' % (
+                    prefix, stage, entry['count']))
+        return '\n'.join(lines) + '\n'
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_latency_recorder(key):
+    """Return the latency recorder shared by all threads for the
+    given key.
+    """
+    with _recorders_lock:
+        recorder = _recorders.get(key)
+        if recorder is None:
+            recorder = _recorders[key] = LatencyRecorder()
+        return recorder
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from cStringIO import StringIO
+import csv
+import logging
+
+import transaction
+
+from silva.app.subscriptions.interfaces import ISubscriptionManager
+from silva.app.subscriptions.subscribable import walk_subscribable_data
+from silva.core.interfaces import ISilvaObject
+from z3c.schema.email import isValidMailAddress
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+
+def get_content_path(root, content):
+    """Return the path of content relative to the root of the site.
+    """
+    path = content.getPhysicalPath()[len(root.getPhysicalPath()):]
+    return '/' + '/'.join(path)
+
+
+def export_subscriptions(root, stream, chunk_size=1000):
+    """Write all the subscriptions of the site as content path, email
+    CSV rows in stream, chunk_size rows at a time. Return the number
+    of written rows.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    for content, data in walk_subscribable_data(root):
+        path = get_content_path(root, content)
+        for email in data.subscriptions:
+            if isinstance(email, unicode):
+                email = email.encode('utf-8')
+            writer.writerow((path, email))
+            count += 1
+            if not count % chunk_size:
+                stream.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+    stream.write(buffer.getvalue())
+    return count
+
+
+class ImportReport(object):
+    """Result of an import of subscriptions.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.existing = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+    def __repr__(self):
+        return '<ImportReport %d rows, %d imported, %d errors>' % (
+            self.rows, self.imported, len(self.errors))
+
+
+def import_subscriptions(root, stream, batch_size=1000, commit=True,
+                         progress=None):
+    """Subscribe the emails listed with content paths in the CSV
+    rows read from stream. Changes are committed every batch_size rows
+    if commit is true, and progress is called with the report after
+    each batch. Invalid rows are reported and skipped.
+    """
+    report = ImportReport()
+    managers = {}
+
+    def get_manager(path):
+        if path not in managers:
+            content = root.unrestrictedTraverse(path.strip('/'), None)
+            manager = None
+            if ISilvaObject.providedBy(content):
+                manager = ISubscriptionManager(content, None)
+            managers[path] = manager
+        return managers[path]
+
+    def end_batch():
+        if commit:
+            transaction.commit()
+        logger.info(
+            u"Imported %d subscriptions out of %d rows.",
+            report.imported, report.rows)
+        if progress is not None:
+            progress(report)
+
+    def import_row(line, row):
+        if len(row) != 2:
+            report.error(line, u"expected a content path and an email")
+            return
+        path, email = row[0].strip(), row[1].strip()
+        if not isValidMailAddress(email):
+            report.error(line, u"invalid email address %s" % email)
+            return
+        manager = get_manager(path)
+        if manager is None:
+            report.error(line, u"no subscribable content at %s" % path)
+            return
+        if manager.subscribe_many([email])[0]:
+            report.imported += 1
+        else:
+            report.existing += 1
+
+    for line, row in enumerate(csv.reader(stream), 1):
+        if not row or (len(row) == 1 and not row[0].strip()):
+            # Skip empty lines.
+            continue
+        report.rows += 1
+        import_row(line, row)
+        if not report.rows % batch_size:
+            end_batch()
+    if report.rows % batch_size or not report.rows:
+        end_batch()
+    return report
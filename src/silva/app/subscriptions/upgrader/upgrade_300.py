@@ -9,6 +9,7 @@ from Acquisition import aq_base
 from silva.core.interfaces import IContent, IContainer
 from silva.core.upgrade.upgrade import BaseUpgrader, AnyMetaType, content_path
 from silva.app.subscriptions.subscribable import SubscribableData
+from silva.app.subscriptions.subscribers import SubscriberSet
 from zope.annotation.interfaces import IAnnotations
 
 VERSION_A0='3.0a0'
@@ -31,7 +32,7 @@ class SubscriptionUpgrader(BaseUpgrader):
         data = SubscribableData(content.__subscribability__)
         annotations['silva.app.subscriptions'] = data
         if hasattr(aq_base(content), '__subscriptions__'):
-            data.subscriptions = set(content.__subscriptions__.keys())
+            data.subscriptions = SubscriberSet(content.__subscriptions__.keys())
             delattr(content, '__subscriptions__')
         if hasattr(aq_base(content), '__pending_subscription_tokens__'):
             delattr(content, '__pending_subscription_tokens__')
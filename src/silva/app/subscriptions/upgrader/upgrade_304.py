@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import logging
+import os
+
+from Products.Silva.install import add_helper, pt_add_helper
+
+from silva.core.upgrade.upgrade import BaseUpgrader, AnyMetaType
+from silva.core.upgrade.upgrade import content_path
+from silva.app import subscriptions
+from silva.app.subscriptions.cache import subscribers_cache
+from silva.app.subscriptions.rendering import is_rendered_once
+from silva.app.subscriptions.rendering import set_rendered_once
+from silva.app.subscriptions.subscribable import query_subscribable_data
+from silva.app.subscriptions.subscribable import walk_subscribable_data
+from silva.app.subscriptions.subscribers import SubscriberSet
+
+VERSION_FINAL='3.0.4'
+logger = logging.getLogger('silva.core.upgrade')
+
+
+class ServiceTemplatesUpgrader(BaseUpgrader):
+    """Add the templates introduced since the service was created,
+    and mark the default notification template as rendered once for
+    all recipients if it was not customized.
+    """
+    templates = ['digest_template', 'summary_template']
+    shared = 'publication_event_template'
+
+    def is_shareable(self, service):
+        template = service._getOb(self.shared, None)
+        if template is None or is_rendered_once(template):
+            return False
+        path = os.path.join(
+            os.path.dirname(subscriptions.__file__), 'layout',
+            self.shared + '.pt')
+        with open(path) as stream:
+            text = stream.read().decode('utf-8')
+        return template.read().strip() == text.strip()
+
+    def validate(self, service):
+        for identifier in self.templates:
+            if identifier not in service.objectIds():
+                return True
+        return self.is_shareable(service)
+
+    def upgrade(self, service):
+        globs = {'__file__': subscriptions.__file__}
+        for identifier in self.templates:
+            if identifier not in service.objectIds():
+                logger.info(u'Add template %s to subscription service.',
+                            identifier)
+                add_helper(
+                    service, identifier + '.pt', globs, pt_add_helper, True)
+        if self.is_shareable(service):
+            logger.info(u'Render template %s once for all recipients.',
+                        self.shared)
+            set_rendered_once(service._getOb(self.shared))
+        return service
+
+
+service_templates_upgrader = ServiceTemplatesUpgrader(
+    VERSION_FINAL, 'Silva Subscription Service')
+
+
+class SubscriptionStorageUpgrader(BaseUpgrader):
+    """Store subscribed emails in a SubscriberSet instead of a set.
+    """
+
+    def validate(self, content):
+        data = query_subscribable_data(content)
+        return data is not None and not isinstance(
+            data.subscriptions, (SubscriberSet, frozenset))
+
+    def upgrade(self, content):
+        logger.info(u'Update subscriptions storage in: %s.',
+                    content_path(content))
+        query_subscribable_data(content).migrate()
+        return content
+
+
+subscription_storage_upgrader = SubscriptionStorageUpgrader(
+    VERSION_FINAL, AnyMetaType)
+
+
+class SubscriptionAddressUpgrader(BaseUpgrader):
+    """Store subscribed emails in their canonical form.
+    """
+
+    def validate(self, content):
+        data = query_subscribable_data(content)
+        return data is not None and bool(data.get_denormalized_emails())
+
+    def upgrade(self, content):
+        logger.info(u'Normalize subscribed emails in: %s.',
+                    content_path(content))
+        data = query_subscribable_data(content)
+        data.normalize()
+        subscribers_cache.invalidate(data)
+        return content
+
+
+subscription_address_upgrader = SubscriptionAddressUpgrader(
+    VERSION_FINAL, AnyMetaType)
+
+
+class ServiceIndexUpgrader(BaseUpgrader):
+    """Index the existing subscriptions in the service.
+    """
+
+    def validate(self, service):
+        # Subscriptions added since the code was updated are already
+        # indexed, but not the ones made before.
+        return True
+
+    def upgrade(self, service):
+        # The storage and addresses of the subscriptions must be
+        # upgraded first, the content might not have been visited yet.
+        for content, data in walk_subscribable_data(service.get_root()):
+            for upgrader in (subscription_storage_upgrader,
+                             subscription_address_upgrader):
+                if upgrader.validate(content):
+                    upgrader.upgrade(content)
+        logger.info(u'Index subscriptions in subscription service.')
+        service.rebuild_index()
+        return service
+
+
+service_index_upgrader = ServiceIndexUpgrader(
+    VERSION_FINAL, 'Silva Subscription Service', 500)
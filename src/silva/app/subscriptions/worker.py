@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Infrae. All rights reserved.
+# See also LICENSE.txt
+
+"""Background worker sending queued notifications.
+
+It is meant to be run next to the Zope instance, for instance from
+a cron job::
+
+  bin/silva-subscriptions-worker -C parts/instance/etc/zope.conf /root
+
+Messages that failed to be sent before are sent again when they are
+due. Digests are sent the same way, using the --digest option with
+hourly or daily. Bounces received in a Maildir or a mbox are processed
+with the --bounces option.
+
+To deliver queued notifications with several processes, use
+``silva-subscriptions-delivery`` instead.
+"""
+
+import logging
+import optparse
+import sys
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from silva.app.subscriptions.digest import DIGEST_PERIODS
+
+logger = logging.getLogger('silva.app.subscriptions')
+
+MAXIMUM_RETRIES = 3
+
+
+def process_queue(service, batch_size=None, limit=None):
+    """Drain the notification queue of the given service, one batch
+    per transaction. Return the number of processed notifications.
+    """
+    processed = 0
+    retries = 0
+    while limit is None or processed < limit:
+        if limit is not None and batch_size is not None:
+            batch_size = min(batch_size, limit - processed)
+        try:
+            count = service.process_notifications(batch_size)
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            retries += 1
+            if retries > MAXIMUM_RETRIES:
+                raise
+            logger.info(u"Conflict while sending notifications, retrying.")
+            continue
+        retries = 0
+        if not count:
+            break
+        processed += count
+    return processed
+
+
+def send_outbox(service):
+    """Send again the messages that failed before and are due.
+    Return their number.
+    """
+    try:
+        count = service.process_outbox(throttle=True)
+        transaction.commit()
+    except ConflictError:
+        transaction.abort()
+        logger.info(u"Conflict while sending the outbox, skipping.")
+        return 0
+    if count:
+        logger.info(u"Sent again %d messages from the outbox.", count)
+    return count
+
+
+def get_site(app, path, base_url):
+    """Return the Silva root at the given path, setup to be used
+    outside of a request.
+    """
+    from AccessControl.SecurityManagement import newSecurityManager
+    from AccessControl.SpecialUsers import system
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setHooks, setSite
+    from urlparse import urlparse
+
+    url = urlparse(base_url)
+    environ = {'SERVER_NAME': url.hostname,
+               'SERVER_PORT': str(url.port or
+                                  (url.scheme == 'https' and 443 or 80))}
+    if url.scheme == 'https':
+        environ['HTTPS'] = 'on'
+    app = makerequest(app, environ=environ)
+    newSecurityManager(None, system)
+    root = app.unrestrictedTraverse(path)
+    setHooks()
+    setSite(root)
+    return root
+
+
+def get_service(root):
+    from zope.component import getUtility
+    from silva.app.subscriptions.interfaces import ISubscriptionService
+    return getUtility(ISubscriptionService)
+
+
+def get_parser():
+    parser = optparse.OptionParser(
+        usage=u"%prog -C zope.conf [options] /path/to/silva/root")
+    parser.add_option(
+        '-C', '--config', dest='config',
+        help=u"Zope configuration file")
+    parser.add_option(
+        '-b', '--batch-size', dest='batch_size', type='int',
+        help=u"Number of notifications sent per transaction")
+    parser.add_option(
+        '-u', '--url', dest='url', default='http://localhost:8080',
+        help=u"Public URL of the Zope server, used in notifications")
+    parser.add_option(
+        '-d', '--digest', dest='digest', choices=DIGEST_PERIODS,
+        help=u"Send the digests for the given period (hourly or daily) "
+        u"instead of the queued notifications")
+    parser.add_option(
+        '--rebuild-index', dest='rebuild_index', action='store_true',
+        help=u"Rebuild the index of subscribed email addresses")
+    parser.add_option(
+        '--bounces', dest='bounces', metavar='MAILBOX',
+        help=u"Unsubscribe the addresses reported by the bounces and "
+        u"complaints in the given Maildir or mbox")
+    parser.add_option(
+        '--remove-bounces', dest='remove_bounces', action='store_true',
+        help=u"Remove processed bounces from the mailbox")
+    parser.add_option(
+        '-i', '--interval', dest='interval', type='int', default=0,
+        help=u"Keep running, checking the queue every interval seconds")
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    options, args = parser.parse_args(argv)
+    if not options.config or len(args) != 1:
+        parser.error(u"You need to provide a configuration and a site.")
+
+    logging.basicConfig(level=logging.INFO)
+    from Zope2.Startup.run import configure
+    import Zope2
+    configure(options.config)
+    root = get_site(Zope2.app(), args[0], options.url)
+    if options.rebuild_index:
+        count = get_service(root).rebuild_index()
+        transaction.commit()
+        logger.info(u"Indexed %d subscribed email addresses.", count)
+        return 0
+    if options.bounces:
+        get_service(root).process_bounces(
+            options.bounces, options.remove_bounces)
+        transaction.commit()
+        return 0
+    if options.digest:
+        sent = get_service(root).send_digests(options.digest)
+        transaction.commit()
+        logger.info(u"Sent %d %s digests.", sent, options.digest)
+        return 0
+    while True:
+        processed = process_queue(get_service(root), options.batch_size)
+        if processed:
+            logger.info(u"Sent %d queued notifications.", processed)
+        send_outbox(get_service(root))
+        if not options.interval:
+            break
+        time.sleep(options.interval)
+        transaction.begin()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())